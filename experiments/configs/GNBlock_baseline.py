@@ -40,6 +40,15 @@ def get_config():
     config.log_every_epochs = 1
     config.eval_every_epochs = 10
     config.checkpoint_every_epochs = 10
+    config.eval_batch_size = 128 # number of windows evaluated at once
+    config.eval_error_tensors = False # save the mse/bias per lead time, node 
+        # and variable at every evaluation (to workdir/eval_errors)
+    config.compilation_cache_dir = None # e.g. "experiments/compilation_cache"
+    config.data_parallel = False # if True, take one step per batch_size windows, 
+        # split over the host devices (see experiments/data_parallel_scaling.py)
+    config.coordinator_address = None # "host:port" of process 0 for 
+        # multi-process training, with num_processes and process_id also set 
+        # (see experiments/launch_distributed.py)
     # config.num_train_steps = 100_000 # TODO is this different from epochs?
     # config.log_every_steps = 2
     # config.eval_every_steps = 1
@@ -56,5 +65,7 @@ def get_config():
     config.edge_features = (4, 8) # the last feature size will be the number of features that the graph predicts
     config.node_features = (32, 2)
     config.global_features = None
+    config.compute_dtype = 'float32' # 'bfloat16' for mixed precision 
+    config.param_dtype = 'float32' # keep float32 master weights 
 
     return config
@@ -0,0 +1,157 @@
+""" Benchmarks data-parallel training (train_step_batch) across 1/2/4/8
+    XLA host devices.
+
+    Each device count is run in its own process, since the number of host
+    devices is fixed by XLA_FLAGS=--xla_force_host_platform_device_count=<n>
+    when jax starts. The global batch size is kept fixed, so ideally the
+    throughput grows linearly with the number of devices (as long as there are
+    enough cores to back them).
+
+    Usage:
+        python -m experiments.data_parallel_scaling --batch_size 32
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+
+def make_synthetic_windows(n_windows, input_steps, output_steps, K,
+                           fully_connected_edges, seed):
+    """ Random windows with the same structure as the Lorenz datasets, so
+        that the benchmark does not depend on simulating the system. """
+    import numpy as np
+    from utils.jraph_data import timestep_to_graphstuple
+
+    rng = np.random.default_rng(seed)
+    n_steps = input_steps + output_steps
+    inputs, targets = [], []
+    for _ in range(n_windows):
+        data = rng.standard_normal((n_steps, K, 2)).astype(np.float32)
+        graphs = [timestep_to_graphstuple(data[t], K=K,
+                                          fully_connected_edges=fully_connected_edges)
+                  for t in range(n_steps)]
+        inputs.append(graphs[:input_steps])
+        targets.append(graphs[input_steps:])
+    return inputs, targets
+
+
+def run_worker(args):
+    """ Times train_step_batch on the devices of this process. """
+    import jax
+    import ml_collections
+    from flax.training import train_state
+    from utils.jraph_data import stack_windows
+    from utils.jraph_training import (create_model, create_optimizer,
+                                      create_data_parallel_mesh,
+                                      train_step_batch)
+
+    config = ml_collections.ConfigDict()
+    config.model = 'MLPGraphNetwork'
+    config.n_blocks = 2
+    config.share_params = False
+    config.dropout_rate = 0.1
+    config.skip_connections = False
+    config.layer_norm = False
+    config.activation = 'relu'
+    config.edge_features = (4, 8)
+    config.node_features = (32, 2)
+    config.global_features = None
+    config.optimizer = 'adam'
+    config.learning_rate = 1e-3
+
+    inputs, targets = make_synthetic_windows(
+        args.batch_size, input_steps=args.input_steps,
+        output_steps=args.output_steps, K=args.K,
+        fully_connected_edges=args.fully_connected_edges, seed=0)
+
+    rng = jax.random.key(0)
+    rng, init_rng = jax.random.split(rng)
+    init_net = create_model(config, deterministic=True)
+    params = jax.jit(init_net.init)(init_rng, inputs[0])
+    net = create_model(config, deterministic=False)
+    state = train_state.TrainState.create(
+        apply_fn=net.apply, params=params, tx=create_optimizer(config))
+
+    mesh = create_data_parallel_mesh()
+    assert args.batch_size % mesh.size == 0, (args.batch_size, mesh.size)
+    state = jax.device_put(
+        state, jax.sharding.NamedSharding(mesh, jax.sharding.PartitionSpec()))
+    batch_sharding = jax.sharding.NamedSharding(
+        mesh, jax.sharding.PartitionSpec('batch'))
+    batch_inputs, batch_targets = jax.device_put(
+        (stack_windows(inputs), stack_windows(targets)), batch_sharding)
+
+    def run_steps(state, rng, n_steps):
+        for _ in range(n_steps):
+            rng, dropout_rng = jax.random.split(rng)
+            state, metrics_update, _ = train_step_batch(
+                state=state, n_rollout_steps=args.output_steps,
+                input_window_graphs=batch_inputs,
+                target_window_graphs=batch_targets,
+                rngs={'dropout': dropout_rng})
+        jax.block_until_ready(state)
+        return state, rng
+
+    state, rng = run_steps(state, rng, args.warmup_steps) # includes compiling
+    start = time.perf_counter()
+    state, rng = run_steps(state, rng, args.steps)
+    elapsed = time.perf_counter() - start
+
+    # parsed by the parent process
+    print(f"RESULT {mesh.size} {elapsed / args.steps} "
+          f"{args.steps * args.batch_size / elapsed}")
+
+
+def run_benchmark(args):
+    """ Launches one worker per device count and prints a summary table. """
+    results = []
+    for n_devices in args.device_counts:
+        env = dict(os.environ)
+        env["XLA_FLAGS"] = (env.get("XLA_FLAGS", "")
+            + f" --xla_force_host_platform_device_count={n_devices}")
+        env["JAX_PLATFORMS"] = "cpu"
+        cmd = [sys.executable, "-m", "experiments.data_parallel_scaling",
+               "--worker"] + [f"--{name}={getattr(args, name)}" for name in
+               ["batch_size", "steps", "warmup_steps", "input_steps",
+                "output_steps", "K", "fully_connected_edges"]]
+        out = subprocess.run(cmd, env=env, capture_output=True, text=True,
+                             check=True)
+        line = [l for l in out.stdout.splitlines() if l.startswith("RESULT")][-1]
+        _, n, step_time, windows_per_sec = line.split()
+        results.append((int(n), float(step_time), float(windows_per_sec)))
+
+    base_throughput = results[0][2]
+    print(f"global batch size {args.batch_size}, {os.cpu_count()} cpu cores")
+    print(f"{'devices':>8} {'step time (ms)':>15} {'windows/s':>10} {'speedup':>8}")
+    for n, step_time, windows_per_sec in results:
+        print(f"{n:>8} {1000 * step_time:>15.2f} {windows_per_sec:>10.1f} "
+              f"{windows_per_sec / base_throughput:>8.2f}")
+    return results
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--device_counts", type=int, nargs="+",
+                        default=[1, 2, 4, 8])
+    parser.add_argument("--batch_size", type=int, default=32,
+                        help="global batch size (number of windows per step)")
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--warmup_steps", type=int, default=3)
+    parser.add_argument("--input_steps", type=int, default=3)
+    parser.add_argument("--output_steps", type=int, default=4)
+    parser.add_argument("--K", type=int, default=36)
+    parser.add_argument("--fully_connected_edges", type=int, default=3)
+    parser.add_argument("--worker", action="store_true",
+                        help="run a single measurement on the devices of "
+                             "this process")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.worker:
+        run_worker(args)
+    else:
+        run_benchmark(args)
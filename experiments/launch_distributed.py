@@ -0,0 +1,81 @@
+""" Launches a multi-process training run on the local machine, with all
+    processes connecting to a coordinator on the loopback interface.
+
+    This is meant for testing the multi-process code path without a cluster;
+    on a cluster, each node sets coordinator_address, num_processes and
+    process_id in its config and calls train_and_evaluate itself.
+
+    Usage:
+        python -m experiments.launch_distributed \
+            --config experiments/configs/GNBlock_baseline.py \
+            --workdir experiments/distributed_test --num_processes 2
+"""
+import argparse
+import importlib.util
+import os
+import socket
+import subprocess
+import sys
+
+
+def load_config(config_path):
+    spec = importlib.util.spec_from_file_location("config_module", config_path)
+    config_module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(config_module)
+    return config_module.get_config()
+
+
+def get_free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def run_worker(args):
+    """ Trains as one process of the run. """
+    from utils.jraph_training import train_and_evaluate
+
+    config = load_config(args.config)
+    config.coordinator_address = args.coordinator_address
+    config.num_processes = args.num_processes
+    config.process_id = args.process_id
+    config.data_parallel = True
+    train_and_evaluate(config=config, workdir=args.workdir)
+
+
+def launch(args):
+    """ Starts num_processes workers and waits for all of them. """
+    coordinator_address = f"127.0.0.1:{get_free_port()}"
+    procs = []
+    for process_id in range(args.num_processes):
+        cmd = [sys.executable, "-m", "experiments.launch_distributed",
+               "--worker", f"--config={args.config}",
+               f"--workdir={args.workdir}",
+               f"--num_processes={args.num_processes}",
+               f"--process_id={process_id}",
+               f"--coordinator_address={coordinator_address}"]
+        procs.append(subprocess.Popen(cmd, env=dict(os.environ)))
+
+    return_codes = [proc.wait() for proc in procs]
+    if any(return_codes):
+        raise RuntimeError(f"worker return codes: {return_codes}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--config", required=True,
+                        help="path to a config file with a get_config()")
+    parser.add_argument("--workdir", required=True)
+    parser.add_argument("--num_processes", type=int, default=2)
+    parser.add_argument("--worker", action="store_true")
+    parser.add_argument("--process_id", type=int, default=0)
+    parser.add_argument("--coordinator_address", type=str, default=None)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.worker:
+        run_worker(args)
+    else:
+        launch(args)
@@ -0,0 +1,56 @@
+""" Reports the memory footprint of the dataset and of training with a config
+    (see utils/memory_profile.py), e.g. to find out why a run with a larger
+    n_samples runs out of memory.
+
+    Usage:
+        python -m experiments.profile_memory \
+            --config experiments/configs/GNBlock_baseline.py \
+            --n_samples 10000 --profile_steps 0 10 \
+            --output_dir experiments/memory_profile
+
+    The report is logged and written to output_dir/memory_report.json, next
+    to the device memory profiles of the chosen steps (view them with
+    `pprof -http=: output_dir/memory_step_0.prof`).
+"""
+import argparse
+import json
+import os
+
+from absl import logging
+
+from experiments.launch_distributed import load_config
+from utils.jraph_training import create_dataset
+from utils.memory_profile import get_memory_report, log_memory_report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--config", required=True)
+    parser.add_argument("--output_dir", required=True)
+    parser.add_argument("--n_samples", type=int, default=None,
+                        help="overrides the config's n_samples")
+    parser.add_argument("--profile_steps", type=int, nargs="*", default=[],
+                        help="train steps after which to save a device "
+                             "memory profile")
+    args = parser.parse_args()
+
+    logging.set_verbosity(logging.INFO)
+    config = load_config(args.config)
+    if args.n_samples is not None:
+        config.n_samples = args.n_samples
+
+    logging.info('Obtaining datasets.')
+    datasets = create_dataset(config)
+    report = get_memory_report(config, datasets, args.profile_steps,
+                               args.output_dir)
+    log_memory_report(report)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    report_path = os.path.join(args.output_dir, "memory_report.json")
+    with open(report_path, "w") as f:
+        json.dump(report, f, indent=2)
+    logging.info(f'Wrote memory report to {report_path}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+""" Serves forecasts from a trained model to other local jobs (see
+    utils/forecast_server.py).
+
+    Usage:
+        python -m experiments.serve_forecasts \
+            --config experiments/configs/GNBlock_baseline.py \
+            --workdir experiments/GNBlock_baseline --port 8000
+        or, on a Unix socket:
+            ... --unix_socket /tmp/lorenz_forecasts.sock
+
+    Clients can use utils.forecast_server.ForecastClient("127.0.0.1:8000")
+    (or "unix:///tmp/lorenz_forecasts.sock").
+"""
+import argparse
+
+from absl import logging
+
+from experiments.launch_distributed import load_config
+from utils.forecast_server import load_forecast_server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--config", required=True)
+    parser.add_argument("--workdir", required=True)
+    parser.add_argument("--port", type=int, default=None)
+    parser.add_argument("--unix_socket", default=None)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--max_batch_size", type=int, default=64)
+    parser.add_argument("--max_wait_ms", type=float, default=5.)
+    parser.add_argument("--max_n_steps", type=int, default=1024,
+                        help="longest horizon that a request can ask for")
+    args = parser.parse_args()
+    if args.port is None and args.unix_socket is None:
+        args.port = 8000
+
+    logging.set_verbosity(logging.INFO)
+    server = load_forecast_server(
+        load_config(args.config), args.workdir, port=args.port,
+        unix_socket=args.unix_socket, host=args.host,
+        max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms,
+        max_n_steps=args.max_n_steps)
+    logging.info(f'Serving forecasts on {args.unix_socket or server.server_address}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.batcher.close()
+
+
+if __name__ == "__main__":
+    main()
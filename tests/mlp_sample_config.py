@@ -23,6 +23,7 @@ def get_config():
     config.h=1
     config.seed=42
     config.normalize=True
+    config.fully_connected_edges=1
 
     # Optimizer.
     config.optimizer = 'adam'
@@ -44,6 +45,7 @@ def get_config():
 
     # GNN hyperparameters.
     config.model = 'MLPBlock'
+    config.activation = 'relu'
     #   config.message_passing_steps = 5
     #   config.latent_size = 256
     config.dropout_rate = 0.1
@@ -55,5 +57,6 @@ def get_config():
     config.edge_features = (4, 8) # the last feature size will be the number of features that the graph predicts
     config.node_features = (32, 2)
     config.global_features = None
+    config.max_checkpts_to_keep = 2
 
     return config
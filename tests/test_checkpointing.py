@@ -0,0 +1,82 @@
+import unittest
+import logging
+import os
+import tempfile
+from datetime import datetime
+from run_net import set_up_logging
+
+from clu import checkpoint
+import jax
+import numpy as np
+
+from utils.checkpointing import AsyncCheckpointer
+from utils.jraph_models import MLPBlock
+from utils.jraph_training import train_and_evaluate
+from tests.helpers import state_setup_helper
+from tests.mlp_sample_config import get_config
+
+
+class CheckpointingTests(unittest.TestCase):
+
+    def test_async_save(self):
+        """ test that asynchronous saves write the same checkpoints as
+            synchronous ones, in order. """
+        logging.info('\n ------------ test_async_save ------------ \n')
+        state = state_setup_helper(MLPBlock())
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            ckpt = AsyncCheckpointer(checkpoint.Checkpoint(tmp_dir))
+            state = ckpt.restore_or_initialize(state)
+            for step in range(1, 4):
+                state = state.replace(
+                    step=step,
+                    params=jax.tree_util.tree_map(lambda x: x + 1, state.params))
+                ckpt.save(state)
+            ckpt.wait()
+            self.assertEqual(ckpt.n_saves, 3)
+            self.assertEqual(os.path.basename(ckpt.latest_checkpoint), 'ckpt-4')
+
+            restored = checkpoint.Checkpoint(tmp_dir).restore(
+                state.replace(step=0))
+            self.assertEqual(int(restored.step), 3)
+            jax.tree_util.tree_map(np.testing.assert_array_equal,
+                                   restored.params, state.params)
+
+    def test_save_error(self):
+        """ test that an error in the background save is raised by the next
+            call. """
+        logging.info('\n ------------ test_save_error ------------ \n')
+        state = state_setup_helper(MLPBlock())
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # saving before restore_or_initialize fails in clu
+            ckpt = AsyncCheckpointer(checkpoint.Checkpoint(tmp_dir))
+            ckpt.ckpt.tf_checkpoint.save_counter.assign_add(1)
+            ckpt.save(state)
+            with self.assertRaises(RuntimeError):
+                ckpt.wait()
+            ckpt.wait() # the error is only raised once
+
+    def test_train_and_evaluate_async_checkpointing(self):
+        """ test that training with async checkpointing writes the final
+            checkpoint before returning. """
+        logging.info('\n ------------ test_train_and_evaluate_async_checkpointing ------------ \n')
+        mlp_config = get_config()
+        mlp_config.async_checkpointing = True
+        workdir=f"tests/outputs/train_testing_dir_{datetime.now()}"
+
+        trained_state, _, _, _ = train_and_evaluate(config=mlp_config, workdir=workdir)
+
+        ckpt = checkpoint.Checkpoint(os.path.join(workdir, 'checkpoints'))
+        restored = ckpt.restore(trained_state.replace(step=0))
+        self.assertEqual(int(restored.step), int(trained_state.step))
+        jax.tree_util.tree_map(np.testing.assert_array_equal,
+                               restored.params, trained_state.params)
+
+
+if __name__ == "__main__":
+    # set up logging for unittest outputs
+    log_path = f"tests/outputs/checkpointing_tests_{datetime.now().strftime('%y-%m-%d_%H:%M:%S')}.log"
+    set_up_logging(log_path=log_path, log_level_str="INFO")
+
+    with open(log_path, "a") as f:
+        runner = unittest.TextTestRunner(f)
+        unittest.main(testRunner=runner, verbosity=2)
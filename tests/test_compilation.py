@@ -0,0 +1,107 @@
+import unittest
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+from datetime import datetime
+from run_net import set_up_logging
+
+import jax
+import jax.numpy as jnp
+
+from utils.compilation import (setup_compilation_cache, CPU_CACHE_XLA_FLAG, 
+                               monitor_compiles, set_recompilation_limit, 
+                               get_compile_counts, RecompilationError)
+
+# compiles a small jitted function with the persistent cache turned on and
+# prints the cache stats
+CACHE_SCRIPT = """
+import sys
+import jax
+import jax.numpy as jnp
+from utils.compilation import setup_compilation_cache, get_compilation_cache_stats
+
+setup_compilation_cache(sys.argv[1])
+
+@jax.jit
+def f(x):
+    for _ in range(20):
+        x = jnp.tanh(x) @ x
+    return x
+
+f(jnp.ones((16, 16))).block_until_ready()
+stats = get_compilation_cache_stats()
+print(stats["hits"], stats["misses"])
+"""
+
+
+class CompilationTests(unittest.TestCase):
+
+    def test_no_cache_dir(self):
+        """ test that the cache is left alone if no directory is given. """
+        logging.info('\n ------------ test_no_cache_dir ------------ \n')
+        self.assertFalse(setup_compilation_cache(None))
+
+    def test_persistent_cache_hits(self):
+        """ test that a second process reuses the executables compiled by the
+            first one. """
+        logging.info('\n ------------ test_persistent_cache_hits ------------ \n')
+        env = dict(os.environ)
+        env["XLA_FLAGS"] = env.get("XLA_FLAGS", "") + " " + CPU_CACHE_XLA_FLAG
+        env["PYTHONPATH"] = os.getcwd()
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            runs = []
+            for _ in range(2):
+                out = subprocess.run(
+                    [sys.executable, "-c", CACHE_SCRIPT, cache_dir], env=env,
+                    capture_output=True, text=True, check=True)
+                hits, misses = out.stdout.split()[-2:]
+                runs.append((int(hits), int(misses)))
+
+        # the first run compiles everything, the second only reads the cache
+        self.assertEqual(runs[0][0], 0)
+        self.assertGreater(runs[0][1], 0)
+        self.assertGreater(runs[1][0], 0)
+        self.assertEqual(runs[1][1], 0)
+
+    def test_recompilation_monitor(self):
+        """ test that compiles of a monitored function are recorded with the 
+            arguments that changed, and that exceeding the limit warns, or 
+            raises in strict mode. """
+        logging.info('\n ------------ test_recompilation_monitor ------------ \n')
+        self.addCleanup(set_recompilation_limit, None)
+
+        @monitor_compiles
+        @jax.jit
+        def scale_and_shift(x, shift):
+            return 2 * x + shift
+
+        scale_and_shift(jnp.ones(3), 1.)
+        scale_and_shift(jnp.zeros(3), 2.) # same signature, no compile
+        self.assertEqual(len(scale_and_shift.compiles), 1)
+        self.assertEqual(scale_and_shift._cache_size(), 1)
+
+        set_recompilation_limit(2)
+        scale_and_shift(jnp.ones(4), 1.)
+        with self.assertLogs(level='WARNING'):
+            scale_and_shift(jnp.ones(5), 1.)
+        self.assertEqual(get_compile_counts()['scale_and_shift'], 3)
+        self.assertEqual(scale_and_shift.compiles[-1]['signature']['x'], 
+                         'float32[5]')
+
+        set_recompilation_limit(3, strict=True)
+        with self.assertRaises(RecompilationError):
+            scale_and_shift(jnp.ones(6), 1.)
+        scale_and_shift(jnp.ones(6), 1.) # already compiled 
+
+
+if __name__ == "__main__":
+    # set up logging for unittest outputs
+    log_path = f"tests/outputs/compilation_tests_{datetime.now().strftime('%y-%m-%d_%H:%M:%S')}.log"
+    set_up_logging(log_path=log_path, log_level_str="INFO")
+
+    with open(log_path, "a") as f:
+        runner = unittest.TextTestRunner(f)
+        unittest.main(testRunner=runner, verbosity=2)
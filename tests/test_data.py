@@ -1,5 +1,7 @@
 from utils.lorenz import get_window_indices, load_lorenz96_2coupled
 from utils.jraph_data import get_lorenz_graph_tuples
+from utils.data_loader import PrefetchLoader, get_epoch_order, get_subset_fraction
+from tests.helpers import get_sample_data
 from run_net import set_up_logging
 import jax.numpy as jnp
 import numpy as np
@@ -315,6 +317,69 @@ class DataTests(unittest.TestCase):
         # self.assertEqual(sample_graphtuple.n_edge[0], self.K * 5)
         self.assertEqual(sample_graphtuple.n_edge[0], self.K**2)
 
+    def test_prefetch_loader(self):
+        """ test that the prefetching loader yields every window once per 
+            epoch, in a deterministic order that changes between epochs. """
+        logging.info('\n ------------ test_prefetch_loader ------------ \n')
+        sample_dataset, _ = get_sample_data()
+        input_data = sample_dataset['test']['inputs']
+        target_data = sample_dataset['test']['targets']
+        loader = PrefetchLoader(input_data, target_data, prefetch_depth=2, 
+                                shuffle=True, seed=3)
+
+        # the order only depends on (seed, epoch)
+        np.testing.assert_array_equal(loader.epoch_order(0), 
+                                      PrefetchLoader(input_data, target_data, 
+                                                     shuffle=True, seed=3
+                                                     ).epoch_order(0))
+        self.assertEqual(sorted(loader.epoch_order(0)), 
+                         list(range(len(input_data))))
+        self.assertFalse(all(
+            np.array_equal(loader.epoch_order(0), loader.epoch_order(epoch)) 
+            for epoch in range(1, 5)))
+
+        order = loader.epoch_order(1)
+        windows = list(loader.iterate(epoch=1))
+        self.assertEqual(len(windows), len(input_data))
+        for i, (input_window, target_window) in zip(order, windows):
+            self.assertTrue(jnp.array_equal(input_window[0].nodes, 
+                                            input_data[i][0].nodes))
+            self.assertTrue(jnp.array_equal(target_window[-1].nodes, 
+                                            target_data[i][-1].nodes))
+
+        # stopping early must not leave the background thread hanging 
+        for _ in loader.iterate(epoch=2):
+            break
+
+    def test_train_subsets(self):
+        """ test that epochs can visit a growing, nested subset of the 
+            windows. """
+        logging.info('\n ------------ test_train_subsets ------------ \n')
+        n_windows = 20
+        subsets = [set(get_epoch_order(n_windows, epoch=0, seed=1, shuffle=True, 
+                                       subset_fraction=fraction))
+                   for fraction in [0.1, 0.5, 1.]]
+        self.assertEqual([len(subset) for subset in subsets], [2, 10, 20])
+        self.assertTrue(subsets[0] <= subsets[1] <= subsets[2])
+        # the shuffled order of a subset changes between epochs, not its windows
+        self.assertEqual(set(get_epoch_order(n_windows, epoch=3, seed=1, 
+                                             shuffle=True, subset_fraction=0.5)), 
+                         subsets[1])
+        np.testing.assert_array_equal(
+            get_epoch_order(n_windows, epoch=0, seed=1, shuffle=False, 
+                            subset_fraction=1.), np.arange(n_windows))
+
+        self.assertEqual(get_subset_fraction(None, 5), 1.)
+        self.assertEqual(get_subset_fraction((0.25, 0.5), 0), 0.25)
+        self.assertEqual(get_subset_fraction((0.25, 0.5), 5), 0.5)
+
+        sample_dataset, _ = get_sample_data()
+        input_data = sample_dataset['test']['inputs']
+        loader = PrefetchLoader(input_data, sample_dataset['test']['targets'])
+        windows = list(loader.iterate(epoch=0, subset_fraction=0.5))
+        self.assertEqual(len(windows), round(0.5 * len(input_data)))
+
+
 if __name__ == "__main__":
     # set up logging for unittest outputs
     log_path = f"tests/outputs/data_tests_{datetime.now().strftime('%y-%m-%d_%H:%M:%S')}.log"
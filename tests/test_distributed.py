@@ -0,0 +1,175 @@
+import unittest
+import logging
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+from datetime import datetime
+from unittest import mock
+from run_net import set_up_logging
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+
+from experiments.data_parallel_scaling import make_synthetic_windows
+from utils.distributed import (initialize_distributed, is_main_process,
+                               shard_windows, to_global, to_local)
+from tests.mlp_sample_config import get_config
+
+# trains as one process of a 2-process run on synthetic windows and prints the
+# final step and params checksum
+DISTRIBUTED_SCRIPT = """
+import os
+import sys
+import jax
+from experiments.data_parallel_scaling import make_synthetic_windows
+from tests.mlp_sample_config import get_config
+from utils.distributed import initialize_distributed
+from utils.jraph_training import train_and_evaluate_with_data
+
+config = get_config()
+config.coordinator_address = sys.argv[1]
+config.num_processes = 2
+config.process_id = int(sys.argv[2])
+config.data_parallel = True
+config.batch_size = 2
+config.epochs = 2
+initialize_distributed(config)
+
+datasets = {}
+for split, n_windows in [('train', 4), ('val', 2), ('test', 2)]:
+    inputs, targets = make_synthetic_windows(
+        n_windows, input_steps=config.input_steps,
+        output_steps=config.output_steps, K=config.K,
+        fully_connected_edges=config.fully_connected_edges, seed=0)
+    datasets[split] = {'inputs': inputs, 'targets': targets}
+
+state, _, _, _ = train_and_evaluate_with_data(
+    config=config, workdir=sys.argv[3], datasets=datasets)
+checksum = sum(float(abs(x.addressable_data(0)).sum())
+               for x in jax.tree_util.tree_leaves(state.params))
+print("RESULT", int(state.step), checksum)
+"""
+
+
+class DistributedTests(unittest.TestCase):
+
+    def test_shard_windows(self):
+        """ test that each process gets a disjoint, equally sized shard. """
+        logging.info('\n ------------ test_shard_windows ------------ \n')
+        windows = list(range(7))
+        shards = [shard_windows(windows, i, 3) for i in range(3)]
+
+        self.assertEqual(shards, [[0, 3], [1, 4], [2, 5]])
+        self.assertEqual(shard_windows(windows, 0, 1), windows)
+
+    def test_shard_training_windows(self):
+        """ test that the shards of the training windows of several 
+            processes are disjoint and equally sized, and that invalid 
+            process indices are rejected. """
+        logging.info('\n ------------ test_shard_training_windows ------------ \n')
+        inputs, _ = make_synthetic_windows(
+            9, input_steps=3, output_steps=2, K=36, fully_connected_edges=1, 
+            seed=0)
+        for process_count in [1, 2, 4]:
+            shards = [shard_windows(inputs, i, process_count) 
+                      for i in range(process_count)]
+            self.assertEqual({len(shard) for shard in shards}, 
+                             {len(inputs) // process_count})
+            shard_ids = [id(window) for shard in shards for window in shard]
+            self.assertEqual(len(set(shard_ids)), len(shard_ids))
+            self.assertTrue(set(shard_ids) <= {id(w) for w in inputs})
+
+        with self.assertRaises(AssertionError):
+            shard_windows(inputs, 2, 2)
+        with self.assertRaises(AssertionError):
+            shard_windows(inputs[:1], 0, 2)
+
+    def test_global_arrays(self):
+        """ test to_global and to_local on a single-process mesh, also 
+            through the multi-process code paths. """
+        logging.info('\n ------------ test_global_arrays ------------ \n')
+        mesh = jax.sharding.Mesh(np.array(jax.devices()), ('batch',))
+        P = jax.sharding.PartitionSpec
+        batch = {'nodes': np.arange(8.).reshape(4, 2)}
+        state = {'params': np.ones((3, 2), np.float32)}
+
+        for process_count in [1, 2]:
+            # with process_count 2, the host-local values are assembled into 
+            # global arrays with multihost_utils 
+            with mock.patch.object(jax, "process_count", 
+                                   return_value=process_count):
+                global_batch = to_global(
+                    batch, jax.sharding.NamedSharding(mesh, P('batch')))
+                global_state = to_global(
+                    state, jax.sharding.NamedSharding(mesh, P()))
+                local_state = to_local(global_state)
+
+            self.assertEqual(global_batch['nodes'].sharding.spec, P('batch'))
+            self.assertEqual(global_batch['nodes'].shape, (4, 2))
+            np.testing.assert_array_equal(global_batch['nodes'], 
+                                          batch['nodes'])
+            self.assertTrue(global_state['params'].sharding.is_fully_replicated)
+            self.assertEqual(local_state['params'].devices(), 
+                             {jax.local_devices()[0]})
+            np.testing.assert_array_equal(local_state['params'], 
+                                          state['params'])
+
+    def test_single_process(self):
+        """ test that the helpers are no-ops without a coordinator. """
+        logging.info('\n ------------ test_single_process ------------ \n')
+        self.assertFalse(initialize_distributed(get_config()))
+        self.assertTrue(is_main_process())
+
+        mesh = jax.sharding.Mesh(np.array(jax.devices()), ('batch',))
+        x = {'a': jnp.arange(4.)}
+        global_x = to_global(x, jax.sharding.NamedSharding(
+            mesh, jax.sharding.PartitionSpec('batch')))
+        self.assertTrue(jnp.array_equal(to_local(global_x)['a'], x['a']))
+
+    def test_multi_process_training(self):
+        """ test that two local processes, connected over the loopback
+            interface, train the same replicated model. """
+        logging.info('\n ------------ test_multi_process_training ------------ \n')
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            coordinator_address = f"127.0.0.1:{s.getsockname()[1]}"
+        env = dict(os.environ)
+        env["JAX_PLATFORMS"] = "cpu"
+        env["PYTHONPATH"] = os.getcwd()
+
+        with tempfile.TemporaryDirectory() as workdir:
+            procs = [subprocess.Popen(
+                [sys.executable, "-c", DISTRIBUTED_SCRIPT, coordinator_address,
+                 str(process_id), workdir],
+                env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                text=True) for process_id in range(2)]
+            outputs = [proc.communicate(timeout=600) for proc in procs]
+
+            if any("does not support multi-process" in err
+                   for _, err in outputs):
+                self.skipTest("the jax backend does not support multi-process "
+                              "computations")
+            for proc, (_, err) in zip(procs, outputs):
+                self.assertEqual(proc.returncode, 0, err)
+
+            # only process 0 writes checkpoints
+            self.assertTrue(os.path.isdir(os.path.join(workdir, 'checkpoints')))
+
+        results = [out.split("RESULT")[-1].split() for out, _ in outputs]
+        # 2 epochs of 2 steps (4 windows, 2 per process, 1 per local batch)
+        self.assertEqual([int(r[0]) for r in results], [4, 4])
+        self.assertAlmostEqual(float(results[0][1]), float(results[1][1]),
+                               places=4)
+
+
+if __name__ == "__main__":
+    # set up logging for unittest outputs
+    log_path = f"tests/outputs/distributed_tests_{datetime.now().strftime('%y-%m-%d_%H:%M:%S')}.log"
+    set_up_logging(log_path=log_path, log_level_str="INFO")
+
+    with open(log_path, "a") as f:
+        runner = unittest.TextTestRunner(f)
+        unittest.main(testRunner=runner, verbosity=2)
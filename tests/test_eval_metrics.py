@@ -0,0 +1,92 @@
+import unittest
+import logging
+from datetime import datetime
+from run_net import set_up_logging
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+
+from utils.eval_metrics import SufficientStats, SUITE_METRICS
+from utils.jraph_training import MSE, MB, ME, RMSE, CRMSE, FB, FE, R, R2, D
+
+
+class EvalMetricsTests(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        # (windows, rollout steps, K, 2)
+        self.targets = jnp.asarray(rng.normal(1., 2., (6, 3, 36, 2)),
+                                   dtype=jnp.float32)
+        self.preds = self.targets + jnp.asarray(
+            rng.normal(0.3, 0.5, self.targets.shape), dtype=jnp.float32)
+
+    def test_matches_metric_functions(self):
+        """ test that the derived metrics match the metric functions applied
+            to all values at once. """
+        logging.info('\n ------------ test_matches_metric_functions ------------ \n')
+        stats = SufficientStats.from_model_output(preds=self.preds,
+                                                  targets=self.targets)
+        suite = stats.compute()
+
+        metric_funcs = [MSE, MB, ME, RMSE, CRMSE, FB, FE, R, R2, D]
+        self.assertEqual(set(suite.keys()), set(SUITE_METRICS))
+        for metric in metric_funcs:
+            name = metric.__name__.lower()
+            expected = metric(targets=self.targets, preds=self.preds)
+            self.assertTrue(jnp.allclose(suite[name], expected, rtol=1e-4),
+                            (name, suite[name], expected))
+
+    def test_merge(self):
+        """ test that merging the statistics of single windows gives the
+            statistics of all windows, given the same target mean. """
+        logging.info('\n ------------ test_merge ------------ \n')
+        target_mean = jnp.mean(self.targets)
+        merged = None
+        for preds, targets in zip(self.preds, self.targets):
+            stats = SufficientStats.from_model_output(
+                preds=preds, targets=targets, target_mean=target_mean)
+            merged = stats if merged is None else merged.merge(stats)
+        full = SufficientStats.from_model_output(
+            preds=self.preds, targets=self.targets)
+
+        for name, value in full.compute().items():
+            self.assertTrue(jnp.allclose(merged.compute()[name], value,
+                                         rtol=1e-5), name)
+
+    def test_constant_preds(self):
+        """ test that r and r2 stay finite when the variance of the preds 
+            rounds to zero or below. """
+        logging.info('\n ------------ test_constant_preds ------------ \n')
+        preds = jnp.full(self.targets.shape, 1000.1, dtype=jnp.float32)
+        suite = SufficientStats.from_model_output(
+            preds=preds, targets=self.targets).compute()
+        for name in SUITE_METRICS:
+            self.assertTrue(jnp.isfinite(suite[name]), (name, suite[name]))
+        self.assertEqual(float(suite["r"]), 0.)
+        self.assertEqual(float(suite["r2"]), 0.)
+
+    def test_mask(self):
+        """ test that masked windows do not contribute. """
+        logging.info('\n ------------ test_mask ------------ \n')
+        mask = jnp.array([True] * 4 + [False] * 2)
+        preds = self.preds.at[4:].set(jnp.nan)
+        masked = SufficientStats.from_model_output(
+            preds=preds, targets=self.targets, mask=mask,
+            target_mean=jnp.mean(self.targets[:4]))
+        expected = SufficientStats.from_model_output(
+            preds=self.preds[:4], targets=self.targets[:4])
+
+        for field in jax.tree_util.tree_leaves(
+            jax.tree_util.tree_map(jnp.allclose, masked, expected)):
+            self.assertTrue(field)
+
+
+if __name__ == "__main__":
+    # set up logging for unittest outputs
+    log_path = f"tests/outputs/eval_metrics_tests_{datetime.now().strftime('%y-%m-%d_%H:%M:%S')}.log"
+    set_up_logging(log_path=log_path, log_level_str="INFO")
+
+    with open(log_path, "a") as f:
+        runner = unittest.TextTestRunner(f)
+        unittest.main(testRunner=runner, verbosity=2)
@@ -0,0 +1,71 @@
+import unittest
+import logging
+import os
+import tempfile
+from datetime import datetime
+from run_net import set_up_logging
+
+import jax.numpy as jnp
+import numpy as np
+
+from utils.jraph_models import MLPGraphNetwork
+from utils.jraph_training import rollout
+from utils.forecast_export import export_forecast_fn
+from utils.forecast_loader import load_forecast_fn
+from tests.helpers import get_sample_data, state_setup_helper
+
+
+class ExportTests(unittest.TestCase):
+
+    def test_export_and_load(self):
+        """ test that a loaded forecast artifact reproduces the rollout of the
+            model it was exported from. """
+        logging.info('\n ------------ test_export_and_load ------------ \n')
+        sample_dataset, data_params = get_sample_data()
+        sample_input_window = sample_dataset['test']['inputs'][0]
+
+        model = MLPGraphNetwork(n_blocks=2, share_params=False)
+        state = state_setup_helper(model)
+        norm_stats = {"X1_mean": 1.5, "X1_std": 2.,
+                      "X2_mean": -0.5, "X2_std": 0.5}
+
+        expected_preds = jnp.stack(rollout(
+            state=state,
+            input_window_graphs=sample_input_window,
+            n_rollout_steps=data_params['output_steps'],
+            rngs=None))
+        mean = np.array([norm_stats["X1_mean"], norm_stats["X2_mean"]])
+        std = np.array([norm_stats["X1_std"], norm_stats["X2_std"]])
+        expected_preds = expected_preds * std + mean
+
+        # the artifact takes raw (unnormalized) states
+        raw_window_nodes = np.stack(
+            [g.nodes for g in sample_input_window]) * std + mean
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "forecast.npz")
+            export_forecast_fn(
+                state=state,
+                sample_input_window=sample_input_window,
+                n_rollout_steps=data_params['output_steps'],
+                path=path,
+                norm_stats=norm_stats)
+            forecast_fn, metadata = load_forecast_fn(path)
+
+        self.assertEqual(metadata["n_rollout_steps"], data_params['output_steps'])
+        self.assertEqual(metadata["norm_stats"], norm_stats)
+
+        preds = forecast_fn(raw_window_nodes)
+        self.assertEqual(preds.shape,
+                         (data_params['output_steps'], data_params['K'], 2))
+        np.testing.assert_allclose(preds, expected_preds, rtol=1e-4, atol=1e-4)
+
+
+if __name__ == "__main__":
+    # set up logging for unittest outputs
+    log_path = f"tests/outputs/export_tests_{datetime.now().strftime('%y-%m-%d_%H:%M:%S')}.log"
+    set_up_logging(log_path=log_path, log_level_str="INFO")
+
+    with open(log_path, "a") as f:
+        runner = unittest.TextTestRunner(f)
+        unittest.main(testRunner=runner, verbosity=2)
@@ -0,0 +1,152 @@
+import unittest
+import logging
+import os
+import tempfile
+from datetime import datetime
+from run_net import set_up_logging
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+
+from utils.jraph_models import MLPBlock
+from utils.jraph_training import rollout, rollout_scan
+from utils.forecast import (forecast, forecast_batch, forecast_to_memmap, 
+                            ensemble_forecast, create_mc_dropout_state)
+from tests.helpers import get_sample_data, state_setup_helper
+from tests.mlp_sample_config import get_config
+
+
+class ForecastTests(unittest.TestCase):
+
+    def setUp(self):
+        sample_dataset, _ = get_sample_data()
+        self.input_windows = sample_dataset['test']['inputs']
+        self.input_window = self.input_windows[0]
+        self.state = state_setup_helper(MLPBlock())
+
+    def test_rollout_scan(self):
+        """ test that the scanned rollout matches rollout. """
+        logging.info('\n ------------ test_rollout_scan ------------ \n')
+        expected_preds = jnp.stack(rollout(
+            state=self.state, input_window_graphs=self.input_window,
+            n_rollout_steps=5, rngs=None))
+        final_window, preds = rollout_scan(
+            state=self.state, input_window_graphs=self.input_window,
+            n_rollout_steps=5)
+
+        self.assertEqual(preds.shape, expected_preds.shape)
+        self.assertTrue(jnp.allclose(preds, expected_preds, atol=1e-5))
+        # the window ends with the last predictions
+        self.assertEqual(len(final_window), len(self.input_window))
+        self.assertTrue(jnp.allclose(final_window[-1].nodes, preds[-1]))
+
+    def test_forecast_to_memmap(self):
+        """ test that a chunked forecast matches a single rollout, including
+            a partial last chunk, and computes the errors against a
+            reference. """
+        logging.info('\n ------------ test_forecast_to_memmap ------------ \n')
+        n_steps = 7
+        _, expected_preds = rollout_scan(
+            state=self.state, input_window_graphs=self.input_window,
+            n_rollout_steps=n_steps)
+        reference = np.asarray(expected_preds) + np.array([0.5, -1.])
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "forecast.npy")
+            preds, errors = forecast_to_memmap(
+                state=self.state, input_window_graphs=self.input_window,
+                n_steps=n_steps, path=path, chunk_size=3,
+                reference_nodes=reference)
+
+            saved_preds = np.load(path, mmap_mode='r')
+            self.assertEqual(saved_preds.shape, expected_preds.shape)
+            np.testing.assert_allclose(saved_preds, expected_preds, atol=1e-5)
+            del preds, saved_preds
+
+        np.testing.assert_allclose(
+            errors["bias"], np.tile([-0.5, 1.], (n_steps, 1)), atol=1e-5)
+        np.testing.assert_allclose(
+            errors["mse"], np.tile([0.25, 1.], (n_steps, 1)), atol=1e-5)
+
+    def test_forecast(self):
+        """ test that batched forecasts match the rollout of each window, 
+            and that batches in the same bucket reuse the executable. """
+        logging.info('\n ------------ test_forecast ------------ \n')
+        window_nodes = jnp.stack([jnp.stack([graph.nodes for graph in window]) 
+                                  for window in self.input_windows])
+        expected_preds = jnp.stack([jnp.stack(rollout(
+            state=self.state, input_window_graphs=window, n_rollout_steps=3, 
+            rngs=None)) for window in self.input_windows])
+
+        preds = forecast(state=self.state, states=window_nodes, n_steps=3, 
+                         template_graph=self.input_window[0], 
+                         bucket_sizes=(2, 8))
+        self.assertEqual(preds.shape, expected_preds.shape)
+        self.assertTrue(jnp.allclose(preds, expected_preds, atol=1e-5))
+
+        # batches of single states, with different sizes in the same bucket 
+        n_compiled = forecast_batch._cache_size()
+        for batch_size in [4, 3]:
+            preds = forecast(state=self.state, 
+                             states=window_nodes[:batch_size, -1], 
+                             n_steps=3, template_graph=self.input_window[0], 
+                             bucket_sizes=(2, 8))
+            self.assertEqual(preds.shape, 
+                             (batch_size,) + expected_preds.shape[1:])
+        self.assertEqual(forecast_batch._cache_size(), n_compiled + 1)
+
+        # batches larger than the largest bucket are split into chunks 
+        preds = forecast(state=self.state, states=window_nodes, n_steps=3, 
+                         template_graph=self.input_window[0], 
+                         bucket_sizes=(1, 3))
+        self.assertTrue(jnp.allclose(preds, expected_preds, atol=1e-5))
+
+    def test_ensemble_forecast(self):
+        """ test the ensemble summaries, with and without perturbations. """
+        logging.info('\n ------------ test_ensemble_forecast ------------ \n')
+        _, expected_preds = rollout_scan(
+            state=self.state, input_window_graphs=self.input_window,
+            n_rollout_steps=4)
+
+        # without perturbations, all members are the deterministic rollout
+        outputs = ensemble_forecast(
+            state=self.state, input_window_graphs=self.input_window,
+            n_steps=4, n_members=3, rng=jax.random.key(0))
+        self.assertTrue(jnp.allclose(outputs["mean"], expected_preds, atol=1e-5))
+        self.assertTrue(jnp.allclose(outputs["spread"], 0, atol=1e-5))
+
+        outputs = ensemble_forecast(
+            state=self.state, input_window_graphs=self.input_window,
+            n_steps=4, n_members=8, rng=jax.random.key(0),
+            perturbation_std=0.1, quantiles=(0.1, 0.5, 0.9),
+            return_members=True)
+        self.assertEqual(outputs["members"].shape, (8,) + expected_preds.shape)
+        self.assertEqual(outputs["quantiles"].shape, (3,) + expected_preds.shape)
+        self.assertTrue(jnp.all(outputs["spread"] > 0))
+        self.assertTrue(jnp.all(outputs["quantiles"][0] <= outputs["quantiles"][1]))
+        self.assertTrue(jnp.all(outputs["quantiles"][1] <= outputs["quantiles"][2]))
+        self.assertTrue(jnp.allclose(outputs["mean"], 
+                                     jnp.mean(outputs["members"], axis=0)))
+
+    def test_mc_dropout_ensemble(self):
+        """ test that MC dropout alone makes the members differ. """
+        logging.info('\n ------------ test_mc_dropout_ensemble ------------ \n')
+        config = get_config()
+        config.dropout_rate = 0.5
+        state = create_mc_dropout_state(config, state_setup_helper(MLPBlock()))
+
+        outputs = ensemble_forecast(
+            state=state, input_window_graphs=self.input_window,
+            n_steps=3, n_members=4, rng=jax.random.key(0), mc_dropout=True)
+        self.assertGreater(float(jnp.mean(outputs["spread"])), 0)
+
+
+if __name__ == "__main__":
+    # set up logging for unittest outputs
+    log_path = f"tests/outputs/forecast_tests_{datetime.now().strftime('%y-%m-%d_%H:%M:%S')}.log"
+    set_up_logging(log_path=log_path, log_level_str="INFO")
+
+    with open(log_path, "a") as f:
+        runner = unittest.TextTestRunner(f)
+        unittest.main(testRunner=runner, verbosity=2)
@@ -0,0 +1,154 @@
+import unittest
+import logging
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from run_net import set_up_logging
+
+import jax.numpy as jnp
+import numpy as np
+
+from utils.jraph_models import MLPBlock
+from utils.forecast import forecast, forecast_batch
+from utils.forecast_server import ForecastClient, create_forecast_server
+from tests.helpers import get_sample_data, state_setup_helper
+
+
+class ForecastServerTests(unittest.TestCase):
+
+    def setUp(self):
+        sample_dataset, _ = get_sample_data()
+        input_windows = sample_dataset['test']['inputs']
+        self.template_graph = input_windows[0][0]
+        self.states = np.stack([np.asarray(window[-1].nodes)
+                                for window in input_windows])
+        self.state = state_setup_helper(MLPBlock())
+
+    def start_server(self, **kwargs):
+        server = create_forecast_server(self.state, self.template_graph,
+                                        **kwargs)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+
+        def stop():
+            server.shutdown()
+            server.server_close()
+            server.batcher.close()
+        self.addCleanup(stop)
+        return server
+
+    def test_concurrent_requests(self):
+        """ test that concurrent requests are batched together and each gets
+            its own forecast. """
+        logging.info('\n ------------ test_concurrent_requests ------------ \n')
+        server = self.start_server(port=0, max_wait_ms=200., max_batch_size=64)
+        host, port = server.server_address[:2]
+        client = ForecastClient(f"{host}:{port}")
+        expected_preds = np.asarray(forecast(
+            state=self.state, states=jnp.asarray(self.states), n_steps=3,
+            template_graph=self.template_graph))
+
+        n_requests = len(self.states)
+        with ThreadPoolExecutor(n_requests) as executor:
+            preds = list(executor.map(
+                lambda i: client.forecast(self.states[i:i + 1], n_steps=3),
+                range(n_requests)))
+        for i, pred in enumerate(preds):
+            self.assertEqual(pred.shape, (1,) + expected_preds.shape[1:])
+            np.testing.assert_allclose(pred[0], expected_preds[i], atol=1e-5)
+
+        metrics = client.metrics()
+        self.assertEqual(metrics["requests"], n_requests)
+        self.assertLess(metrics["batches"], n_requests)
+        self.assertEqual(metrics["queue_depth"], 0)
+        self.assertGreater(metrics["latency_ms_p50"], 0)
+
+    def test_normalization(self):
+        """ test that raw states are normalized before the rollout and the
+            predictions are denormalized, with the norm stats of the
+            training data. """
+        logging.info('\n ------------ test_normalization ------------ \n')
+        norm_stats = {"X1_mean": 2., "X1_std": 3., "X2_mean": -1.,
+                      "X2_std": 0.5}
+        mean = np.array([norm_stats["X1_mean"], norm_stats["X2_mean"]])
+        std = np.array([norm_stats["X1_std"], norm_stats["X2_std"]])
+        server = self.start_server(port=0, max_wait_ms=1.,
+                                   norm_stats=norm_stats)
+        host, port = server.server_address[:2]
+        client = ForecastClient(f"{host}:{port}")
+
+        # self.states are normalized, as the model was trained on 
+        raw_states = self.states * std + mean
+        preds = client.forecast(raw_states, n_steps=3)
+        expected_preds = np.asarray(forecast(
+            state=self.state, states=jnp.asarray(self.states), n_steps=3,
+            template_graph=self.template_graph)) * std + mean
+        np.testing.assert_allclose(preds, expected_preds, rtol=1e-5,
+                                   atol=1e-5)
+
+    def test_horizon_buckets(self):
+        """ test that horizons are rounded up to a few buckets and cut back, 
+            and that horizons above max_n_steps are rejected. """
+        logging.info('\n ------------ test_horizon_buckets ------------ \n')
+        server = self.start_server(port=0, max_wait_ms=1., max_n_steps=6,
+                                   horizon_buckets=(2, 8))
+        host, port = server.server_address[:2]
+        client = ForecastClient(f"{host}:{port}")
+        expected_preds = np.asarray(forecast(
+            state=self.state, states=jnp.asarray(self.states[:2]), n_steps=8,
+            template_graph=self.template_graph))
+
+        n_cached = forecast_batch._cache_size()
+        for n_steps in [3, 5, 6]:
+            preds = client.forecast(self.states[:2], n_steps=n_steps)
+            np.testing.assert_allclose(preds, expected_preds[:, :n_steps], 
+                                       atol=1e-5)
+        # all three horizons run the 8 step rollout, which is already compiled
+        self.assertEqual(forecast_batch._cache_size(), n_cached)
+
+        with self.assertRaisesRegex(RuntimeError, '400'):
+            client.forecast(self.states[:2], n_steps=7)
+        with self.assertRaisesRegex(RuntimeError, '400'):
+            client.forecast(self.states[:2], n_steps=0)
+
+    def test_client_address(self):
+        """ test that client addresses are parsed as TCP or Unix socket 
+            addresses, and that invalid addresses are rejected. """
+        logging.info('\n ------------ test_client_address ------------ \n')
+        client = ForecastClient("http://localhost:8000/")
+        self.assertEqual((client.host, client.port), ("localhost", 8000))
+        self.assertIsNone(client.unix_socket)
+        client = ForecastClient("unix://forecasts.sock")
+        self.assertEqual(client.unix_socket, "forecasts.sock")
+        for address in ["forecasts.sock", "/tmp/forecasts.sock", "unix://"]:
+            with self.assertRaises(ValueError):
+                ForecastClient(address)
+
+    def test_unix_socket(self):
+        """ test requests over a unix socket, with different horizons, and
+            that invalid requests get an error. """
+        logging.info('\n ------------ test_unix_socket ------------ \n')
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "forecasts.sock")
+            self.start_server(unix_socket=path, max_wait_ms=1.)
+            client = ForecastClient(f"unix://{path}")
+
+            for n_steps in [2, 4]:
+                preds = client.forecast(self.states[:2], n_steps=n_steps)
+                self.assertEqual(preds.shape,
+                                 (2, n_steps) + self.states.shape[1:])
+
+            with self.assertRaises(RuntimeError):
+                client.forecast(self.states[0, 0], n_steps=2)
+
+
+if __name__ == "__main__":
+    # set up logging for unittest outputs
+    log_path = f"tests/outputs/forecast_server_tests_{datetime.now().strftime('%y-%m-%d_%H:%M:%S')}.log"
+    set_up_logging(log_path=log_path, log_level_str="INFO")
+
+    with open(log_path, "a") as f:
+        runner = unittest.TextTestRunner(f)
+        unittest.main(testRunner=runner, verbosity=2)
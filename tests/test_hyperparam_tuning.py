@@ -0,0 +1,169 @@
+import unittest
+import logging
+import os
+import tempfile
+from datetime import datetime
+from run_net import set_up_logging
+
+import numpy as np
+import optuna
+
+from utils.hyperparam_tuning import (create_pruner, get_train_subset_fractions, 
+                                     get_worker_cores, run_parallel_study, 
+                                     run_population_trials, suggest_config)
+from utils.shared_dataset import SharedDataset
+from tests.helpers import get_sample_data
+
+
+def dataset_objective(trial, datasets):
+    """ Objective that reads the shared dataset, for the parallel study. """
+    x = trial.suggest_float('x', -1, 1)
+    train_nodes = np.stack([window[0].nodes 
+                            for window in datasets['train']['inputs']])
+    trial.set_user_attr('pid', os.getpid())
+    trial.set_user_attr('train_nodes_sum', float(train_nodes.sum()))
+    return (x - 0.5) ** 2
+
+
+def small_config(trial):
+    """ Trial config for the sample dataset, with a short training. """
+    config = suggest_config(trial)
+    config.output_steps = 2
+    config.epochs = 2
+    config.eval_every_epochs = 1
+    return config
+
+
+class HyperparamTuningTests(unittest.TestCase):
+
+    def setUp(self):
+        self.datasets, _ = get_sample_data()
+
+    def test_shared_dataset(self):
+        """ test that the datasets read back from shared memory are the same. 
+        """
+        logging.info('\n ------------ test_shared_dataset ------------ \n')
+        shared = SharedDataset.create(self.datasets)
+        try:
+            attached = SharedDataset.attach(shared.spec)
+            shared_datasets = attached.get_datasets()
+            for split, split_data in self.datasets.items():
+                for key, windows in split_data.items():
+                    self.assertEqual(len(shared_datasets[split][key]), 
+                                     len(windows))
+                    for window, shared_window in zip(
+                        windows, shared_datasets[split][key]):
+                        for graph, shared_graph in zip(window, shared_window):
+                            for field, value in graph._asdict().items():
+                                np.testing.assert_array_equal(
+                                    getattr(shared_graph, field), value)
+            # the views are read-only
+            with self.assertRaises(ValueError):
+                shared_datasets['train']['inputs'][0][0].nodes[0, 0] = 1.
+            del shared_datasets, shared_window, shared_graph
+            attached.close()
+        finally:
+            shared.unlink()
+
+    def test_worker_cores(self):
+        """ test that the cores are split into groups for the workers. """
+        logging.info('\n ------------ test_worker_cores ------------ \n')
+        self.assertEqual(get_worker_cores(2, cores=[0, 1, 2, 3, 4]), 
+                         [[0, 1, 2], [3, 4]])
+        self.assertEqual(get_worker_cores(3, cores=[0, 1]), [[0], [1], [0]])
+
+    def test_run_parallel_study(self):
+        """ test that the workers run all trials of one study, on the shared 
+            dataset. """
+        logging.info('\n ------------ test_run_parallel_study ------------ \n')
+        expected_sum = float(np.stack([
+            window[0].nodes for window in self.datasets['train']['inputs']
+            ]).sum())
+        with tempfile.TemporaryDirectory() as study_dir:
+            study = run_parallel_study(
+                'test_study', n_trials=5, n_workers=2, datasets=self.datasets, 
+                objective_fn=dataset_objective, study_dir=study_dir)
+
+            trials = study.get_trials()
+            self.assertEqual(len(trials), 5)
+            self.assertTrue(all(t.state == optuna.trial.TrialState.COMPLETE 
+                                for t in trials))
+            self.assertEqual(len({t.user_attrs['pid'] for t in trials}), 2)
+            for t in trials:
+                self.assertAlmostEqual(t.user_attrs['train_nodes_sum'], 
+                                       expected_sum, places=3)
+
+    def test_run_population_trials(self):
+        """ test that a population of trials shares the architecture of its 
+            first trial and each trial gets its own val loss. """
+        logging.info('\n ------------ test_run_population_trials ------------ \n')
+        study = optuna.create_study(direction='minimize')
+        study.enqueue_trial({"n_blocks": 1, "edge_mlp_1_power": 1, 
+                             "edge_mlp_2_power": 1, "node_mlp_1_power": 2})
+        run_population_trials(study, self.datasets, population_size=3, 
+                              config_fn=small_config)
+
+        trials = study.get_trials()
+        self.assertEqual(len(trials), 3)
+        self.assertTrue(all(t.state == optuna.trial.TrialState.COMPLETE 
+                            for t in trials))
+        self.assertEqual({t.params['n_blocks'] for t in trials}, {1})
+        self.assertEqual(len({t.params['learning_rate'] for t in trials}), 3)
+        self.assertEqual(len({t.value for t in trials}), 3)
+        self.assertTrue(all(len(t.intermediate_values) == 2 for t in trials))
+
+    def test_run_population_trials_shared_storage(self):
+        """ test that a member that was enqueued by another worker, with 
+            another architecture, is discarded and asked again. """
+        logging.info('\n ------------ test_run_population_trials_shared_storage ------------ \n')
+        study = optuna.create_study(direction='minimize')
+        study.enqueue_trial({"n_blocks": 1, "edge_mlp_1_power": 1, 
+                             "edge_mlp_2_power": 1, "node_mlp_1_power": 2})
+
+        def concurrent_config(trial):
+            # another worker enqueues a member of its own population while 
+            # the first trial is created 
+            if trial.number == 0:
+                study.enqueue_trial({"n_blocks": 2, "edge_mlp_1_power": 1, 
+                                     "edge_mlp_2_power": 1, 
+                                     "node_mlp_1_power": 1})
+            return small_config(trial)
+
+        run_population_trials(study, self.datasets, population_size=2, 
+                              config_fn=concurrent_config)
+
+        trials = study.get_trials()
+        discarded = [t for t in trials 
+                     if t.user_attrs.get("population_mismatch")]
+        self.assertEqual(len(discarded), 1)
+        self.assertEqual(discarded[0].state, optuna.trial.TrialState.FAIL)
+        self.assertEqual(discarded[0].params['n_blocks'], 2)
+        completed = [t for t in trials 
+                     if t.state == optuna.trial.TrialState.COMPLETE]
+        self.assertEqual(len(completed), 2)
+        self.assertEqual({t.params['n_blocks'] for t in completed}, {1})
+
+    def test_multi_fidelity_settings(self):
+        """ test the pruners and the training subset schedule of 
+            multi-fidelity tuning. """
+        logging.info('\n ------------ test_multi_fidelity_settings ------------ \n')
+        self.assertIsInstance(create_pruner("hyperband"), 
+                              optuna.pruners.HyperbandPruner)
+        self.assertIsInstance(create_pruner("successive_halving"), 
+                              optuna.pruners.SuccessiveHalvingPruner)
+        self.assertIsInstance(create_pruner(), optuna.pruners.MedianPruner)
+        with self.assertRaises(ValueError):
+            create_pruner("unknown")
+
+        np.testing.assert_allclose(get_train_subset_fractions(4), 
+                                   [1/9, 1/3, 1, 1])
+
+
+if __name__ == "__main__":
+    # set up logging for unittest outputs
+    log_path = f"tests/outputs/hyperparam_tuning_tests_{datetime.now().strftime('%y-%m-%d_%H:%M:%S')}.log"
+    set_up_logging(log_path=log_path, log_level_str="INFO")
+
+    with open(log_path, "a") as f:
+        runner = unittest.TextTestRunner(f)
+        unittest.main(testRunner=runner, verbosity=2)
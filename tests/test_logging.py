@@ -0,0 +1,74 @@
+import unittest
+import logging
+import tempfile
+from datetime import datetime
+from run_net import set_up_logging
+
+import jax.numpy as jnp
+import numpy as np
+
+from utils.logging import (PerformanceLogWriter, connect_performance_log,
+                           get_performance_for_epoch, load_training_performance,
+                           log_training_performance, read_training_performance)
+
+
+class PerformanceLogTests(unittest.TestCase):
+
+    def test_buffered_writer(self):
+        """ test that records are only written to the log once flush_every
+            records are buffered. """
+        logging.info('\n ------------ test_buffered_writer ------------ \n')
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            log_path = f"{tmp_dir}/performance.sqlite"
+            writer = PerformanceLogWriter(log_path, flush_every=3,
+                                          flush_secs=3600.)
+
+            def n_written():
+                with connect_performance_log(log_path) as connection:
+                    return connection.execute(
+                        "SELECT COUNT(*) FROM performance").fetchone()[0]
+
+            writer.write(0, "train", 1.)
+            writer.write(0, "val", 2.)
+            self.assertEqual(n_written(), 0)
+            writer.write(1, "train", 3.)
+            self.assertEqual(n_written(), 3)
+            writer.write(1, "val", 4.)
+            writer.flush()
+            self.assertEqual(n_written(), 4)
+
+    def test_training_performance(self):
+        """ test logging the performance of a run and reading it back, in
+            full and by epoch. """
+        logging.info('\n ------------ test_training_performance ------------ \n')
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cfg = {"OUTPUT_DIR": f"{tmp_dir}/output"}
+            for epoch in range(10):
+                log_training_performance(cfg, epoch, "train",
+                                         jnp.float32(epoch))
+                log_training_performance(cfg, epoch, "val", 2. * epoch)
+
+            losses_dict = load_training_performance(cfg)
+            self.assertEqual(losses_dict["train"], list(range(10)))
+            self.assertEqual(losses_dict["val"], [2. * e for e in range(10)])
+            self.assertEqual(get_performance_for_epoch(cfg, "val", 7), 14.)
+            epochs, losses = read_training_performance(cfg, "train", 3, 6)
+            np.testing.assert_array_equal(epochs, [3, 4, 5])
+            np.testing.assert_array_equal(losses, [3., 4., 5.])
+            with self.assertRaises(AssertionError):
+                get_performance_for_epoch(cfg, "val", 10)
+
+            # a new run replaces the log
+            log_training_performance(cfg, 0, "train", 5.)
+            self.assertEqual(load_training_performance(cfg),
+                             {"train": [5.], "val": []})
+
+
+if __name__ == "__main__":
+    # set up logging for unittest outputs
+    log_path = f"tests/outputs/logging_tests_{datetime.now().strftime('%y-%m-%d_%H:%M:%S')}.log"
+    set_up_logging(log_path=log_path, log_level_str="INFO")
+
+    with open(log_path, "a") as f:
+        runner = unittest.TextTestRunner(f)
+        unittest.main(testRunner=runner, verbosity=2)
@@ -0,0 +1,73 @@
+import unittest
+import logging
+import os
+import tempfile
+from datetime import datetime
+from run_net import set_up_logging
+
+import jax
+import numpy as np
+
+from utils.memory_profile import (get_memory_report, get_object_memory,
+                                  log_memory_report)
+from tests.helpers import get_sample_data
+from tests.mlp_sample_config import get_config
+
+
+class MemoryProfileTests(unittest.TestCase):
+
+    def test_object_memory(self):
+        """ test that host arrays, device arrays and python objects are
+            counted separately, and shared objects only once. """
+        logging.info('\n ------------ test_object_memory ------------ \n')
+        host_array = np.zeros((10, 4), np.float32)
+        device_array = jax.numpy.ones(5, jax.numpy.float32)
+        memory = get_object_memory(
+            [(host_array, device_array), (host_array, None)])
+        self.assertEqual(memory["host_arrays"], 1)
+        self.assertEqual(memory["host_array_bytes"], 160)
+        self.assertEqual(memory["device_arrays"], 1)
+        self.assertEqual(memory["device_array_bytes"], 20)
+        # the list, two tuples and the numpy array header
+        self.assertEqual(memory["python_objects"], 4)
+        self.assertGreater(memory["python_object_bytes"], 0)
+        self.assertLess(memory["python_object_bytes"], 1000)
+
+    def test_memory_report(self):
+        """ test the report of a sample dataset and model, with device memory
+            profiles. """
+        logging.info('\n ------------ test_memory_report ------------ \n')
+        datasets, _ = get_sample_data()
+        config = get_config()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            report = get_memory_report(config, datasets, profile_steps=[0, 2],
+                                       profile_dir=tmp_dir)
+            log_memory_report(report)
+            self.assertEqual(len(report["profiles"]), 2)
+            for path in report["profiles"]:
+                self.assertGreater(os.path.getsize(path), 0)
+
+        dataset_memory = report["dataset"]
+        self.assertEqual(set(dataset_memory),
+                         {"train", "val", "test", "total"})
+        self.assertEqual(
+            dataset_memory["total"]["host_array_bytes"]
+            + dataset_memory["total"]["device_array_bytes"],
+            sum(dataset_memory[split]["host_array_bytes"]
+                + dataset_memory[split]["device_array_bytes"]
+                for split in ["train", "val", "test"]))
+        self.assertGreater(report["train_state"]["n_params"], 0)
+        # adam keeps two moments per param
+        self.assertGreaterEqual(report["train_state"]["opt_state_bytes"],
+                                2 * report["train_state"]["params_bytes"])
+        self.assertIn("temp_size_in_bytes", report["train_step"])
+
+
+if __name__ == "__main__":
+    # set up logging for unittest outputs
+    log_path = f"tests/outputs/memory_profile_tests_{datetime.now().strftime('%y-%m-%d_%H:%M:%S')}.log"
+    set_up_logging(log_path=log_path, log_level_str="INFO")
+
+    with open(log_path, "a") as f:
+        runner = unittest.TextTestRunner(f)
+        unittest.main(testRunner=runner, verbosity=2)
@@ -0,0 +1,94 @@
+import unittest
+import logging
+from datetime import datetime
+from run_net import set_up_logging
+
+from flax.training import train_state
+import jax
+import jax.numpy as jnp
+import numpy as np
+import optax
+
+from utils.jraph_training import create_model, train_step
+from utils.population_training import (create_population_state, 
+                                       train_population, 
+                                       train_population_step)
+from tests.helpers import get_sample_data
+from tests.mlp_sample_config import get_config
+
+
+class PopulationTrainingTests(unittest.TestCase):
+
+    def setUp(self):
+        self.datasets, _ = get_sample_data()
+        self.config = get_config()
+        self.config.dropout_rate = 0.
+        self.input_window = self.datasets['train']['inputs'][0]
+        self.target_window = self.datasets['train']['targets'][0]
+
+    def test_population_matches_serial(self):
+        """ test that each member of a population trains like a separate 
+            model with its own learning rate, with a single compiled step. """
+        logging.info('\n ------------ test_population_matches_serial ------------ \n')
+        learning_rates = [1e-3, 1e-2, 3e-2]
+        n_steps = 3
+        pop_state = create_population_state(
+            self.config, self.input_window, {"learning_rate": learning_rates})
+        net = create_model(self.config, deterministic=False)
+        init_params = jax.tree_util.tree_map(lambda x: x[0], pop_state.params)
+
+        rngs = jax.random.split(jax.random.key(1), n_steps)
+        n_compiled = train_population_step._cache_size()
+        for step in range(n_steps):
+            pop_state, metrics, _ = train_population_step(
+                state=pop_state, n_rollout_steps=self.config.output_steps, 
+                input_window_graphs=self.input_window, 
+                target_window_graphs=self.target_window, 
+                rngs={'dropout': jax.random.split(rngs[step], 3)}, 
+                dropout_rates=jnp.zeros(3), net=net)
+        self.assertEqual(train_population_step._cache_size(), n_compiled + 1)
+        self.assertEqual(metrics.loss.total.shape, (3,))
+
+        for i, learning_rate in enumerate(learning_rates):
+            state = train_state.TrainState.create(
+                apply_fn=net.apply, params=init_params, 
+                tx=optax.adam(learning_rate))
+            for step in range(n_steps):
+                state, _, _ = train_step(
+                    state=state, n_rollout_steps=self.config.output_steps, 
+                    input_window_graphs=self.input_window, 
+                    target_window_graphs=self.target_window, 
+                    rngs={'dropout': jax.random.split(rngs[step], 3)[i]})
+            for leaf, pop_leaf in zip(
+                jax.tree_util.tree_leaves(state.params), 
+                jax.tree_util.tree_leaves(pop_state.params)):
+                np.testing.assert_allclose(leaf, pop_leaf[i], rtol=1e-4, 
+                                           atol=1e-6)
+
+    def test_train_population(self):
+        """ test that the members are evaluated separately, and that their 
+            dropout rates are applied. """
+        logging.info('\n ------------ test_train_population ------------ \n')
+        self.config.epochs = 2
+        reports = []
+        state, val_losses = train_population(
+            self.config, self.datasets, 
+            {"learning_rate": [1e-3, 1e-3], "dropout_rate": [0., 0.5]}, 
+            report_fn=lambda epoch, losses: reports.append((epoch, losses)))
+
+        self.assertEqual(val_losses.shape, (2,))
+        self.assertTrue(np.all(np.isfinite(val_losses)))
+        self.assertEqual([epoch for epoch, _ in reports], [0, 1])
+        # same learning rate, but different dropout, so the params differ 
+        leaf = jax.tree_util.tree_leaves(state.params)[0]
+        self.assertFalse(np.allclose(leaf[0], leaf[1]))
+
+
+if __name__ == "__main__":
+    # set up logging for unittest outputs
+    log_path = f"tests/outputs/population_training_tests_{datetime.now().strftime('%y-%m-%d_%H:%M:%S')}.log"
+    set_up_logging(log_path=log_path, log_level_str="INFO")
+
+    with open(log_path, "a") as f:
+        runner = unittest.TextTestRunner(f)
+        unittest.main(testRunner=runner, verbosity=2)
@@ -0,0 +1,94 @@
+import unittest
+import logging
+import time
+from datetime import datetime
+from run_net import set_up_logging
+
+from clu import metric_writers
+import jax
+import jax.numpy as jnp
+
+from utils.jraph_training import train_and_evaluate
+from utils.timing import TrainingTimer
+from tests.mlp_sample_config import get_config
+
+
+class RecordingWriter(metric_writers.MetricWriter):
+    """ Metric writer that keeps the scalars written to it. """
+
+    def __init__(self):
+        self.scalars = {}
+
+    def write_scalars(self, step, scalars):
+        self.scalars.update(scalars)
+
+    def write_summaries(self, step, values, metadata=None): pass
+    def write_images(self, step, images): pass
+    def write_videos(self, step, videos): pass
+    def write_audios(self, step, audios, *, sample_rate): pass
+    def write_texts(self, step, texts): pass
+    def write_histograms(self, step, arrays, num_buckets=None): pass
+    def write_hparams(self, hparams): pass
+    def flush(self): pass
+    def close(self): pass
+
+
+class TimingTests(unittest.TestCase):
+
+    def test_timer(self):
+        """ test that the timer records phases, data fetches and compilations,
+            and writes their percentiles. """
+        logging.info('\n ------------ test_timer ------------ \n')
+        timer = TrainingTimer()
+        for _ in range(5):
+            with timer.timed('step'):
+                time.sleep(0.01)
+            timer.count_steps()
+        self.assertEqual(list(timer.timed_iter('fetch', range(3))), [0, 1, 2])
+        jax.jit(lambda x: x * 3 + 1)(jnp.ones(7)).block_until_ready()
+
+        writer = RecordingWriter()
+        timer.write(writer, step=0)
+        timer.close()
+        self.assertGreaterEqual(writer.scalars['timing/step_ms_p50'], 10.)
+        self.assertLessEqual(writer.scalars['timing/step_ms_p50'],
+                             writer.scalars['timing/step_ms_p99'])
+        self.assertIn('timing/fetch_ms_p95', writer.scalars)
+        self.assertIn('timing/compile_backend_ms_p50', writer.scalars)
+        self.assertGreater(writer.scalars['timing/steps_per_sec'], 0)
+
+    def test_disabled_timer(self):
+        """ test that a disabled timer records nothing. """
+        logging.info('\n ------------ test_disabled_timer ------------ \n')
+        timer = TrainingTimer(enabled=False)
+        with timer.timed('step'):
+            pass
+        self.assertEqual(list(timer.timed_iter('fetch', range(3))), [0, 1, 2])
+        writer = RecordingWriter()
+        timer.write(writer, step=0)
+        self.assertEqual(writer.scalars, {})
+        self.assertEqual(len(timer.durations), 0)
+
+    def test_train_and_evaluate_timing(self):
+        """ test that train_and_evaluate() runs with timing turned on. """
+        logging.info('\n ------------ test_train_and_evaluate_timing ------------ \n')
+        mlp_config = get_config()
+        mlp_config.timing = True
+        mlp_config.timing_sync_every_steps = 1
+        workdir=f"tests/outputs/train_testing_dir_{datetime.now()}"
+
+        trained_state, _, _, _ = train_and_evaluate(config=mlp_config, workdir=workdir)
+        num_train_steps = int(
+            mlp_config.epochs * mlp_config.n_samples * mlp_config.train_pct
+            )
+        self.assertEqual(trained_state.step, num_train_steps)
+
+
+if __name__ == "__main__":
+    # set up logging for unittest outputs
+    log_path = f"tests/outputs/timing_tests_{datetime.now().strftime('%y-%m-%d_%H:%M:%S')}.log"
+    set_up_logging(log_path=log_path, log_level_str="INFO")
+
+    with open(log_path, "a") as f:
+        runner = unittest.TextTestRunner(f)
+        unittest.main(testRunner=runner, verbosity=2)
@@ -5,16 +5,69 @@ import numpy as np
 import unittest
 import logging
 import os
+import subprocess
+import sys
 from datetime import datetime
 import pdb
 
+import jax
 import jax.random
+from clu import checkpoint
+import tensorflow as tf
 
 from utils.jraph_models import MLPBlock, MLPGraphNetwork
-from utils.jraph_training import train_step, rollout_loss, evaluate_step, evaluate_model, train_and_evaluate
+from utils.jraph_training import train_step, train_step_batch, train_epoch, rollout, rollout_loss, evaluate_step, evaluate_step_metric_suite, evaluate_model, train_and_evaluate
+from utils.eval_metrics import SUITE_METRICS
+from utils.jraph_data import stack_windows
 from tests.helpers import get_sample_data, state_setup_helper
 from tests.mlp_sample_config import get_config
 
+# runs one data-parallel step on 4 host devices and compares it to the same 
+# step on a single device
+DATA_PARALLEL_SCRIPT = """
+import jax
+import jax.numpy as jnp
+from flax.training import train_state
+import optax
+from experiments.data_parallel_scaling import make_synthetic_windows
+from utils.jraph_data import stack_windows
+from utils.jraph_models import MLPBlock
+from utils.jraph_training import create_data_parallel_mesh, train_step_batch
+
+assert jax.device_count() == 4, jax.device_count()
+inputs, targets = make_synthetic_windows(8, input_steps=3, output_steps=2, K=36,
+                                         fully_connected_edges=1, seed=0)
+batch = (stack_windows(inputs), stack_windows(targets))
+model = MLPBlock(deterministic=True)
+params = model.init(jax.random.key(0), inputs[0])
+state = train_state.TrainState.create(apply_fn=model.apply, params=params, 
+                                      tx=optax.adam(1e-3))
+
+def step(state, batch):
+    return train_step_batch(state=state, n_rollout_steps=2, 
+                            input_window_graphs=batch[0], 
+                            target_window_graphs=batch[1], 
+                            rngs={'dropout': jax.random.key(1)})
+
+single_state, single_metrics, _ = step(state, batch)
+
+mesh = create_data_parallel_mesh()
+P = jax.sharding.PartitionSpec
+dp_state, dp_metrics, _ = step(
+    jax.device_put(state, jax.sharding.NamedSharding(mesh, P())), 
+    jax.device_put(batch, jax.sharding.NamedSharding(mesh, P('batch'))))
+
+for single_leaf, dp_leaf in zip(jax.tree_util.tree_leaves(single_state.params), 
+                                jax.tree_util.tree_leaves(dp_state.params)):
+    assert dp_leaf.sharding.is_fully_replicated
+    assert len(dp_leaf.sharding.device_set) == 4
+    assert jnp.allclose(single_leaf, dp_leaf, atol=1e-5)
+assert jnp.allclose(single_metrics.compute()['loss'], 
+                    dp_metrics.compute()['loss'], atol=1e-5)
+print("OK")
+"""
+
+
 class TrainingTests(unittest.TestCase):
 
     # def setUp(self):
@@ -60,6 +113,49 @@ class TrainingTests(unittest.TestCase):
         self.assertEqual(pred_nodes[0].shape, (data_params['K'], 2), f"pred_nodes shape is {pred_nodes[0].shape}")
 
 
+    def test_bfloat16_rollout(self):
+        """ test that a bfloat16 compute rollout stays close to the float32 
+            rollout when using the same float32 params. """
+        logging.info('\n ------------ test_bfloat16_rollout ------------ \n')
+        sample_dataset, data_params = get_sample_data()
+
+        sample_input_window = sample_dataset['train']['inputs'][0]
+        sample_target_window = sample_dataset['train']['targets'][0]
+
+        fp32_model = MLPGraphNetwork(n_blocks=2, share_params=False, 
+                                     node_features=(512, 2))
+        bf16_model = MLPGraphNetwork(n_blocks=2, share_params=False, 
+                                     node_features=(512, 2),
+                                     dtype=jnp.bfloat16, 
+                                     param_dtype=jnp.float32)
+        fp32_state = state_setup_helper(fp32_model)
+        # the params only depend on param_dtype, so they can be shared 
+        bf16_state = fp32_state.replace(apply_fn=bf16_model.apply)
+
+        fp32_preds = rollout(state=fp32_state, 
+                             input_window_graphs=sample_input_window, 
+                             n_rollout_steps=data_params['output_steps'], 
+                             rngs=None)
+        bf16_preds = rollout(state=bf16_state, 
+                             input_window_graphs=sample_input_window, 
+                             n_rollout_steps=data_params['output_steps'], 
+                             rngs=None)
+
+        # outputs are cast back to the dtype of the data 
+        self.assertEqual(bf16_preds[0].dtype, jnp.float32)
+
+        # compare the rollout error of both precisions against the targets 
+        targets = jnp.stack([g.nodes for g in sample_target_window])
+        fp32_mse = jnp.mean(jnp.square(jnp.stack(fp32_preds) - targets))
+        bf16_mse = jnp.mean(jnp.square(jnp.stack(bf16_preds) - targets))
+        logging.info(f'rollout mse: fp32 {fp32_mse}, bf16 {bf16_mse}')
+        self.assertLess(abs(float(bf16_mse - fp32_mse)), 0.05 * float(fp32_mse))
+
+        # and the predictions themselves
+        max_diff = jnp.max(jnp.abs(jnp.stack(bf16_preds) - jnp.stack(fp32_preds)))
+        self.assertLess(float(max_diff), 0.05 * float(jnp.max(jnp.abs(targets))))
+
+
     def test_train_step(self):
         """ test that the train_step() function works. """
         logging.info('\n ------------ test_train_step ------------ \n')
@@ -174,6 +270,61 @@ class TrainingTests(unittest.TestCase):
                 init_state.params['params']['MLP_1']['Dense_0']['kernel'],
                 new_state.params['params']['MLP_1']['Dense_0']['kernel']))
 
+    def test_train_epoch(self):
+        """ test that train_epoch() matches a loop of train_step() calls, and 
+            that it skips steps with a nan loss. """
+        logging.info('\n ------------ test_train_epoch ------------ \n')
+        sample_dataset, data_params = get_sample_data()
+        input_windows = sample_dataset['test']['inputs']
+        target_windows = sample_dataset['test']['targets']
+
+        # no dropout, so that the rngs do not matter 
+        model = MLPBlock(deterministic=True)
+        init_state = state_setup_helper(model=model)
+
+        loop_state = init_state
+        for input_window_graphs, target_window_graphs in zip(
+            input_windows, target_windows):
+            loop_state, _, _ = train_step(
+                state=loop_state,
+                n_rollout_steps=data_params['output_steps'],
+                input_window_graphs=input_window_graphs,
+                target_window_graphs=target_window_graphs,
+                rngs={'dropout': jax.random.key(0)})
+
+        scan_state, epoch_metrics, nan_step = train_epoch(
+            state=init_state,
+            n_rollout_steps=data_params['output_steps'],
+            input_windows=stack_windows(input_windows),
+            target_windows=stack_windows(target_windows),
+            rng=jax.random.key(0))
+
+        self.assertEqual(int(scan_state.step), len(input_windows))
+        self.assertEqual(int(epoch_metrics.loss.count), len(input_windows))
+        self.assertEqual(int(nan_step), -1)
+        for loop_leaf, scan_leaf in zip(
+            jax.tree_util.tree_leaves(loop_state.params), 
+            jax.tree_util.tree_leaves(scan_state.params)):
+            self.assertTrue(jnp.allclose(loop_leaf, scan_leaf, atol=1e-5))
+
+        # corrupt the second window; its update should be skipped 
+        bad_input_windows = list(input_windows)
+        bad_input_windows[1] = [g._replace(nodes=g.nodes * jnp.nan) 
+                                for g in input_windows[1]]
+        bad_state, bad_metrics, nan_step = train_epoch(
+            state=init_state,
+            n_rollout_steps=data_params['output_steps'],
+            input_windows=stack_windows(bad_input_windows),
+            target_windows=stack_windows(target_windows),
+            rng=jax.random.key(0))
+
+        self.assertEqual(int(nan_step), 1)
+        self.assertEqual(int(bad_state.step), len(input_windows))
+        self.assertEqual(int(bad_metrics.loss.count), len(input_windows) - 1)
+        self.assertTrue(jnp.isfinite(bad_metrics.loss.compute()))
+        for leaf in jax.tree_util.tree_leaves(bad_state.params):
+            self.assertTrue(jnp.all(jnp.isfinite(leaf)))
+
     def test_evaluate_step(self):
         """ test that the evaluate_step() function works. """
         logging.info('\n ------------ test_evaluate_step ------------ \n')
@@ -249,6 +400,100 @@ class TrainingTests(unittest.TestCase):
         self.assertGreater(float(eval_metrics_dict['val'].loss.total), 0)
         self.assertGreater(float(eval_metrics_dict['test'].loss.total), 0)
 
+    def test_evaluate_model_batched(self):
+        """ test that evaluating in (padded) batches gives the same metrics as 
+            evaluating window by window. """
+        logging.info('\n ------------ test_evaluate_model_batched ------------ \n')
+        sample_dataset, data_params = get_sample_data()
+        model = MLPBlock()
+        init_state = state_setup_helper(model=model)
+
+        # the metric suite measures d against the mean of the split's targets 
+        target_mean = jnp.mean(jnp.stack([
+            graph.nodes for window in sample_dataset['val']['targets'] 
+            for graph in window]))
+
+        for all_metrics, eval_fn, eval_kwargs in [
+            (False, evaluate_step, {}), 
+            (True, evaluate_step_metric_suite, {'target_mean': target_mean})]:
+            expected_metrics = None
+            for input_window_graphs, target_window_graphs in zip(
+                sample_dataset['val']['inputs'], 
+                sample_dataset['val']['targets']):
+                metrics_update, _ = eval_fn(
+                    state=init_state,
+                    n_rollout_steps=data_params['output_steps'],
+                    input_window_graphs=input_window_graphs,
+                    target_window_graphs=target_window_graphs, 
+                    **eval_kwargs)
+                if expected_metrics is None:
+                    expected_metrics = metrics_update
+                else:
+                    expected_metrics = expected_metrics.merge(metrics_update)
+
+            # 4 val windows in batches of 3, so the last batch is padded 
+            eval_metrics_dict = evaluate_model(
+                state=init_state,
+                n_rollout_steps=data_params['output_steps'],
+                datasets=sample_dataset,
+                splits=['val'],
+                all_metrics=all_metrics,
+                batch_size=3)
+
+            split_metrics = eval_metrics_dict['val'].compute()
+            for name, value in expected_metrics.compute().items():
+                self.assertTrue(jnp.allclose(split_metrics[name], value, 
+                                             rtol=1e-5, atol=1e-6), name)
+            n_val_samples = int(data_params['n_samples']*data_params['val_pct'])
+            if all_metrics: # counts every predicted value 
+                self.assertEqual(set(split_metrics), set(SUITE_METRICS))
+                self.assertEqual(
+                    int(eval_metrics_dict['val'].stats.count), 
+                    n_val_samples * data_params['output_steps'] 
+                    * data_params['K'] * 2)
+            else:
+                self.assertEqual(int(eval_metrics_dict['val'].loss.count), 
+                                 n_val_samples)
+
+    def test_evaluate_model_error_tensors(self):
+        """ test that the error tensors match errors computed from the 
+            rollouts of each window. """
+        logging.info('\n ------------ test_evaluate_model_error_tensors ------------ \n')
+        sample_dataset, data_params = get_sample_data()
+        model = MLPBlock()
+        init_state = state_setup_helper(model=model)
+
+        errors = []
+        for input_window_graphs, target_window_graphs in zip(
+            sample_dataset['val']['inputs'], sample_dataset['val']['targets']):
+            pred_nodes = rollout(state=init_state, 
+                                 input_window_graphs=input_window_graphs, 
+                                 n_rollout_steps=data_params['output_steps'], 
+                                 rngs=None)
+            errors.append(jnp.stack(pred_nodes) - jnp.stack(
+                [graph.nodes for graph in target_window_graphs]))
+        errors = jnp.stack(errors)
+
+        eval_metrics_dict, error_tensors_dict = evaluate_model(
+            state=init_state,
+            n_rollout_steps=data_params['output_steps'],
+            datasets=sample_dataset,
+            splits=['val'],
+            batch_size=3,
+            return_error_tensors=True)
+        error_tensors = error_tensors_dict['val'].compute()
+
+        expected_shape = (data_params['output_steps'], data_params['K'], 2)
+        self.assertEqual(error_tensors['mse'].shape, expected_shape)
+        self.assertEqual(error_tensors['bias'].shape, expected_shape)
+        self.assertTrue(jnp.allclose(error_tensors['mse'], 
+                                     jnp.mean(jnp.square(errors), axis=0), 
+                                     rtol=1e-5, atol=1e-6))
+        self.assertTrue(jnp.allclose(error_tensors['bias'], 
+                                     jnp.mean(errors, axis=0), 
+                                     rtol=1e-5, atol=1e-6))
+        self.assertEqual(int(eval_metrics_dict['val'].loss.count), len(errors))
+
     def test_train_and_evaluate(self):
         """ test that the train_and_evaluate() function works. """
         logging.info('\n ------------ test_train_and_evaluate ------------ \n')
@@ -256,7 +501,7 @@ class TrainingTests(unittest.TestCase):
         workdir=f"tests/outputs/train_testing_dir_{datetime.now()}"
 
         # test that the function runs without crashing
-        trained_state, train_metrics, eval_metrics_dict = train_and_evaluate(config=mlp_config, workdir=workdir)
+        trained_state, train_metrics, eval_metrics_dict, _ = train_and_evaluate(config=mlp_config, workdir=workdir)
 
         # check the state has the correct number of steps 
         num_train_steps = int(
@@ -307,6 +552,248 @@ class TrainingTests(unittest.TestCase):
              mlp_config.node_features[1])) 
 
 
+    def test_train_and_evaluate_scan_epochs(self):
+        """ test that train_and_evaluate() runs with each epoch as a single 
+            scan. """
+        logging.info('\n ------------ test_train_and_evaluate_scan_epochs ------------ \n')
+        mlp_config = get_config()
+        mlp_config.scan_epochs = True
+        workdir=f"tests/outputs/train_testing_dir_{datetime.now()}"
+
+        trained_state, train_metrics, eval_metrics_dict, _ = train_and_evaluate(config=mlp_config, workdir=workdir)
+
+        num_train_steps = int(
+            mlp_config.epochs * mlp_config.n_samples * mlp_config.train_pct
+            )
+        self.assertEqual(trained_state.step, num_train_steps)
+        self.assertGreater(float(eval_metrics_dict['val'].loss.total), 0)
+
+
+    def test_train_and_evaluate_prefetch(self):
+        """ test that train_and_evaluate() runs with the prefetching loader 
+            and shuffled windows. """
+        logging.info('\n ------------ test_train_and_evaluate_prefetch ------------ \n')
+        mlp_config = get_config()
+        mlp_config.prefetch_depth = 2
+        mlp_config.shuffle_train = True
+        workdir=f"tests/outputs/train_testing_dir_{datetime.now()}"
+
+        trained_state, train_metrics, eval_metrics_dict, _ = train_and_evaluate(config=mlp_config, workdir=workdir)
+
+        num_train_steps = int(
+            mlp_config.epochs * mlp_config.n_samples * mlp_config.train_pct
+            )
+        self.assertEqual(trained_state.step, num_train_steps)
+        self.assertGreater(float(eval_metrics_dict['val'].loss.total), 0)
+
+    def test_train_and_evaluate_train_subsets(self):
+        """ test that train_and_evaluate() trains on the scheduled fraction of 
+            the training windows in each epoch. """
+        logging.info('\n ------------ test_train_and_evaluate_train_subsets ------------ \n')
+        mlp_config = get_config()
+        mlp_config.train_subset_fractions = (0.5, 1.)
+        workdir=f"tests/outputs/train_testing_dir_{datetime.now()}"
+
+        trained_state, _, eval_metrics_dict, _ = train_and_evaluate(config=mlp_config, workdir=workdir)
+
+        n_train_windows = int(mlp_config.n_samples * mlp_config.train_pct)
+        num_train_steps = (round(0.5 * n_train_windows) 
+                           + (mlp_config.epochs - 1) * n_train_windows)
+        self.assertEqual(trained_state.step, num_train_steps)
+        self.assertGreater(float(eval_metrics_dict['val'].loss.total), 0)
+
+    def test_train_and_evaluate_compiles_once(self):
+        """ test that a run compiles train_step only once, even with a strict 
+            limit of one compile. """
+        logging.info('\n ------------ test_train_and_evaluate_compiles_once ------------ \n')
+        mlp_config = get_config()
+        mlp_config.node_features = (28, 2) # an architecture no other test compiles
+        mlp_config.max_compiles_per_function = 1
+        mlp_config.strict_recompilation = True
+        workdir=f"tests/outputs/train_testing_dir_{datetime.now()}"
+        n_compiled = train_step._cache_size()
+
+        train_and_evaluate(config=mlp_config, workdir=workdir)
+        self.assertEqual(train_step._cache_size(), n_compiled + 1)
+
+    def test_train_and_evaluate_recompilation_limit(self):
+        """ test that the recompilation limit and compile counts of a run do 
+            not carry over to the next run in the same process. """
+        logging.info('\n ------------ test_train_and_evaluate_recompilation_limit ------------ \n')
+        mlp_config = get_config()
+        mlp_config.node_features = (24, 2) # an architecture no other test compiles
+        mlp_config.max_compiles_per_function = 2
+        mlp_config.strict_recompilation = True
+        workdir=f"tests/outputs/train_testing_dir_{datetime.now()}"
+        train_and_evaluate(config=mlp_config, workdir=workdir)
+
+        # a new architecture compiles train_step again, which is within this 
+        # run's limit 
+        mlp_config.node_features = (12, 2)
+        workdir=f"tests/outputs/train_testing_dir_{datetime.now()}"
+        train_and_evaluate(config=mlp_config, workdir=workdir)
+
+        # without a limit, the previous run's limit doesn't apply either 
+        mlp_config = get_config()
+        mlp_config.node_features = (20, 2)
+        workdir=f"tests/outputs/train_testing_dir_{datetime.now()}"
+        train_and_evaluate(config=mlp_config, workdir=workdir)
+
+    def test_train_and_evaluate_cache_executables(self):
+        """ test that runs with the same architecture but a different learning 
+            rate and dropout rate reuse the compiled train step, and train 
+            like the uncached run. """
+        logging.info('\n ------------ test_train_and_evaluate_cache_executables ------------ \n')
+        mlp_config = get_config()
+        workdir=f"tests/outputs/train_testing_dir_{datetime.now()}"
+        uncached_state, _, _, _ = train_and_evaluate(config=mlp_config, workdir=workdir)
+
+        mlp_config.cache_executables = True
+        workdir=f"tests/outputs/train_testing_dir_{datetime.now()}"
+        cached_state, _, _, _ = train_and_evaluate(config=mlp_config, workdir=workdir)
+        jax.tree_util.tree_map(
+            lambda x, y: np.testing.assert_allclose(x, y, rtol=1e-4, atol=1e-6), 
+            uncached_state.params, cached_state.params)
+        n_compiled = train_step._cache_size()
+
+        mlp_config.learning_rate = 1e-2
+        mlp_config.dropout_rate = 0.3
+        workdir=f"tests/outputs/train_testing_dir_{datetime.now()}"
+        trained_state, _, eval_metrics_dict, _ = train_and_evaluate(config=mlp_config, workdir=workdir)
+        self.assertEqual(train_step._cache_size(), n_compiled)
+        self.assertAlmostEqual(
+            float(trained_state.opt_state.hyperparams['learning_rate']), 1e-2)
+        self.assertGreater(float(eval_metrics_dict['val'].loss.total), 0)
+
+    def test_train_and_evaluate_resume_mid_epoch(self):
+        """ test that training resumed from a checkpoint saved in the middle 
+            of an epoch ends with the same params as uninterrupted training. """
+        logging.info('\n ------------ test_train_and_evaluate_resume_mid_epoch ------------ \n')
+        mlp_config = get_config()
+        mlp_config.shuffle_train = True
+        mlp_config.checkpoint_every_steps = 1
+        mlp_config.max_checkpts_to_keep = 100
+        workdir=f"tests/outputs/train_testing_dir_{datetime.now()}"
+        trained_state, _, _, _ = train_and_evaluate(config=mlp_config, workdir=workdir)
+
+        # roll back to the checkpoint after the first step of the second epoch 
+        # (the first checkpoint is the initial state) 
+        checkpoint_dir = os.path.join(workdir, 'checkpoints')
+        tf.compat.v1.train.update_checkpoint_state(
+            checkpoint_dir, os.path.join(checkpoint_dir, 'ckpt-4'))
+        restored = checkpoint.Checkpoint(checkpoint_dir).restore_dict()
+        n_train_windows = int(mlp_config.n_samples * mlp_config.train_pct)
+        self.assertEqual(int(restored['step']), n_train_windows + 1)
+        self.assertEqual(int(restored['epoch']), 1)
+        self.assertEqual(int(restored['epoch_step']), 1)
+
+        resumed_state, _, _, _ = train_and_evaluate(config=mlp_config, workdir=workdir)
+        self.assertEqual(int(resumed_state.step), int(trained_state.step))
+        jax.tree_util.tree_map(
+            lambda x, y: np.testing.assert_allclose(x, y, rtol=1e-5, atol=1e-7), 
+            resumed_state.params, trained_state.params)
+
+    def test_train_and_evaluate_resume_train_state(self):
+        """ test that training resumes from a checkpoint of a plain 
+            TrainState, without the rng and position fields, at the step it 
+            was saved. """
+        logging.info('\n ------------ test_train_and_evaluate_resume_train_state ------------ \n')
+        mlp_config = get_config()
+        mlp_config.max_checkpts_to_keep = 100
+        workdir=f"tests/outputs/train_testing_dir_{datetime.now()}"
+        trained_state, _, _, _ = train_and_evaluate(config=mlp_config, workdir=workdir)
+
+        # the checkpoint at the end of the first epoch, without the fields of 
+        # ResumableTrainState (the first checkpoint is the initial state) 
+        state_dict = checkpoint.Checkpoint(
+            os.path.join(workdir, 'checkpoints')).restore_dict(
+                os.path.join(workdir, 'checkpoints', 'ckpt-2'))
+        self.assertEqual(int(state_dict['epoch']), 1)
+        for field in ['rng', 'epoch', 'epoch_step']:
+            del state_dict[field]
+        legacy_workdir = f"tests/outputs/train_testing_dir_{datetime.now()}"
+        checkpoint.Checkpoint(
+            os.path.join(legacy_workdir, 'checkpoints')).save(state_dict)
+
+        resumed_state, _, _, _ = train_and_evaluate(config=mlp_config, 
+                                                   workdir=legacy_workdir)
+        self.assertEqual(int(resumed_state.step), int(trained_state.step))
+        restored = checkpoint.Checkpoint(
+            os.path.join(legacy_workdir, 'checkpoints')).restore_dict()
+        self.assertEqual(int(restored['epoch']), mlp_config.epochs)
+        jax.tree_util.tree_map(
+            lambda x, y: np.testing.assert_allclose(x, y, rtol=1e-5, atol=1e-7), 
+            resumed_state.params, trained_state.params)
+
+    def test_train_step_batch(self):
+        """ test that a batched step uses the average loss of its windows. """
+        logging.info('\n ------------ test_train_step_batch ------------ \n')
+        sample_dataset, data_params = get_sample_data()
+        input_windows = sample_dataset['test']['inputs']
+        target_windows = sample_dataset['test']['targets']
+
+        model = MLPBlock(deterministic=True)
+        init_state = state_setup_helper(model=model)
+
+        window_losses = []
+        for input_window_graphs, target_window_graphs in zip(
+            input_windows, target_windows):
+            x1_loss, x2_loss, _ = rollout_loss(
+                state=init_state,
+                input_window_graphs=input_window_graphs,
+                target_window_graphs=target_window_graphs,
+                n_rollout_steps=data_params['output_steps'],
+                rngs=None)
+            window_losses.append(x1_loss + x2_loss)
+
+        batch_state, batch_metrics, pred_nodes = train_step_batch(
+            state=init_state,
+            n_rollout_steps=data_params['output_steps'],
+            input_window_graphs=stack_windows(input_windows),
+            target_window_graphs=stack_windows(target_windows),
+            rngs={'dropout': jax.random.key(0)})
+
+        self.assertEqual(int(batch_state.step), 1)
+        self.assertEqual(int(batch_metrics.loss.count), len(input_windows))
+        self.assertTrue(jnp.allclose(batch_metrics.compute()['loss'], 
+                                     jnp.mean(jnp.array(window_losses)), 
+                                     atol=1e-5))
+        self.assertEqual(len(pred_nodes), data_params['output_steps'])
+        self.assertEqual(pred_nodes[0].shape, 
+                         (len(input_windows), data_params['K'], 2))
+
+    def test_train_step_batch_multi_device(self):
+        """ test that sharding a batch over several host devices gives the 
+            same update as running it on one device. """
+        logging.info('\n ------------ test_train_step_batch_multi_device ------------ \n')
+        env = dict(os.environ)
+        env["XLA_FLAGS"] = (env.get("XLA_FLAGS", "") 
+                            + " --xla_force_host_platform_device_count=4")
+        env["JAX_PLATFORMS"] = "cpu"
+        env["PYTHONPATH"] = os.getcwd()
+        out = subprocess.run([sys.executable, "-c", DATA_PARALLEL_SCRIPT], 
+                             env=env, capture_output=True, text=True)
+        self.assertEqual(out.returncode, 0, out.stderr)
+        self.assertEqual(out.stdout.split()[-1], "OK")
+
+    def test_train_and_evaluate_data_parallel(self):
+        """ test that train_and_evaluate() runs in data-parallel mode, taking 
+            one step per batch of windows. """
+        logging.info('\n ------------ test_train_and_evaluate_data_parallel ------------ \n')
+        mlp_config = get_config()
+        mlp_config.data_parallel = True
+        mlp_config.batch_size = 2
+        workdir=f"tests/outputs/train_testing_dir_{datetime.now()}"
+
+        trained_state, train_metrics, eval_metrics_dict, _ = train_and_evaluate(config=mlp_config, workdir=workdir)
+
+        n_train_windows = int(mlp_config.n_samples * mlp_config.train_pct)
+        num_train_steps = mlp_config.epochs * (
+            n_train_windows // mlp_config.batch_size)
+        self.assertEqual(trained_state.step, num_train_steps)
+        self.assertGreater(float(eval_metrics_dict['val'].loss.total), 0)
+
+
 if __name__ == "__main__":
     # set up logging for unittest outputs
     log_path = f"tests/outputs/training_tests_{datetime.now().strftime('%y-%m-%d_%H:%M:%S')}.log"
@@ -0,0 +1,86 @@
+import unittest
+import logging
+import os
+import tempfile
+from datetime import datetime
+from run_net import set_up_logging
+
+import optuna
+
+from utils.hyperparam_tuning import get_best_trial_workdir, train_trial
+from utils.trial_artifacts import TrialArtifacts, get_trial_workdir
+from tests.helpers import get_sample_data
+from tests.mlp_sample_config import get_config
+
+
+class TrialArtifactsTests(unittest.TestCase):
+
+    def test_keep_top_k(self):
+        """ test that only the workdirs of the best completed trials are kept, 
+            and the manifest records what happened to every trial. """
+        logging.info('\n ------------ test_keep_top_k ------------ \n')
+        with tempfile.TemporaryDirectory() as study_dir:
+            artifacts = TrialArtifacts(study_dir, keep_top_k=2)
+            workdirs = {}
+            for number in range(5):
+                workdirs[number] = artifacts.create_workdir(number)
+                with open(os.path.join(workdirs[number], "ckpt"), "w") as f:
+                    f.write(str(number))
+            # trial 2 is pruned, trial 0 is evicted by trial 3 and trial 4 
+            # does not make the top 2 
+            artifacts.finish(0, 0.5)
+            artifacts.finish(1, 0.2)
+            artifacts.discard(2)
+            self.assertEqual(artifacts.finish(3, 0.1), 
+                             get_trial_workdir(study_dir, 3))
+            self.assertIsNone(artifacts.finish(4, 0.3))
+            artifacts.wait()
+
+            states = {int(number): entry["state"] for number, entry 
+                      in artifacts.read_manifest()["trials"].items()}
+            self.assertEqual(states, {0: "deleted", 1: "kept", 2: "pruned", 
+                                      3: "kept", 4: "deleted"})
+            for number in [1, 3]:
+                kept_workdir = artifacts.get_workdir(number)
+                self.assertEqual(kept_workdir, 
+                                 get_trial_workdir(study_dir, number))
+                with open(os.path.join(kept_workdir, "ckpt")) as f:
+                    self.assertEqual(f.read(), str(number))
+            for number in [0, 2, 4]:
+                self.assertIsNone(artifacts.get_workdir(number))
+                self.assertFalse(os.path.exists(workdirs[number]))
+            self.assertEqual(sorted(os.listdir(os.path.join(study_dir, "tmp"))), 
+                             [])
+
+    def test_best_trial_workdir(self):
+        """ test that the best trial's checkpoints are found after tuning. """
+        logging.info('\n ------------ test_best_trial_workdir ------------ \n')
+        datasets, _ = get_sample_data()
+
+        def objective(trial):
+            config = get_config()
+            config.epochs = 1
+            config.compilation_cache_dir = None
+            config.learning_rate = trial.suggest_float('learning_rate', 1e-4, 
+                                                       1e-2, log=True)
+            return train_trial(trial, config, datasets)
+
+        with tempfile.TemporaryDirectory() as study_dir:
+            study = optuna.create_study(direction='minimize')
+            study.set_user_attr("study_dir", study_dir)
+            study.optimize(objective, n_trials=2)
+
+            workdir = get_best_trial_workdir(study)
+            self.assertEqual(workdir, get_trial_workdir(
+                study_dir, study.best_trial.number))
+            self.assertTrue(os.path.isdir(os.path.join(workdir, 'checkpoints')))
+
+
+if __name__ == "__main__":
+    # set up logging for unittest outputs
+    log_path = f"tests/outputs/trial_artifacts_tests_{datetime.now().strftime('%y-%m-%d_%H:%M:%S')}.log"
+    set_up_logging(log_path=log_path, log_level_str="INFO")
+
+    with open(log_path, "a") as f:
+        runner = unittest.TextTestRunner(f)
+        unittest.main(testRunner=runner, verbosity=2)
@@ -0,0 +1,85 @@
+""" Asynchronous checkpointing, so that training does not stall while a
+    checkpoint is serialized and written.
+
+    AsyncCheckpointer wraps a clu Checkpoint. save() copies the train state to
+    the host and returns; the copy is serialized and written by clu on a
+    background thread. At most one save is in flight: the next save() first
+    waits for the previous one. clu writes the TensorFlow checkpoint index
+    last, so a checkpoint only becomes visible to restore() once all of its
+    files are complete.
+"""
+import threading
+import weakref
+from typing import Any, Optional
+
+from absl import logging
+from clu import checkpoint
+import jax
+
+# checkpointers that may still have a save in flight
+_checkpointers = weakref.WeakSet()
+
+
+class AsyncCheckpointer:
+    """ Saves checkpoints of a clu Checkpoint on a background thread.
+
+        The background thread is not a daemon thread, so a pending save is
+        finished before the interpreter exits. Call wait() to block until it
+        is done and to raise any error that happened while saving.
+    """
+
+    def __init__(self, ckpt: checkpoint.Checkpoint):
+        self.ckpt = ckpt
+        self.thread: Optional[threading.Thread] = None
+        self.error: Optional[BaseException] = None
+        self.n_saves = 0
+        _checkpointers.add(self)
+
+    @property
+    def latest_checkpoint(self) -> Optional[str]:
+        """ Latest completed checkpoint (see clu's Checkpoint). """
+        return self.ckpt.latest_checkpoint
+
+    def restore_or_initialize(self, state: Any) -> Any:
+        self.wait()
+        return self.ckpt.restore_or_initialize(state)
+
+    def save(self, state: Any):
+        """ Snapshots state on the host and saves it in the background. Waits
+            for the previous save first, if it is still in flight. """
+        self.wait()
+        # copying to the host waits for the steps that compute the state, but
+        # not for the serialization and writing
+        host_state = jax.device_get(state)
+        self.thread = threading.Thread(target=self._save, args=(host_state,),
+                                       name="async_checkpoint")
+        self.thread.start()
+
+    def _save(self, host_state: Any):
+        try:
+            path = self.ckpt.save(host_state)
+            self.n_saves += 1
+            logging.info(f'saved checkpoint {path}')
+        except BaseException as e:
+            self.error = e
+
+    def wait(self):
+        """ Blocks until the pending save (if any) is done, and raises its
+            error, if it failed. """
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+
+def wait_for_pending_checkpoints():
+    """ Waits for the pending saves of all checkpointers of this process,
+        logging (rather than raising) their errors, e.g. before the workdir of
+        a stopped run is cleaned up. """
+    for checkpointer in list(_checkpointers):
+        try:
+            checkpointer.wait()
+        except Exception as e:
+            logging.warning(f'checkpoint save failed: {e}')
@@ -0,0 +1,233 @@
+import contextlib
+import functools
+import inspect
+import os
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from absl import logging
+import jax
+from jax.experimental.compilation_cache import compilation_cache
+
+
+# the persistent cache is only used on cpu if the XLA runtime is enabled, see
+# jax._src.compiler.compile_or_get_cached
+CPU_CACHE_XLA_FLAG = "--xla_cpu_use_xla_runtime=true"
+
+_cache_stats = {"requests": 0, "hits": 0}
+_cache_listener_registered = False
+
+
+def _cache_event_listener(event: str, **kwargs) -> None:
+    """ Counts persistent compilation cache lookups and hits. """
+    if event == "/jax/compilation_cache/compile_requests_use_cache":
+        _cache_stats["requests"] += 1
+    elif event in ("/jax/compilation_cache/cache_hits",
+                   "/jax/compilation_cache/cache_hits_original"):
+        _cache_stats["hits"] += 1
+
+
+def setup_compilation_cache(
+    cache_dir: Optional[str],
+    min_compile_time_secs: float = 0.,
+) -> bool:
+    """ Turns on the on-disk persistent XLA compilation cache.
+
+        Compiled executables of jitted functions (e.g. train_step,
+        evaluate_step) are written to cache_dir and reloaded by later
+        processes that compile the same program with the same shapes, instead
+        of recompiling from scratch. The cache can only be initialized once
+        per process; later calls with the same directory are no-ops.
+
+        Args:
+            cache_dir: directory for the cache. if None, nothing is done.
+            min_compile_time_secs: only programs that took at least this long
+                to compile are written to the cache.
+
+        Returns:
+            whether the persistent cache is active.
+    """
+    global _cache_listener_registered
+    if cache_dir is None:
+        return False
+
+    if not _cache_listener_registered:
+        jax.monitoring.register_event_listener(_cache_event_listener)
+        _cache_listener_registered = True
+
+    if compilation_cache.is_initialized():
+        # initialize_cache() asserts if the path differs
+        logging.info('Persistent compilation cache already initialized.')
+        return True
+
+    os.makedirs(cache_dir, exist_ok=True)
+    jax.config.update('jax_persistent_cache_min_compile_time_secs',
+                      min_compile_time_secs)
+    compilation_cache.initialize_cache(cache_dir)
+    logging.info(f'Using persistent compilation cache at {cache_dir}.')
+
+    if (jax.default_backend() == "cpu"
+        and CPU_CACHE_XLA_FLAG not in os.environ.get("XLA_FLAGS", "")):
+        logging.warning(
+            'The persistent compilation cache is only used on cpu if '
+            f'XLA_FLAGS contains {CPU_CACHE_XLA_FLAG} before jax is '
+            'initialized; compiled programs will not be cached.')
+
+    return True
+
+
+def get_compilation_cache_stats() -> Dict[str, int]:
+    """ Returns the number of persistent cache hits and misses so far in this
+        process.
+    """
+    return {
+        "hits": _cache_stats["hits"],
+        "misses": _cache_stats["requests"] - _cache_stats["hits"],
+    }
+
+
+def log_compilation_cache_stats() -> None:
+    """ Logs the persistent compilation cache hits and misses, if the cache
+        is in use.
+    """
+    if not compilation_cache.is_initialized():
+        return
+    stats = get_compilation_cache_stats()
+    logging.info(
+        f'Persistent compilation cache: {stats["hits"]} hits, '
+        f'{stats["misses"]} misses.')
+
+
+class RecompilationError(RuntimeError):
+    """ Raised in strict mode when a monitored function compiles more often
+        than allowed (see set_recompilation_limit). """
+
+
+# limit on the number of compiles of each monitored function (None for no
+# limit), and whether exceeding it raises a RecompilationError instead of
+# logging a warning
+_recompilation_limit = {"max_compiles": None, "strict": False}
+_monitored_functions: List["MonitoredFunction"] = []
+
+
+def set_recompilation_limit(max_compiles: Optional[int],
+                            strict: bool = False) -> None:
+    """ Sets how many times each monitored function may compile before a
+        warning is logged (or, if strict, a RecompilationError is raised).
+        Compiles for different static arguments (e.g. n_rollout_steps) count
+        too. """
+    _recompilation_limit["max_compiles"] = max_compiles
+    _recompilation_limit["strict"] = strict
+
+
+def reset_compile_counts() -> None:
+    """ Forgets the compiles recorded so far by every monitored function, so 
+        that the limit applies afresh (the compiled programs stay cached). """
+    for fn in _monitored_functions:
+        fn.compiles = []
+
+
+@contextlib.contextmanager
+def recompilation_limit(max_compiles: Optional[int], strict: bool = False):
+    """ Applies a recompilation limit (see set_recompilation_limit) to the 
+        compiles within the block only, e.g. to one training run: the counts 
+        are reset on entering and leaving it, and the previous limit is 
+        restored afterwards. """
+    previous_limit = dict(_recompilation_limit)
+    reset_compile_counts()
+    set_recompilation_limit(max_compiles, strict)
+    try:
+        yield
+    finally:
+        reset_compile_counts()
+        set_recompilation_limit(**previous_limit)
+
+
+def _abstract_signature(value: Any) -> str:
+    """ Describes value by the shapes and dtypes of its arrays (and the
+        values of everything else), which is what jit compiles for. """
+    leaves, treedef = jax.tree_util.tree_flatten(value)
+    if treedef.num_nodes == 1 and len(leaves) == 1 and leaves[0] is value:
+        if hasattr(value, "shape") and hasattr(value, "dtype"):
+            return f'{value.dtype}{list(value.shape)}'
+        return repr(value)
+    if len(leaves) > 8:
+        # long structures, e.g. windows of graphs, are summarized 
+        shapes = sorted(set(_abstract_signature(leaf) for leaf in leaves))
+        return f'{len(leaves)} leaves of {", ".join(shapes)}'
+    return str(jax.tree_util.tree_unflatten(
+        treedef, [_abstract_signature(leaf) for leaf in leaves]))
+
+
+class MonitoredFunction:
+    """ Wraps a jitted function to log each of its compiles, with the
+        abstract signature of the arguments that changed since the previous
+        compile and the compile time, and to enforce the recompilation limit.
+
+        Compiles are detected by the growth of the jitted function's cache,
+        and the compile time is the duration of the call that compiled. Other
+        attributes (e.g. lower, _cache_size) are those of the jitted function.
+    """
+
+    def __init__(self, jitted_fn: Callable, name: Optional[str] = None):
+        self.jitted_fn = jitted_fn
+        self.name = name or getattr(jitted_fn, "__name__", repr(jitted_fn))
+        self.signature = inspect.signature(jitted_fn)
+        self.compiles: List[Dict[str, Any]] = []
+        functools.update_wrapper(self, jitted_fn)
+        _monitored_functions.append(self)
+
+    def __call__(self, *args, **kwargs):
+        n_cached = self.jitted_fn._cache_size()
+        start = time.perf_counter()
+        outputs = self.jitted_fn(*args, **kwargs)
+        if self.jitted_fn._cache_size() > n_cached:
+            self._log_compile(time.perf_counter() - start, args, kwargs)
+        return outputs
+
+    def __getattr__(self, name):
+        return getattr(self.jitted_fn, name)
+
+    def _log_compile(self, compile_secs: float, args, kwargs):
+        bound = self.signature.bind(*args, **kwargs)
+        arg_signatures = {name: _abstract_signature(value)
+                          for name, value in bound.arguments.items()}
+        if self.compiles:
+            previous = self.compiles[-1]["signature"]
+            changed = {name: sig for name, sig in arg_signatures.items()
+                       if previous.get(name) != sig}
+        else:
+            changed = arg_signatures
+        self.compiles.append({"signature": arg_signatures,
+                              "compile_secs": compile_secs})
+        n_compiles = len(self.compiles)
+        logging.info(
+            f'Compiled {self.name} (compile #{n_compiles}) in '
+            f'{compile_secs:.2f}s for '
+            + ('; '.join(f'{name}={sig}' for name, sig in changed.items())
+               or 'the same signature'))
+
+        max_compiles = _recompilation_limit["max_compiles"]
+        if max_compiles is not None and n_compiles > max_compiles:
+            message = (f'{self.name} compiled {n_compiles} times (the limit '
+                       f'is {max_compiles}), most recently for changed '
+                       f'arguments {sorted(changed)}.')
+            if _recompilation_limit["strict"]:
+                raise RecompilationError(message)
+            logging.warning(message)
+
+
+def monitor_compiles(jitted_fn: Callable, name: Optional[str] = None
+                     ) -> MonitoredFunction:
+    """ Returns jitted_fn, with its compiles logged and limited (see
+        MonitoredFunction). Can be used as a decorator above jax.jit. """
+    return MonitoredFunction(jitted_fn, name)
+
+
+def get_compile_counts() -> Dict[str, int]:
+    """ Returns the number of compiles of each monitored function so far in
+        this process. """
+    counts = {}
+    for fn in _monitored_functions:
+        counts[fn.name] = counts.get(fn.name, 0) + len(fn.compiles)
+    return counts
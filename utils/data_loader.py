@@ -0,0 +1,159 @@
+import queue
+import threading
+from typing import Iterator, List, Optional, Sequence, Tuple
+
+import jax
+import jraph
+import numpy as np
+
+from utils.distributed import to_global
+from utils.jraph_data import stack_windows
+
+
+def get_subset_indices(n_windows: int, subset_fraction: float,
+                       seed: int) -> np.ndarray:
+    """ Returns the (sorted) indices of a random subset of the windows, with
+        round(subset_fraction * n_windows) windows (at least one).
+
+        The subsets of a seed are nested, so a larger fraction includes every
+        window of a smaller one.
+    """
+    assert 0 < subset_fraction <= 1, subset_fraction
+    if subset_fraction == 1:
+        return np.arange(n_windows)
+    n_subset = max(1, int(round(subset_fraction * n_windows)))
+    rng = np.random.default_rng([seed, n_windows])
+    return np.sort(rng.permutation(n_windows)[:n_subset])
+
+
+def get_subset_fraction(subset_fractions: Optional[Sequence[float]],
+                        epoch: int) -> float:
+    """ Returns the fraction of the training windows used in an epoch, given
+        a schedule of fractions per epoch. The last fraction of the schedule
+        is kept for the remaining epochs. """
+    if not subset_fractions:
+        return 1.
+    return subset_fractions[min(epoch, len(subset_fractions) - 1)]
+
+
+def get_epoch_order(n_windows: int, epoch: int, seed: int,
+                    shuffle: bool, subset_fraction: float = 1.) -> np.ndarray:
+    """ Returns the order in which the windows are visited in an epoch.
+
+        The order only depends on (seed, epoch), so it can be recomputed, e.g.
+        when resuming training. If subset_fraction < 1, only the windows of a
+        subset (see get_subset_indices) are visited.
+    """
+    subset = get_subset_indices(n_windows, subset_fraction, seed)
+    if not shuffle:
+        return subset
+    rng = np.random.default_rng([seed, epoch])
+    return subset[rng.permutation(len(subset))]
+
+
+class PrefetchLoader:
+    """ Iterates over the (input window, target window) pairs of a dataset
+        split, assembling the next windows and transferring them to the device
+        on a background thread.
+
+        Up to prefetch_depth windows are kept ready ahead of the consumer, so
+        that input preparation overlaps with the compute of the current step
+        instead of sitting in the critical path.
+
+        If batch_size > 1, consecutive windows of the epoch order are stacked
+        into batches (see stack_windows) and the last incomplete batch is
+        dropped. If a sharding is given, the batches are placed with it, e.g.
+        split over the devices of a data-parallel mesh. In a multi-process
+        run, each process passes its own shard of the windows and the batches
+        are assembled into global arrays (see utils.distributed.to_global).
+    """
+
+    def __init__(self,
+                 input_data: List[List[jraph.GraphsTuple]],
+                 target_data: List[List[jraph.GraphsTuple]],
+                 prefetch_depth: int = 2,
+                 shuffle: bool = False,
+                 seed: int = 0,
+                 batch_size: int = 1,
+                 sharding: Optional[jax.sharding.Sharding] = None):
+        assert len(input_data) == len(target_data)
+        assert prefetch_depth > 0
+        assert 0 < batch_size <= len(input_data), (batch_size, len(input_data))
+        self.input_data = input_data
+        self.target_data = target_data
+        self.prefetch_depth = prefetch_depth
+        self.shuffle = shuffle
+        self.seed = seed
+        self.batch_size = batch_size
+        self.sharding = sharding
+
+    def __len__(self) -> int:
+        """ Number of items (windows or batches) yielded per epoch. """
+        return len(self.input_data) // self.batch_size
+
+    def epoch_order(self, epoch: int, subset_fraction: float = 1.) -> np.ndarray:
+        return get_epoch_order(len(self.input_data), epoch, self.seed,
+                               self.shuffle, subset_fraction)
+
+    def _assemble(self, indices: np.ndarray):
+        if self.batch_size == 1:
+            window_pair = (self.input_data[indices[0]],
+                           self.target_data[indices[0]])
+        else:
+            window_pair = (
+                stack_windows([self.input_data[i] for i in indices]),
+                stack_windows([self.target_data[i] for i in indices]))
+        if self.sharding is None:
+            return jax.device_put(window_pair)
+        return to_global(window_pair, self.sharding)
+
+    def iterate(self, epoch: int, subset_fraction: float = 1., start: int = 0
+                ) -> Iterator[Tuple[List[jraph.GraphsTuple],
+                                    List[jraph.GraphsTuple]]]:
+        """ Yields the device-resident windows (or batches) of the given
+            epoch, optionally from a subset of the windows (see
+            get_epoch_order), starting from the window (or batch) with index
+            start, e.g. to resume an epoch. """
+        order = self.epoch_order(epoch, subset_fraction)
+        n_items = len(order) // self.batch_size
+        windows = queue.Queue(maxsize=self.prefetch_depth)
+        stop = threading.Event()
+        end_of_epoch = object()
+
+        def put(item):
+            # give up if the consumer stopped iterating early
+            while not stop.is_set():
+                try:
+                    windows.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def producer():
+            try:
+                for b in range(start, n_items):
+                    indices = order[b * self.batch_size:(b + 1) * self.batch_size]
+                    if not put(self._assemble(indices)):
+                        return
+            except Exception as e: # re-raised in the consumer thread
+                put(e)
+                return
+            put(end_of_epoch)
+
+        thread = threading.Thread(target=producer, daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = windows.get()
+                if item is end_of_epoch:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            thread.join()
+
+    def __iter__(self):
+        return self.iterate(epoch=0)
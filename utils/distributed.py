@@ -0,0 +1,99 @@
+""" Helpers for multi-process (multi-host) training with jax.distributed.
+
+    In a multi-process run, every process executes the same training loop on
+    its own shard of the training windows. The train state is replicated over
+    the devices of all processes and the batches are assembled from the local
+    shards, so that XLA all-reduces the gradients across processes.
+"""
+from typing import Any, List, Sequence
+
+from absl import logging
+import jax
+from jax.experimental import multihost_utils
+import ml_collections
+
+_initialized = False
+
+
+def initialize_distributed(config: ml_collections.ConfigDict) -> bool:
+    """ Connects this process to the other processes of the run, if
+        config.coordinator_address is set.
+
+        This has to happen before jax runs any computation, so it should be the
+        first thing a training process does. The config specifies
+            coordinator_address: "host:port" of process 0, e.g.
+                "127.0.0.1:12355" to run all processes on one machine
+            num_processes: total number of processes
+            process_id: index of this process, in [0, num_processes)
+
+        Returns whether this is a multi-process run.
+    """
+    global _initialized
+    if ("coordinator_address" not in config._fields.keys()
+        or config.coordinator_address is None):
+        return False
+    if _initialized:
+        return True
+
+    # CPU devices only take part in cross-process computations with a
+    # collectives implementation, which newer jax versions provide with gloo
+    if "jax_cpu_collectives_implementation" in jax.config.values:
+        jax.config.update("jax_cpu_collectives_implementation", "gloo")
+
+    jax.distributed.initialize(
+        coordinator_address=config.coordinator_address,
+        num_processes=config.num_processes,
+        process_id=config.process_id)
+    _initialized = True
+
+    if jax.process_count() != config.num_processes:
+        raise RuntimeError(
+            f"jax sees {jax.process_count()} process(es) instead of "
+            f"{config.num_processes} after jax.distributed.initialize. The "
+            f"{jax.default_backend()} backend of this jax version does not "
+            "support multi-process computations.")
+    logging.info(f'Initialized process {jax.process_index()} of '
+                 f'{jax.process_count()} ({jax.local_device_count()} local '
+                 f'and {jax.device_count()} global devices).')
+    return True
+
+
+def is_main_process() -> bool:
+    """ Whether this process should write checkpoints and metrics. """
+    return jax.process_index() == 0
+
+
+def shard_windows(windows: Sequence[Any], process_index: int,
+                  process_count: int) -> List[Any]:
+    """ Returns the windows that the given process trains on.
+
+        The windows are dealt out round-robin, and the leftover windows are
+        dropped so that all processes take the same number of steps.
+    """
+    assert 0 <= process_index < process_count, (process_index, process_count)
+    n_per_process = len(windows) // process_count
+    assert n_per_process > 0, (len(windows), process_count)
+    return list(windows[process_index::process_count])[:n_per_process]
+
+
+def to_global(tree: Any, sharding: jax.sharding.NamedSharding) -> Any:
+    """ Places a pytree of host-local values on the devices of the sharding's
+        mesh.
+
+        With a single process this is a device_put. With several processes,
+        each process passes its local part of the data: its shard of the batch
+        for a sharded axis, or the full value if it is replicated.
+    """
+    if jax.process_count() == 1:
+        return jax.device_put(tree, sharding)
+    return multihost_utils.host_local_array_to_global_array(
+        tree, sharding.mesh, sharding.spec)
+
+
+def to_local(tree: Any) -> Any:
+    """ Returns a copy of a pytree of replicated global arrays on the first
+        local device, so that it can be used in single-process computations
+        such as evaluation. """
+    if jax.process_count() == 1:
+        return tree
+    return jax.tree_util.tree_map(lambda x: x.addressable_data(0), tree)
@@ -0,0 +1,157 @@
+""" Metrics of the evaluation suite, derived from mergeable sufficient
+    statistics.
+
+    Every metric of the suite (mse, mb, me, rmse, crmse, fb, fe, r, r2, d) can
+    be written in terms of a few sums over the predicted and target values:
+    counts, sums, sums of squares, cross-products and absolute sums. These are
+    collected in one pass and simply added when windows, batches or devices are
+    merged, so the metrics are computed over all values of a split at once
+    (rather than averaged over windows, which is wrong for r, crmse and d).
+"""
+from typing import Dict, Optional
+
+import flax
+from clu import metrics
+import jax
+import jax.numpy as jnp
+
+
+@flax.struct.dataclass
+class SufficientStats(metrics.Metric):
+    """ Sums over the (rollout step, node, feature) values of one or more
+        windows.
+
+        The index of agreement (d) needs the mean of the targets, which cannot
+        be merged after the fact. It is measured against the target_mean given
+        to from_model_output, which should be the same (e.g. the mean of the
+        split's targets) for all merged statistics.
+    """
+    count: jnp.ndarray
+    sum_preds: jnp.ndarray
+    sum_targets: jnp.ndarray
+    sum_sq_preds: jnp.ndarray
+    sum_sq_targets: jnp.ndarray
+    sum_cross: jnp.ndarray # sum of preds * targets
+    sum_sq_err: jnp.ndarray
+    sum_abs_err: jnp.ndarray
+    sum_abs_preds_dev: jnp.ndarray # sum of |preds - target_mean|
+    sum_abs_targets_dev: jnp.ndarray # sum of |targets - target_mean|
+
+    @classmethod
+    def from_model_output(cls,
+                          preds: jnp.ndarray,
+                          targets: jnp.ndarray,
+                          target_mean: Optional[jnp.ndarray] = None,
+                          mask: Optional[jnp.ndarray] = None,
+                          **_) -> metrics.Metric:
+        """ Args:
+                preds, targets: arrays of the same shape, e.g.
+                    (n_rollout_steps, K, 2)
+                target_mean: reference for d. defaults to the mean of targets.
+                mask: optional mask over the leading axis of preds
+        """
+        assert preds.shape == targets.shape, (preds.shape, targets.shape)
+        if target_mean is None:
+            target_mean = jnp.mean(targets)
+        if mask is None:
+            weights = jnp.ones(preds.shape, dtype=preds.dtype)
+        else:
+            mask = jnp.reshape(mask, mask.shape + (1,) * (preds.ndim - mask.ndim))
+            weights = jnp.broadcast_to(mask, preds.shape).astype(preds.dtype)
+        # zero out the masked values, so that e.g. nans there do not propagate
+        preds = jnp.where(weights > 0, preds, 0)
+        targets = jnp.where(weights > 0, targets, 0)
+
+        err = preds - targets
+        return cls(
+            count=jnp.sum(weights),
+            sum_preds=jnp.sum(preds),
+            sum_targets=jnp.sum(targets),
+            sum_sq_preds=jnp.sum(jnp.square(preds)),
+            sum_sq_targets=jnp.sum(jnp.square(targets)),
+            sum_cross=jnp.sum(preds * targets),
+            sum_sq_err=jnp.sum(jnp.square(err)),
+            sum_abs_err=jnp.sum(jnp.abs(err)),
+            sum_abs_preds_dev=jnp.sum(weights * jnp.abs(preds - target_mean)),
+            sum_abs_targets_dev=jnp.sum(weights * jnp.abs(targets - target_mean)),
+        )
+
+    def merge(self, other: "SufficientStats") -> "SufficientStats":
+        return jax.tree_util.tree_map(jnp.add, self, other)
+
+    def compute(self) -> Dict[str, jnp.ndarray]:
+        return compute_suite(self)
+
+
+def compute_suite(stats: SufficientStats) -> Dict[str, jnp.ndarray]:
+    """ Derives the metrics of the suite from the sufficient statistics. """
+    n = stats.count
+    mean_preds = stats.sum_preds / n
+    mean_targets = stats.sum_targets / n
+    mse = stats.sum_sq_err / n
+    mb = mean_preds - mean_targets
+    # the variances can come out slightly negative from float32 rounding 
+    var_preds = jnp.maximum(stats.sum_sq_preds / n - jnp.square(mean_preds), 0.)
+    var_targets = jnp.maximum(
+        stats.sum_sq_targets / n - jnp.square(mean_targets), 0.)
+    cov = stats.sum_cross / n - mean_preds * mean_targets
+    # r is undefined for constant preds or targets; it is set to 0 there 
+    var_product = var_preds * var_targets
+    r = jnp.where(var_product > 0, 
+                  cov / jnp.sqrt(jnp.where(var_product > 0, var_product, 1.)), 
+                  0.)
+    return {
+        "mse": mse,
+        "mb": mb,
+        "me": stats.sum_abs_err / n,
+        "rmse": jnp.sqrt(mse),
+        # the centered error is the error minus its mean (the bias)
+        "crmse": jnp.sqrt(jnp.maximum(mse - jnp.square(mb), 0.)),
+        "fb": 2 * (stats.sum_preds - stats.sum_targets)
+              / (stats.sum_preds + stats.sum_targets),
+        "fe": 2 * stats.sum_abs_err
+              / jnp.abs(stats.sum_preds + stats.sum_targets),
+        "r": r,
+        "r2": jnp.square(r),
+        "d": 1 - stats.sum_sq_err
+             / (stats.sum_abs_preds_dev + stats.sum_abs_targets_dev),
+    }
+
+
+@flax.struct.dataclass
+class LeadTimeErrors(metrics.Metric):
+    """ Errors accumulated per (rollout step, node, feature) over windows,
+        e.g. to plot the error growth over the lead time of the rollout.
+
+        Only the sums are kept, so merging windows does not keep their
+        predictions around.
+    """
+    count: jnp.ndarray # number of windows
+    sum_err: jnp.ndarray # (n_rollout_steps, K, 2)
+    sum_sq_err: jnp.ndarray # (n_rollout_steps, K, 2)
+
+    @classmethod
+    def from_model_output(cls,
+                          preds: jnp.ndarray,
+                          targets: jnp.ndarray,
+                          **_) -> metrics.Metric:
+        """ Args:
+                preds, targets: arrays of shape (n_rollout_steps, K, 2) for a
+                    single window
+        """
+        assert preds.shape == targets.shape, (preds.shape, targets.shape)
+        err = preds - targets
+        return cls(count=jnp.array(1, dtype=jnp.int32),
+                   sum_err=err,
+                   sum_sq_err=jnp.square(err))
+
+    def merge(self, other: "LeadTimeErrors") -> "LeadTimeErrors":
+        return jax.tree_util.tree_map(jnp.add, self, other)
+
+    def compute(self) -> Dict[str, jnp.ndarray]:
+        """ Returns the mse and bias, of shape (n_rollout_steps, K, 2). """
+        return {"mse": self.sum_sq_err / self.count,
+                "bias": self.sum_err / self.count}
+
+
+SUITE_METRICS = ("mse", "mb", "me", "rmse", "crmse", "fb", "fe", "r", "r2", "d")
@@ -0,0 +1,305 @@
+""" Long-horizon autoregressive forecasts with a trained model.
+
+    The rollout is computed in chunks of a fixed number of steps with one
+    jitted lax.scan, so forecasts of any length reuse the same executable, and
+    each chunk is written to a memory-mapped .npy file while the next chunk is
+    computed. The memory use is bounded by the chunk size rather than the
+    forecast horizon.
+
+    It also provides batched forecasts from many initial conditions at once,
+    and ensemble forecasts, from perturbed initial conditions and/or MC
+    dropout.
+"""
+from functools import partial
+from typing import Dict, Iterable, Optional, Tuple
+
+from absl import logging
+from flax.training import train_state
+import jax
+import jax.numpy as jnp
+import jraph
+import ml_collections
+import numpy as np
+
+from utils.jraph_training import create_model, rollout_scan
+
+DEFAULT_CHUNK_SIZE = 256
+# batches are padded up to one of these sizes, so that varying batch sizes
+# reuse a few executables. larger batches are split into chunks of the largest.
+DEFAULT_BUCKET_SIZES = (1, 4, 16, 64, 256)
+
+
+@partial(jax.jit, static_argnames=["chunk_size"])
+def forecast_chunk(
+    state: train_state.TrainState,
+    input_window_graphs: Iterable[jraph.GraphsTuple],
+    chunk_size: int,
+    reference_nodes: Optional[jnp.ndarray] = None,
+) -> Tuple[Iterable[jraph.GraphsTuple], jnp.ndarray, Optional[Dict[str, jnp.ndarray]]]:
+    """ Rolls the forecast forward by chunk_size steps.
+
+        Args:
+            reference_nodes: optional reference trajectory for the chunk, with
+                shape (chunk_size, K, 2)
+
+        Returns:
+            the window to continue from, the predicted nodes of the chunk and,
+            if a reference is given, the mse and bias of each step and
+            variable, with shape (chunk_size, 2)
+    """
+    window_graphs, pred_nodes = rollout_scan(
+        state=state, input_window_graphs=input_window_graphs,
+        n_rollout_steps=chunk_size, rngs=None)
+    if reference_nodes is None:
+        return window_graphs, pred_nodes, None
+
+    err = pred_nodes - reference_nodes
+    errors = {"mse": jnp.mean(jnp.square(err), axis=1),
+              "bias": jnp.mean(err, axis=1)}
+    return window_graphs, pred_nodes, errors
+
+
+def forecast_to_memmap(
+    state: train_state.TrainState,
+    input_window_graphs: Iterable[jraph.GraphsTuple],
+    n_steps: int,
+    path: str,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    reference_nodes: Optional[np.ndarray] = None,
+) -> Tuple[np.memmap, Optional[Dict[str, np.ndarray]]]:
+    """ Forecasts n_steps steps from an input window, streaming the
+        predictions to a .npy file.
+
+        Args:
+            state: train state with a deterministic model, e.g. from
+                restore_eval_state
+            input_window_graphs: window of graphs to start the forecast from
+            n_steps: number of steps to forecast (any length)
+            path: .npy file to write the predictions to, with shape
+                (n_steps, K, 2). it can be reopened with
+                np.load(path, mmap_mode='r').
+            chunk_size: number of steps computed per jitted call. the last
+                chunk is computed in full and truncated, so that every chunk
+                uses the same executable.
+            reference_nodes: optional reference trajectory with shape
+                (n_steps, K, 2), e.g. a memmap of the simulated system, to
+                compute the errors of each step against in the same pass
+
+        Returns:
+            the memory-mapped predictions and, if a reference is given, a dict
+            with the mse and bias of each step and variable, with shape
+            (n_steps, 2)
+    """
+    assert n_steps > 0 and chunk_size > 0
+    n_chunks = -(-n_steps // chunk_size) # ceil
+    node_shape = input_window_graphs[0].nodes.shape
+    preds_out = np.lib.format.open_memmap(
+        path, mode='w+', dtype=np.float32, shape=(n_steps,) + node_shape)
+    if reference_nodes is not None:
+        assert reference_nodes.shape == preds_out.shape, (
+            reference_nodes.shape, preds_out.shape)
+        errors_out = {"mse": np.zeros((n_steps, node_shape[-1]), np.float32),
+                      "bias": np.zeros((n_steps, node_shape[-1]), np.float32)}
+    else:
+        errors_out = None
+
+    def write_chunk(chunk_index, pred_nodes, errors):
+        start = chunk_index * chunk_size
+        stop = min(start + chunk_size, n_steps)
+        # this blocks until the chunk is computed
+        preds_out[start:stop] = np.asarray(pred_nodes)[:stop - start]
+        if errors is not None:
+            for name, values in errors.items():
+                errors_out[name][start:stop] = np.asarray(values)[:stop - start]
+
+    def get_reference_chunk(chunk_index):
+        if reference_nodes is None:
+            return None
+        start = chunk_index * chunk_size
+        chunk = np.asarray(reference_nodes[start:start + chunk_size],
+                           dtype=np.float32)
+        if len(chunk) < chunk_size: # pad the last chunk
+            padding = np.zeros((chunk_size - len(chunk),) + node_shape,
+                               np.float32)
+            chunk = np.concatenate([chunk, padding])
+        return chunk
+
+    window_graphs = list(input_window_graphs)
+    pending_chunk = None
+    for chunk_index in range(n_chunks):
+        # jax dispatches asynchronously, so the next chunk is computed while
+        # the previous one is written to disk
+        window_graphs, pred_nodes, errors = forecast_chunk(
+            state=state,
+            input_window_graphs=window_graphs,
+            chunk_size=chunk_size,
+            reference_nodes=get_reference_chunk(chunk_index))
+        if pending_chunk is not None:
+            write_chunk(*pending_chunk)
+        pending_chunk = (chunk_index, pred_nodes, errors)
+    write_chunk(*pending_chunk)
+    preds_out.flush()
+    logging.info(f'Wrote a {n_steps}-step forecast to {path}.')
+
+    return preds_out, errors_out
+
+
+@partial(jax.jit, static_argnames=["n_steps"])
+def forecast_batch(
+    state: train_state.TrainState,
+    window_nodes: jnp.ndarray,
+    n_steps: int,
+    template_graph: jraph.GraphsTuple,
+) -> jnp.ndarray:
+    """ Rollouts from a batch of input windows of node states, with shape
+        (B, input_steps, K, 2), all at once (vmapped). Returns the predicted
+        nodes, with shape (B, n_steps, K, 2). """
+
+    def window_forecast(nodes):
+        input_window_graphs = [template_graph._replace(nodes=nodes[t])
+                               for t in range(nodes.shape[0])]
+        _, pred_nodes = rollout_scan(
+            state=state, input_window_graphs=input_window_graphs,
+            n_rollout_steps=n_steps, rngs=None)
+        return pred_nodes
+
+    return jax.vmap(window_forecast)(window_nodes)
+
+
+def get_bucket_size(batch_size: int,
+                    bucket_sizes: Tuple[int, ...] = DEFAULT_BUCKET_SIZES) -> int:
+    """ Returns the smallest bucket that fits the batch (or the largest
+        bucket, if none does). """
+    for bucket_size in sorted(bucket_sizes):
+        if bucket_size >= batch_size:
+            return bucket_size
+    return max(bucket_sizes)
+
+
+def forecast(
+    state: train_state.TrainState,
+    states: jnp.ndarray,
+    n_steps: int,
+    template_graph: jraph.GraphsTuple,
+    bucket_sizes: Tuple[int, ...] = DEFAULT_BUCKET_SIZES,
+) -> jnp.ndarray:
+    """ Forecasts n_steps steps from each of a batch of initial conditions.
+
+        The batch is padded up to a bucket size (and split into chunks of the
+        largest bucket), so that calls with different batch sizes do not
+        recompile.
+
+        Args:
+            state: train state with a deterministic model, e.g. from
+                restore_eval_state
+            states: initial states, with shape (B, K, 2), or input windows of
+                states, with shape (B, input_steps, K, 2) for models trained
+                on windows of several steps
+            n_steps: number of steps to forecast
+            template_graph: graph that defines the graph structure (edges,
+                senders, receivers) of the states, e.g. any graph of the
+                dataset. its node features are not used.
+            bucket_sizes: batch sizes that batches are padded up to
+
+        Returns:
+            the predicted nodes, with shape (B, n_steps, K, 2)
+    """
+    assert n_steps > 0
+    states = jnp.asarray(states)
+    if states.ndim == 3: # a single input step
+        states = states[:, None]
+    assert states.ndim == 4, states.shape
+    assert states.shape[2:] == template_graph.nodes.shape, (
+        states.shape, template_graph.nodes.shape)
+    batch_size = states.shape[0]
+
+    preds = []
+    start = 0
+    while start < batch_size:
+        bucket_size = get_bucket_size(batch_size - start, bucket_sizes)
+        chunk = states[start:start + bucket_size]
+        n_padding = bucket_size - len(chunk)
+        if n_padding > 0: # pad with copies of the first state
+            chunk = jnp.concatenate(
+                [chunk, jnp.repeat(chunk[:1], n_padding, axis=0)])
+        chunk_preds = forecast_batch(state=state, window_nodes=chunk,
+                                     n_steps=n_steps,
+                                     template_graph=template_graph)
+        preds.append(chunk_preds[:bucket_size - n_padding])
+        start += bucket_size
+
+    return jnp.concatenate(preds)
+
+
+def create_mc_dropout_state(config: ml_collections.ConfigDict,
+                            state: train_state.TrainState
+                            ) -> train_state.TrainState:
+    """ Returns the state with a non-deterministic model, whose dropout (with
+        config.dropout_rate) stays on at inference, for MC dropout ensembles.
+    """
+    net = create_model(config, deterministic=False)
+    return state.replace(apply_fn=net.apply)
+
+
+@partial(jax.jit, static_argnames=["n_steps", "n_members", "mc_dropout",
+                                   "quantiles", "return_members"])
+def ensemble_forecast(
+    state: train_state.TrainState,
+    input_window_graphs: Iterable[jraph.GraphsTuple],
+    n_steps: int,
+    n_members: int,
+    rng: jnp.ndarray,
+    perturbation_std: float = 0.,
+    mc_dropout: bool = False,
+    quantiles: Tuple[float, ...] = (0.1, 0.5, 0.9),
+    return_members: bool = False,
+) -> Dict[str, jnp.ndarray]:
+    """ Runs an ensemble of rollouts from perturbed copies of an input window,
+        all members at once (vmapped), and summarizes it on device.
+
+        Args:
+            state: train state. for MC dropout, its model should not be
+                deterministic (see create_mc_dropout_state).
+            input_window_graphs: window of graphs to start the members from
+            n_steps: number of steps to forecast
+            n_members: ensemble size
+            rng: key for the perturbations and dropout
+            perturbation_std: std of the gaussian noise added to the node
+                features of every graph of the window, independently for each
+                member
+            mc_dropout: whether to pass dropout rngs to the model, so that each
+                member (and step) uses a different dropout mask
+            quantiles: quantiles to compute over the members
+
+        Returns:
+            dict with the ensemble "mean" and "spread" (std), with shape
+            (n_steps, K, 2), and the "quantiles", with shape
+            (len(quantiles), n_steps, K, 2). if return_members, also the
+            "members" predictions, with shape (n_members, n_steps, K, 2).
+    """
+    assert n_steps > 0 and n_members > 0
+    member_rngs = jax.random.split(rng, n_members)
+
+    def member_forecast(member_rng):
+        noise_rng, dropout_rng = jax.random.split(member_rng)
+        noise_rngs = jax.random.split(noise_rng, len(input_window_graphs))
+        perturbed_window_graphs = [
+            graph._replace(nodes=graph.nodes + perturbation_std
+                           * jax.random.normal(noise_rng, graph.nodes.shape,
+                                               graph.nodes.dtype))
+            for graph, noise_rng in zip(input_window_graphs, noise_rngs)]
+        _, pred_nodes = rollout_scan(
+            state=state, input_window_graphs=perturbed_window_graphs,
+            n_rollout_steps=n_steps,
+            rngs={'dropout': dropout_rng} if mc_dropout else None)
+        return pred_nodes
+
+    members = jax.vmap(member_forecast)(member_rngs) # (n_members, n_steps, K, 2)
+    outputs = {
+        "mean": jnp.mean(members, axis=0),
+        "spread": jnp.std(members, axis=0),
+        "quantiles": jnp.quantile(members, jnp.array(quantiles), axis=0),
+    }
+    if return_members:
+        outputs["members"] = members
+    return outputs
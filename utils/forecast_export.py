@@ -0,0 +1,99 @@
+""" Exports trained models as self-contained StableHLO forecast artifacts.
+
+    The artifacts can be loaded with utils.forecast_loader.load_forecast_fn.
+"""
+import json
+from typing import Dict, Iterable, Optional
+
+from absl import logging
+from flax.training import train_state
+import jax
+from jax.experimental.export import export
+import jax.numpy as jnp
+import jraph
+import numpy as np
+
+from utils.jraph_training import rollout
+from utils.forecast_loader import ARTIFACT_FORMAT_VERSION
+
+
+def export_forecast_fn(
+    state: train_state.TrainState,
+    sample_input_window: Iterable[jraph.GraphsTuple],
+    n_rollout_steps: int,
+    path: str,
+    norm_stats: Optional[Dict[str, float]] = None,
+) -> Dict:
+    """ Serializes the rollout of a trained model to a StableHLO artifact.
+
+        The trained params (and normalization stats) are baked into the
+        exported function as constants, so the artifact maps an input window
+        of node states straight to the rollout predictions.
+
+        Args:
+            state: train state with a deterministic model, e.g. from
+                restore_eval_state
+            sample_input_window: window of graphs that defines the graph
+                structure (edges, senders, receivers) and the input shape. its
+                node features are not used.
+            n_rollout_steps: number of steps that the exported rollout predicts
+            path: where to save the .npz artifact
+            norm_stats: normalization stats of the training data, as returned
+                by create_dataset(config, return_norm_stats=True). if given,
+                the exported function takes and returns raw (unnormalized)
+                states.
+
+        Returns:
+            the metadata saved with the artifact
+    """
+    assert n_rollout_steps > 0
+    template_graphs = list(sample_input_window)
+    params = state.params
+
+    if norm_stats is not None:
+        mean = jnp.array([norm_stats["X1_mean"], norm_stats["X2_mean"]])
+        std = jnp.array([norm_stats["X1_std"], norm_stats["X2_std"]])
+
+    def forecast_fn(window_nodes):
+        if norm_stats is not None:
+            window_nodes = (window_nodes - mean) / std
+
+        input_window_graphs = [
+            graph._replace(nodes=window_nodes[i])
+            for i, graph in enumerate(template_graphs)]
+        pred_nodes = rollout(state=state.replace(params=params),
+                             input_window_graphs=input_window_graphs,
+                             n_rollout_steps=n_rollout_steps,
+                             rngs=None)
+        pred_nodes = jnp.stack(pred_nodes) # (n_rollout_steps, K, 2)
+
+        if norm_stats is not None:
+            pred_nodes = pred_nodes * std + mean
+        return pred_nodes
+
+    input_spec = jax.ShapeDtypeStruct(
+        (len(template_graphs),) + template_graphs[0].nodes.shape, jnp.float32)
+    exported = export.export(jax.jit(forecast_fn))(input_spec)
+
+    metadata = {
+        "format_version": ARTIFACT_FORMAT_VERSION,
+        "fun_name": exported.fun_name,
+        "input_shape": list(exported.in_avals[0].shape),
+        "input_dtype": str(exported.in_avals[0].dtype),
+        "output_shape": list(exported.out_avals[0].shape),
+        "output_dtype": str(exported.out_avals[0].dtype),
+        "lowering_platforms": list(exported.lowering_platforms),
+        "serialization_version": exported.serialization_version,
+        "module_kept_var_idx": list(exported.module_kept_var_idx),
+        "n_rollout_steps": n_rollout_steps,
+        "norm_stats": norm_stats,
+    }
+    np.savez(
+        path,
+        mlir_module=np.frombuffer(exported.mlir_module_serialized,
+                                  dtype=np.uint8),
+        metadata=np.array(json.dumps(metadata)),
+    )
+    logging.info(f'Exported forecast function to {path}.')
+
+    return metadata
@@ -0,0 +1,75 @@
+""" Loads forecast artifacts written by utils.forecast_export.
+
+    This module only depends on jax and numpy, so that trained models can be
+    used for inference without flax/jraph/clu or the rest of the training stack.
+"""
+import json
+from typing import Any, Callable, Dict, Tuple
+
+import jax
+from jax.experimental.export import export
+import jax.numpy as jnp
+import numpy as np
+
+ARTIFACT_FORMAT_VERSION = 1
+
+
+def load_forecast_fn(
+    path: str,
+    warmup: bool = True,
+) -> Tuple[Callable[[np.ndarray], np.ndarray], Dict[str, Any]]:
+    """ Loads an exported forecast function.
+
+        Args:
+            path: path to the .npz artifact written by export_forecast_fn
+            warmup: whether to compile the function right away (by calling it
+                once on zeros), so that the first real forecast is fast
+
+        Returns:
+            forecast_fn: maps an input window of node states with shape
+                (input_steps, K, 2) to the rollout predictions with shape
+                (n_rollout_steps, K, 2). both are in the units of the raw data
+                if the artifact was exported with normalization stats.
+            metadata: dict describing the artifact (shapes, n_rollout_steps,
+                norm_stats, ...)
+    """
+    with np.load(path) as artifact:
+        metadata = json.loads(str(artifact["metadata"]))
+        mlir_module_serialized = artifact["mlir_module"].tobytes()
+    assert metadata["format_version"] == ARTIFACT_FORMAT_VERSION, metadata
+
+    # the artifacts are exported for a single device, so all inputs and
+    # outputs are replicated
+    sharding = jax.sharding.GSPMDSharding.get_replicated(jax.devices()[:1])
+    in_aval = jax.core.ShapedArray(tuple(metadata["input_shape"]),
+                                   jnp.dtype(metadata["input_dtype"]))
+    out_aval = jax.core.ShapedArray(tuple(metadata["output_shape"]),
+                                    jnp.dtype(metadata["output_dtype"]))
+    exported = export.Exported(
+        fun_name=metadata["fun_name"],
+        in_tree=jax.tree_util.tree_structure(((0,), {})),
+        in_avals=(in_aval,),
+        out_tree=jax.tree_util.tree_structure(0),
+        out_avals=(out_aval,),
+        in_shardings=(sharding,),
+        out_shardings=(sharding,),
+        lowering_platforms=tuple(metadata["lowering_platforms"]),
+        ordered_effects=(),
+        unordered_effects=(),
+        disabled_checks=(),
+        mlir_module_serialized=mlir_module_serialized,
+        serialization_version=metadata["serialization_version"],
+        module_kept_var_idx=tuple(metadata["module_kept_var_idx"]),
+        uses_shape_polymorphism=False,
+        _get_vjp=None,
+    )
+    jitted_fn = jax.jit(export.call_exported(exported))
+
+    def forecast_fn(window_nodes: np.ndarray) -> np.ndarray:
+        window_nodes = jnp.asarray(window_nodes, dtype=in_aval.dtype)
+        return np.asarray(jitted_fn(window_nodes))
+
+    if warmup:
+        forecast_fn(np.zeros(in_aval.shape, dtype=in_aval.dtype))
+
+    return forecast_fn, metadata
@@ -0,0 +1,405 @@
+""" A small HTTP forecast service for trained models, for other local jobs.
+
+    Concurrent requests are coalesced into batches (within a latency deadline)
+    and forecast with one batched rollout (see utils.forecast.forecast). The
+    service listens on a TCP port or a Unix socket:
+        POST /forecast  {"states": [...], "n_steps": int}
+            states has shape (B, K, 2) or (B, input_steps, K, 2); returns
+            {"predictions": [...]} with shape (B, n_steps, K, 2). n_steps
+            is at most the batcher's max_n_steps.
+        GET /metrics    queue depth, batch and latency statistics (JSON)
+
+    States and predictions are raw (unnormalized). For models trained on
+    normalized data, the server normalizes the states and denormalizes the
+    predictions with the normalization stats of the training data (see
+    load_forecast_server).
+"""
+import collections
+import http.client
+import http.server
+import json
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+from absl import logging
+from flax.training import train_state
+import jax.numpy as jnp
+import jraph
+import ml_collections
+import numpy as np
+
+from utils.forecast import DEFAULT_BUCKET_SIZES, forecast, get_bucket_size
+from utils.jraph_data import timestep_to_graphstuple
+from utils.jraph_training import create_dataset, restore_eval_state
+
+
+# horizons are rounded up to one of these numbers of steps, so that requests
+# with varying horizons reuse a few executables (and can be batched together)
+DEFAULT_HORIZON_BUCKETS = (16, 64, 256, 1024)
+
+
+class ForecastRequest:
+    """ A pending request, which the batcher thread fills in. """
+
+    def __init__(self, states: np.ndarray, n_steps: int, horizon: int):
+        self.states = states
+        self.n_steps = n_steps
+        self.horizon = horizon # n_steps rounded up to a horizon bucket
+        self.arrival_time = time.perf_counter()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def key(self) -> Tuple:
+        """ Requests with the same key can be batched together. """
+        return (self.horizon,) + self.states.shape[1:]
+
+
+class ForecastBatcher:
+    """ Coalesces forecast requests into batches on a background thread.
+
+        After the first request of a batch arrives, further requests are
+        collected for up to max_wait_ms (or until max_batch_size states are
+        collected), and all of them are forecast with one batched rollout.
+        Only requests with the same horizon bucket and state shape are batched
+        together; the others wait for the next batch.
+
+        Horizons are rounded up to one of horizon_buckets, and the
+        predictions are cut back to the requested number of steps. Requests
+        for more than max_n_steps steps are rejected, so that a single
+        request cannot compile or run an arbitrarily long rollout.
+
+        If norm_stats (the normalization stats of the training data, as
+        returned by create_dataset(config, return_norm_stats=True)) are
+        given, requests take and return raw states, which are normalized
+        before the rollout and denormalized after it.
+    """
+
+    def __init__(self,
+                 state: train_state.TrainState,
+                 template_graph: jraph.GraphsTuple,
+                 max_batch_size: int = 64,
+                 max_wait_ms: float = 5.,
+                 bucket_sizes: Tuple[int, ...] = DEFAULT_BUCKET_SIZES,
+                 n_latencies: int = 1000,
+                 norm_stats: Optional[Dict[str, float]] = None,
+                 max_n_steps: int = max(DEFAULT_HORIZON_BUCKETS),
+                 horizon_buckets: Tuple[int, ...] = DEFAULT_HORIZON_BUCKETS):
+        assert 0 < max_n_steps <= max(horizon_buckets), (
+            'max_n_steps should be at most the largest horizon bucket', 
+            max_n_steps, horizon_buckets)
+        self.state = state
+        self.template_graph = template_graph
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.bucket_sizes = bucket_sizes
+        self.max_n_steps = max_n_steps
+        self.horizon_buckets = horizon_buckets
+        if norm_stats is not None:
+            self.norm_mean = np.array(
+                [norm_stats["X1_mean"], norm_stats["X2_mean"]], np.float32)
+            self.norm_std = np.array(
+                [norm_stats["X1_std"], norm_stats["X2_std"]], np.float32)
+        else:
+            self.norm_mean, self.norm_std = None, None
+
+        self.requests = queue.Queue()
+        self.deferred = collections.deque() # requests left for a later batch
+        self.latencies = collections.deque(maxlen=n_latencies)
+        self.n_requests = 0
+        self.n_batches = 0
+        self.n_batched_states = 0
+        self.metrics_lock = threading.Lock()
+
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, states: np.ndarray, n_steps: int,
+               timeout: Optional[float] = None) -> np.ndarray:
+        """ Forecasts n_steps steps from states, blocking until the batch that
+            includes them is done. """
+        states = np.asarray(states, dtype=np.float32)
+        assert states.ndim in (3, 4), states.shape
+        n_steps = int(n_steps)
+        if not 0 < n_steps <= self.max_n_steps:
+            raise ValueError(f'n_steps should be between 1 and '
+                             f'{self.max_n_steps}, got {n_steps}')
+        request = ForecastRequest(
+            states, n_steps, get_bucket_size(n_steps, self.horizon_buckets))
+        self.requests.put(request)
+        if not request.done.wait(timeout):
+            raise TimeoutError('forecast request timed out')
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def queue_depth(self) -> int:
+        return self.requests.qsize() + len(self.deferred)
+
+    def get_metrics(self) -> Dict[str, Any]:
+        with self.metrics_lock:
+            latencies = np.array(self.latencies)
+            metrics = {
+                "queue_depth": self.queue_depth(),
+                "requests": self.n_requests,
+                "batches": self.n_batches,
+                "mean_batch_size": (self.n_batched_states / self.n_batches
+                                    if self.n_batches else 0.),
+            }
+        for q in [50, 95, 99]:
+            metrics[f"latency_ms_p{q}"] = (
+                float(np.percentile(latencies, q) * 1000)
+                if len(latencies) else None)
+        return metrics
+
+    def close(self):
+        self.stop_event.set()
+        self.thread.join()
+
+    def _next_request(self, timeout: float) -> Optional[ForecastRequest]:
+        if self.deferred:
+            return self.deferred.popleft()
+        try:
+            return self.requests.get(timeout=max(timeout, 0.))
+        except queue.Empty:
+            return None
+
+    def _collect_batch(self):
+        first = self._next_request(timeout=0.1)
+        if first is None:
+            return []
+        batch = [first]
+        n_states = len(first.states)
+        deadline = time.perf_counter() + self.max_wait
+        skipped = []
+        while n_states < self.max_batch_size:
+            request = self._next_request(deadline - time.perf_counter())
+            if request is None:
+                break
+            if request.key() == first.key():
+                batch.append(request)
+                n_states += len(request.states)
+            else:
+                skipped.append(request)
+        self.deferred.extend(skipped)
+        return batch
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            batch = self._collect_batch()
+            if not batch:
+                continue
+            n_states = sum(len(request.states) for request in batch)
+            try:
+                states = np.concatenate([request.states for request in batch])
+                if self.norm_mean is not None:
+                    states = (states - self.norm_mean) / self.norm_std
+                preds = np.asarray(forecast(
+                    state=self.state, states=jnp.asarray(states),
+                    n_steps=batch[0].horizon,
+                    template_graph=self.template_graph,
+                    bucket_sizes=self.bucket_sizes))
+                if self.norm_mean is not None:
+                    preds = preds * self.norm_std + self.norm_mean
+                start = 0
+                for request in batch:
+                    request.result = preds[start:start + len(request.states),
+                                           :request.n_steps]
+                    start += len(request.states)
+            except Exception as e: # reported to the requests of the batch
+                logging.exception('forecast batch failed')
+                for request in batch:
+                    request.error = e
+
+            done_time = time.perf_counter()
+            with self.metrics_lock:
+                self.n_requests += len(batch)
+                self.n_batches += 1
+                self.n_batched_states += n_states
+                for request in batch:
+                    self.latencies.append(done_time - request.arrival_time)
+            for request in batch:
+                request.done.set()
+
+
+class ForecastRequestHandler(http.server.BaseHTTPRequestHandler):
+
+    def _send_json(self, status: int, payload: Dict[str, Any]):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            self._send_json(200, self.server.batcher.get_metrics())
+        else:
+            self._send_json(404, {"error": f"unknown path {self.path}"})
+
+    def do_POST(self):
+        if self.path != "/forecast":
+            self._send_json(404, {"error": f"unknown path {self.path}"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length))
+            preds = self.server.batcher.submit(
+                np.array(request["states"], dtype=np.float32),
+                n_steps=request["n_steps"])
+        except (KeyError, TypeError, ValueError, AssertionError) as e:
+            self._send_json(400, {"error": repr(e)})
+            return
+        except Exception as e:
+            self._send_json(500, {"error": repr(e)})
+            return
+        self._send_json(200, {"predictions": preds.tolist()})
+
+    def log_message(self, format, *args):
+        logging.debug(format, *args)
+
+
+class ForecastHTTPServer(http.server.ThreadingHTTPServer):
+    """ Threading HTTP server (on a TCP port) that owns a ForecastBatcher. """
+    daemon_threads = True
+
+    def __init__(self, server_address, batcher: ForecastBatcher):
+        self.batcher = batcher
+        super().__init__(server_address, ForecastRequestHandler)
+
+
+class UnixForecastHTTPServer(ForecastHTTPServer):
+    """ ForecastHTTPServer on a Unix socket, given its path. """
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        socketserver.TCPServer.server_bind(self)
+        self.server_name = "localhost"
+        self.server_port = 0
+
+    def get_request(self):
+        request, _ = super().get_request()
+        return request, ("localhost", 0) # for the handler's log messages
+
+
+def create_forecast_server(
+    state: train_state.TrainState,
+    template_graph: jraph.GraphsTuple,
+    port: Optional[int] = None,
+    unix_socket: Optional[str] = None,
+    host: str = "127.0.0.1",
+    **batcher_kwargs,
+) -> ForecastHTTPServer:
+    """ Creates a forecast server on a TCP port (0 picks a free one) or a Unix
+        socket. Call serve_forever() on it, e.g. in a thread, and
+        shutdown() + batcher.close() to stop it. """
+    assert (port is None) != (unix_socket is None), \
+        'give either a port or a unix socket'
+    batcher = ForecastBatcher(state, template_graph, **batcher_kwargs)
+    if unix_socket is not None:
+        return UnixForecastHTTPServer(unix_socket, batcher)
+    return ForecastHTTPServer((host, port), batcher)
+
+
+def load_forecast_server(config: ml_collections.ConfigDict, workdir: str,
+                         norm_stats: Optional[Dict[str, float]] = None,
+                         **server_kwargs) -> ForecastHTTPServer:
+    """ Creates a forecast server for the latest checkpoint in workdir,
+        restored the same way as in plot_predictions.
+
+        If the model was trained on normalized data (config.normalize), the
+        server takes and returns raw states. The normalization stats of the
+        training data are recomputed from the config's dataset, unless they
+        are given as norm_stats.
+    """
+    if config.normalize and norm_stats is None:
+        logging.info('Obtaining the normalization stats of the training data.')
+        _, norm_stats = create_dataset(config, return_norm_stats=True)
+    elif not config.normalize:
+        norm_stats = None
+    template_graph = timestep_to_graphstuple(
+        jnp.zeros((config.K, 2)), K=config.K,
+        fully_connected_edges=config.fully_connected_edges)
+    sample_input_window = [template_graph] * config.input_steps
+    state = restore_eval_state(config, workdir, sample_input_window)
+    return create_forecast_server(state, template_graph, norm_stats=norm_stats,
+                                  **server_kwargs)
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, path: str, timeout: Optional[float] = None):
+        super().__init__("localhost", timeout=timeout)
+        self.unix_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.unix_path)
+
+
+UNIX_SOCKET_PREFIX = "unix://"
+
+
+class ForecastClient:
+    """ Client for a forecast server, given "host:port" (optionally prefixed
+        with "http://") or "unix://" followed by a Unix socket path, e.g.
+        "unix:///tmp/lorenz_forecasts.sock" or "unix://forecasts.sock". """
+
+    def __init__(self, address: str, timeout: Optional[float] = 60.):
+        self.address = address
+        self.timeout = timeout
+        self.unix_socket = None
+        if address.startswith(UNIX_SOCKET_PREFIX):
+            self.unix_socket = address[len(UNIX_SOCKET_PREFIX):]
+            if not self.unix_socket:
+                raise ValueError(f'no socket path in address {address!r}')
+            return
+        host_port = address
+        if host_port.startswith("http://"):
+            host_port = host_port[len("http://"):].rstrip("/")
+        host, _, port = host_port.rpartition(":")
+        if not host or not port.isdigit():
+            raise ValueError(
+                f'forecast server address {address!r} is neither '
+                f'"host:port" nor "{UNIX_SOCKET_PREFIX}<socket path>"')
+        self.host, self.port = host, int(port)
+
+    def _connection(self) -> http.client.HTTPConnection:
+        if self.unix_socket is not None:
+            return UnixHTTPConnection(self.unix_socket, timeout=self.timeout)
+        return http.client.HTTPConnection(self.host, self.port,
+                                          timeout=self.timeout)
+
+    def _request(self, method: str, path: str,
+                 payload: Optional[Dict] = None) -> Dict[str, Any]:
+        connection = self._connection()
+        try:
+            body = None if payload is None else json.dumps(payload)
+            connection.request(method, path, body=body,
+                               headers={"Content-Type": "application/json"})
+            response = connection.getresponse()
+            result = json.loads(response.read())
+        finally:
+            connection.close()
+        if response.status != 200:
+            raise RuntimeError(f'forecast server error {response.status}: '
+                               f'{result.get("error")}')
+        return result
+
+    def forecast(self, states: np.ndarray, n_steps: int) -> np.ndarray:
+        result = self._request("POST", "/forecast", {
+            "states": np.asarray(states).tolist(), "n_steps": n_steps})
+        return np.array(result["predictions"], dtype=np.float32)
+
+    def metrics(self) -> Dict[str, Any]:
+        return self._request("GET", "/metrics")
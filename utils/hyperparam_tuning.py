@@ -1,9 +1,16 @@
 from utils.jraph_training import train_and_evaluate_with_data, create_dataset
+from utils.population_training import train_population
+from utils.checkpointing import wait_for_pending_checkpoints
+from utils.shared_dataset import SharedDataset
+from utils.trial_artifacts import get_trial_artifacts
 # from utils.jraph_models import MLPGraphNetwork
+from absl import logging
 import ml_collections
+import multiprocessing
+import numpy as np
 import optuna 
 from functools import partial
-from datetime import datetime
+from typing import Callable, Optional
 import os 
 
 CHECKPOINT_PATH = "/Users/miamirabelli/Desktop/GNN Research/lorenzGNN/experiments/tuning"
@@ -12,15 +19,15 @@ CHECKPOINT_PATH = "/Users/miamirabelli/Desktop/GNN Research/lorenzGNN/experiment
 def get_base_config():
     config = ml_collections.ConfigDict()
 
+    # defaults that the training loop needs, which are not tuned 
+    config.activation = 'relu'
+    config.seed = 42
+    config.max_checkpts_to_keep = 5
+
     return config
 
-def objective(trial, datasets):
-    """ Defines the objective function to be optimized over, aka the validation loss of a model.
-    
-        Args:
-            trial: object which characterizes the current run 
-            datasets: dictionary of data. we explicitly pass this in so that we don't have to waste runtime regenerating the same dataset over and over. 
-    """
+def suggest_config(trial):
+    """ Creates the config of a trial, sampling its hyperparameters. """
     # create config 
     config = get_base_config()
 
@@ -62,17 +69,83 @@ def objective(trial, datasets):
     # note the last feature size will be the number of features that the graph predicts
     config.global_features = None
 
-    # generate a workdir 
-    # TODO: check if we actually care about referencing this in the future or if we can just create a temp dir 
-    workdir=os.path.join(CHECKPOINT_PATH, str(datetime.now()))
+    # trials with the same architecture reuse the compiled train and eval 
+    # steps, with the learning rate and dropout rate passed at runtime 
+    config.cache_executables = True
+    # write checkpoints without stalling training 
+    config.async_checkpointing = True
+
+    return config
+
+def objective(trial, datasets):
+    """ Defines the objective function to be optimized over, aka the validation loss of a model.
+    
+        Args:
+            trial: object which characterizes the current run 
+            datasets: dictionary of data. we explicitly pass this in so that we don't have to waste runtime regenerating the same dataset over and over. 
+    """
+    config = suggest_config(trial)
+    return train_trial(trial, config, datasets)
+
+def get_train_subset_fractions(n_epochs, min_subset_fraction=1/9, 
+                               reduction_factor=3):
+    """ Returns a schedule of the fraction of the training windows used in 
+        each epoch, growing by reduction_factor every epoch from 
+        min_subset_fraction up to all windows. """
+    return tuple(min(1., min_subset_fraction * reduction_factor**epoch) 
+                 for epoch in range(n_epochs))
+
+def multi_fidelity_objective(trial, datasets, max_epochs=9, 
+                             min_subset_fraction=1/9, reduction_factor=3):
+    """ Objective for multi-fidelity tuning, with a Hyperband or successive 
+        halving pruner (see create_pruner). 
+
+        The trial is evaluated (and reported to the pruner) every epoch, and 
+        trains on a growing subset of the training windows (see 
+        get_train_subset_fractions), so the budget of a trial grows with both 
+        its epochs and the amount of data it has seen. Poor trials are pruned 
+        after seeing a fraction of the data. The subsets are drawn from the 
+        given datasets, so the data is not regenerated. 
+    """
+    config = suggest_config(trial)
+    config.epochs = max_epochs
+    config.log_every_epochs = 1
+    config.eval_every_epochs = 1
+    config.train_subset_fractions = get_train_subset_fractions(
+        max_epochs, min_subset_fraction, reduction_factor)
+    return train_trial(trial, config, datasets)
+
+def train_trial(trial, config, datasets):
+    """ Trains the model of a trial and returns its val loss. """
+    # share compiled executables across trials and studies 
+    if "compilation_cache_dir" not in config._fields.keys():
+        config.compilation_cache_dir = os.path.join(CHECKPOINT_PATH, "compilation_cache")
+
+    # train in a temporary workdir, which is only kept if the trial ends up 
+    # among the best trials of the study (see utils.trial_artifacts) 
+    artifacts = get_trial_artifacts(
+        get_study_dir(trial.study), 
+        direction=trial.study.direction.name.lower())
+    workdir = artifacts.create_workdir(trial.number)
 
     # run training 
-    _, _, eval_metrics_dict, _ = train_and_evaluate_with_data(config=config, workdir=workdir, datasets=datasets, trial=trial)
+    try:
+        _, _, eval_metrics_dict, _ = train_and_evaluate_with_data(config=config, workdir=workdir, datasets=datasets, trial=trial)
+    except optuna.TrialPruned:
+        wait_for_pending_checkpoints()
+        artifacts.discard(trial.number, state="pruned")
+        raise
+    except Exception:
+        wait_for_pending_checkpoints()
+        artifacts.discard(trial.number, state="failed")
+        raise
     
     # retrieve and return val loss (MSE)
     print("eval_metrics_dict['val'].loss", eval_metrics_dict['val'].loss)
     print()
-    return eval_metrics_dict['val'].loss.total / eval_metrics_dict['val'].loss.count
+    val_loss = float(eval_metrics_dict['val'].loss.total / eval_metrics_dict['val'].loss.count)
+    artifacts.finish(trial.number, val_loss)
+    return val_loss
 
 
 def get_data_config():
@@ -101,36 +174,287 @@ def get_data_config():
 
     return config
 
-def prepare_study(study_name):
+def get_study_dir(study):
+    """ Returns the directory of a study, where its trial artifacts are kept. 
+        It is CHECKPOINT_PATH/study_name, unless the study records another 
+        one (see run_parallel_study). """
+    return study.user_attrs.get(
+        "study_dir", os.path.join(CHECKPOINT_PATH, study.study_name))
+
+def get_study_storage(study_dir, storage_type="sqlite"):
+    """ Returns the storage of a study, in study_dir. 
+    
+        Args:
+            storage_type: "sqlite", or "journal" for a journal file, which 
+                handles many processes writing to it at once better 
+    """
+    if not os.path.exists(study_dir):
+        os.makedirs(study_dir)
+    if storage_type == "sqlite":
+        db_path = os.path.join(study_dir, "optuna_hparam_search.db")
+        return f'sqlite:///{db_path}' # generates a new db if it doesn't exist
+    if storage_type == "journal":
+        return optuna.storages.JournalStorage(
+            optuna.storages.JournalFileStorage(
+                os.path.join(study_dir, "optuna_journal.log")))
+    raise ValueError(f'Unsupported storage type: {storage_type}.')
+
+def create_pruner(pruner_type="median", min_resource=1, max_resource="auto", 
+                  reduction_factor=3):
+    """ Creates the pruner of a study. 
+
+        Args:
+            pruner_type: "median", or "hyperband" or "successive_halving" for 
+                multi-fidelity tuning (see multi_fidelity_objective), where the 
+                resource is the number of epochs reported 
+            min_resource, max_resource, reduction_factor: resource parameters 
+                of the multi-fidelity pruners 
+    """
+    if pruner_type == "median":
+        return optuna.pruners.MedianPruner(
+            n_startup_trials=5, 
+            n_warmup_steps=1,
+            )
+    if pruner_type == "hyperband":
+        return optuna.pruners.HyperbandPruner(
+            min_resource=min_resource, max_resource=max_resource, 
+            reduction_factor=reduction_factor)
+    if pruner_type == "successive_halving":
+        return optuna.pruners.SuccessiveHalvingPruner(
+            min_resource=min_resource, reduction_factor=reduction_factor)
+    raise ValueError(f'Unsupported pruner: {pruner_type}.')
+
+def prepare_study(study_name, storage=None, pruner=None):
     # run optimization study
-    db_path = os.path.join(CHECKPOINT_PATH, study_name, "optuna_hparam_search.db")
-    if not os.path.exists(os.path.join(CHECKPOINT_PATH, study_name)):
-        os.makedirs(os.path.join(CHECKPOINT_PATH, study_name))
+    if storage is None:
+        storage = get_study_storage(os.path.join(CHECKPOINT_PATH, study_name))
+    if pruner is None:
+        pruner = create_pruner()
 
     study = optuna.create_study(
         study_name=study_name,
-        storage=f'sqlite:///{db_path}', # generates a new db if it doesn't exist
+        storage=storage,
         direction='minimize',
-        pruner=optuna.pruners.MedianPruner(
-            n_startup_trials=5, 
-            n_warmup_steps=1,
-            ), 
+        pruner=pruner, 
         load_if_exists=True, 
     )
     
     return study
 
-def get_objective_with_dataset():
+def get_objective_with_dataset(multi_fidelity=False):
     # generate dataset 
     dataset_config = get_data_config()
     datasets = create_dataset(dataset_config)
 
     # get the objective function that reuses the pre-generated datasets 
-    objective_with_dataset = partial(objective, datasets=datasets)
+    objective_fn = multi_fidelity_objective if multi_fidelity else objective
+    objective_with_dataset = partial(objective_fn, datasets=datasets)
 
     return objective_with_dataset
 
 
+def get_worker_cores(n_workers, cores=None):
+    """ Splits the cores (by default, the ones this process may run on) into 
+        n_workers contiguous groups. If there are fewer cores than workers, 
+        the workers share them round-robin. 
+    """
+    if cores is None:
+        cores = sorted(os.sched_getaffinity(0))
+    if len(cores) < n_workers:
+        return [[cores[i % len(cores)]] for i in range(n_workers)]
+    return [list(group) for group in np.array_split(cores, n_workers)]
+
+def run_tuning_worker(study_name, study_dir, storage_type, dataset_spec, 
+                      objective_fn, n_trials, cores, pruner_type="median"):
+    """ Runs n_trials trials of the study, on the shared dataset. This runs 
+        in a worker process started by run_parallel_study. """
+    # pin the process (and the XLA threads it starts) to its cores 
+    if cores is not None:
+        os.sched_setaffinity(0, cores)
+    # the shared dataset must stay referenced while its arrays are in use
+    shared_dataset = SharedDataset.attach(dataset_spec)
+    datasets = shared_dataset.get_datasets()
+
+    study = prepare_study(study_name, 
+                          storage=get_study_storage(study_dir, storage_type), 
+                          pruner=create_pruner(pruner_type))
+    study.optimize(partial(objective_fn, datasets=datasets), n_trials=n_trials)
+
+def run_parallel_study(
+    study_name: str, 
+    n_trials: int, 
+    n_workers: Optional[int] = None, 
+    datasets=None, 
+    objective_fn: Callable = objective, 
+    study_dir: Optional[str] = None, 
+    storage_type: str = "journal", 
+    pin_cores: bool = True,
+    pruner_type: str = "median",
+) -> optuna.study.Study:
+    """ Runs the trials of a study in n_workers processes at once. 
+
+        The dataset is generated (or given) once and put in shared memory, 
+        which all workers read from, and the workers share the study's 
+        storage. Each worker is pinned to its own group of cores. 
+
+        Args:
+            study_name: name of the study, created if it does not exist 
+            n_trials: total number of trials, split over the workers 
+            n_workers: number of worker processes. defaults to the number of 
+                available cores. 
+            datasets: dataset to tune on. defaults to the one of 
+                get_data_config. 
+            objective_fn: objective taking (trial, datasets). it must be 
+                importable by the workers, i.e. defined at module level. 
+            study_dir: directory of the study's storage. defaults to 
+                CHECKPOINT_PATH/study_name. 
+            storage_type: "journal" or "sqlite" (see get_study_storage) 
+            pin_cores: whether to pin each worker to its group of cores 
+            pruner_type: pruner of the study (see create_pruner), e.g. 
+                "hyperband" with objective_fn=multi_fidelity_objective 
+    """
+    if n_workers is None:
+        n_workers = len(os.sched_getaffinity(0))
+    if study_dir is None:
+        study_dir = os.path.join(CHECKPOINT_PATH, study_name)
+    if datasets is None:
+        datasets = create_dataset(get_data_config())
+
+    # create the study up front, so the workers do not race to create it
+    study = prepare_study(study_name, 
+                          storage=get_study_storage(study_dir, storage_type), 
+                          pruner=create_pruner(pruner_type))
+    study.set_user_attr("study_dir", study_dir)
+
+    worker_cores = get_worker_cores(n_workers) if pin_cores else [None] * n_workers
+    worker_trials = [len(trials) for trials in 
+                     np.array_split(np.arange(n_trials), n_workers)]
+    shared_dataset = SharedDataset.create(datasets)
+    # jax is not fork-safe, so the workers are started as fresh processes
+    ctx = multiprocessing.get_context("spawn")
+    try:
+        workers = [ctx.Process(
+            target=run_tuning_worker, 
+            args=(study_name, study_dir, storage_type, shared_dataset.spec, 
+                  objective_fn, n_worker_trials, cores, pruner_type)) 
+            for n_worker_trials, cores in zip(worker_trials, worker_cores)
+            if n_worker_trials > 0]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    finally:
+        shared_dataset.unlink()
+
+    failed = [worker.exitcode for worker in workers if worker.exitcode != 0]
+    if failed:
+        raise RuntimeError(f'{len(failed)} tuning workers failed, with exit '
+                           f'codes {failed}')
+    return prepare_study(study_name, 
+                         storage=get_study_storage(study_dir, storage_type), 
+                         pruner=create_pruner(pruner_type))
+
+
+# hyperparameters that define the architecture. the members of a population 
+# share them, and only differ in the other (continuous) hyperparameters 
+ARCHITECTURE_PARAMS = ("n_blocks", "edge_mlp_1_power", "edge_mlp_2_power", 
+                       "node_mlp_1_power")
+
+def ask_population_member(study, architecture, config_fn, max_attempts=10):
+    """ Enqueues a trial with the given architecture and asks for it. 
+
+        If the trial that is asked for does not have that architecture (e.g. 
+        because a concurrent worker asked for the enqueued trial first), it 
+        is told FAIL, and the member is enqueued and asked again, up to 
+        max_attempts times. 
+
+        Returns:
+            the trial and its config 
+    """
+    for _ in range(max_attempts):
+        study.enqueue_trial(architecture)
+        trial = study.ask()
+        config = config_fn(trial)
+        mismatched = {name: trial.params.get(name) 
+                      for name, value in architecture.items() 
+                      if trial.params.get(name) != value}
+        if not mismatched:
+            return trial, config
+        logging.warning(f'Trial {trial.number} does not have the population '
+                        f'architecture {architecture} (got {mismatched}), '
+                        'discarding it.')
+        trial.set_user_attr("population_mismatch", True)
+        study.tell(trial, state=optuna.trial.TrialState.FAIL)
+    raise RuntimeError(f'Could not ask for a trial with the architecture '
+                       f'{architecture} in {max_attempts} attempts; workers '
+                       'running populations should not share storage.')
+
+
+def run_population_trials(study, datasets, population_size, n_populations=1, 
+                          config_fn=suggest_config):
+    """ Runs trials in populations of population_size trials that share an 
+        architecture, each population trained at once (see 
+        utils.population_training). 
+
+        The first trial of each population samples all hyperparameters, and 
+        the others are enqueued with its architecture, so that they only 
+        sample the learning rate, momentum and dropout rate. Each member's 
+        val losses are reported to its own trial. 
+
+        Workers that share the study's storage may ask for an enqueued trial 
+        of another worker's population. Members are therefore enqueued and 
+        asked one at a time, and a member whose architecture does not match 
+        the first trial's is told FAIL and asked again (see 
+        ask_population_member). 
+
+        Args:
+            study: study to run the trials in 
+            datasets: dictionary of data, shared by all trials 
+            population_size: number of trials trained at once 
+            n_populations: number of populations to run one after the other 
+            config_fn: function that creates the config of a trial 
+    """
+    for _ in range(n_populations):
+        first_trial = study.ask()
+        config = config_fn(first_trial)
+        architecture = {name: first_trial.params[name] 
+                        for name in ARCHITECTURE_PARAMS 
+                        if name in first_trial.params}
+        trials, trial_configs = [first_trial], [config]
+        for _ in range(population_size - 1):
+            trial, trial_config = ask_population_member(study, architecture, 
+                                                        config_fn)
+            trials.append(trial)
+            trial_configs.append(trial_config)
+
+        member_hparams = {"learning_rate": [c.learning_rate for c in trial_configs], 
+                          "dropout_rate": [c.dropout_rate for c in trial_configs]}
+        if config.optimizer == "sgd":
+            member_hparams["momentum"] = [c.momentum for c in trial_configs]
+
+        pruned = [False] * population_size
+        def report_fn(epoch, val_losses):
+            # the population keeps training, but pruned trials are not 
+            # reported to anymore 
+            for i, (trial, val_loss) in enumerate(zip(trials, val_losses)):
+                if not pruned[i]:
+                    trial.report(value=float(val_loss), step=epoch)
+                    pruned[i] = trial.should_prune()
+
+        _, val_losses = train_population(config, datasets, member_hparams, 
+                                         report_fn=report_fn)
+
+        for trial, val_loss, trial_pruned in zip(trials, val_losses, pruned):
+            if trial_pruned:
+                study.tell(trial, state=optuna.trial.TrialState.PRUNED)
+            elif np.isfinite(val_loss):
+                study.tell(trial, float(val_loss))
+            else:
+                study.tell(trial, state=optuna.trial.TrialState.FAIL)
+
+    return study
+
+
 def get_best_trial_config(study):
     dataset_config = get_data_config()
     best_trial_config = dataset_config
@@ -172,11 +496,15 @@ def get_best_trial_config(study):
     return best_trial_config
 
 def get_best_trial_workdir(study):
-    workdir=os.path.join(CHECKPOINT_PATH, study.study_name, f"trial_{study.best_trial.number}")
-    return workdir
-
-def get_best_trial_workdir(study):
-    workdir=os.path.join(CHECKPOINT_PATH, study.study_name, f"trial_{study.best_trial.number}")
+    """ Returns the workdir of the best trial, as recorded in the study's 
+        trial manifest (see utils.trial_artifacts). """
+    study_dir = get_study_dir(study)
+    best_trial_number = study.best_trial.number
+    workdir = get_trial_artifacts(study_dir).get_workdir(best_trial_number)
+    if workdir is None:
+        raise FileNotFoundError(
+            f'the artifacts of trial {best_trial_number} were not kept in '
+            f'{study_dir}')
     return workdir
 
 def remove_bad_trials(study):
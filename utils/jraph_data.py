@@ -1,3 +1,4 @@
+from utils.compilation import monitor_compiles
 from utils.lorenz import DATA_DIRECTORY_PATH, run_download_lorenz96_2coupled, load_lorenz96_2coupled, get_window_indices, normalize_lorenz96_2coupled
 
 import jraph
@@ -32,7 +33,8 @@ def get_lorenz_graph_tuples(n_samples,
                             h=1,
                             seed=42,
                             normalize=False,
-                            fully_connected_edges=True):
+                            fully_connected_edges=True,
+                            return_norm_stats=False):
     """ Generated data using Lorenz96 and splits data into train/val/test. 
 
         Args: 
@@ -74,6 +76,8 @@ def get_lorenz_graph_tuples(n_samples,
                 or original 1-layer Lorenz96 model
             seed (int): for reproducibility 
             normalize (bool): whether or not to normalize the data.
+            return_norm_stats (bool): whether to also return the normalization 
+                statistics (None if normalize is False).
             # data_path (str): optional file path. if None, will iterate over all existing simulation data to find a valid dataset with compatible parameters, or generate new simulation data if it cannot find any (using a default generated data path). if a path is given, then the simulation data will be checked to see if it exists is compatible; if it doesn't exist, it will generate new simulation data at that path; if it exists but was incompatible, an error will be raised. 
 
         Output:
@@ -182,12 +186,18 @@ def get_lorenz_graph_tuples(n_samples,
     # type: Dict[str, Dict[str, List[List[jraph.GraphsTuple]]]]
     
     # normalize data 
+    norm_stats = None
     if normalize:
-        graph_tuple_dict = normalize_lorenz96_2coupled(graph_tuple_dict)
+        graph_tuple_dict, norm_stats = normalize_lorenz96_2coupled(
+            graph_tuple_dict, return_stats=True)
+
+    if return_norm_stats:
+        return graph_tuple_dict, norm_stats
 
     return graph_tuple_dict
 
 
+@monitor_compiles
 @partial(jax.jit, static_argnames=["K", "fully_connected_edges"])
 def timestep_to_graphstuple(data, K, fully_connected_edges):
     """ Converts an array of state values at a single timestep to a GraphsTuple 
@@ -283,6 +293,16 @@ def timestep_to_graphstuple(data, K, fully_connected_edges):
         n_edge=jnp.array([n_edges]))
 
 
+def stack_windows(windows: List[List[jraph.GraphsTuple]]) -> List[jraph.GraphsTuple]:
+    """ Stacks a list of windows into a single window of graphs, whose arrays 
+        have a leading axis indexing the original windows. 
+
+        All windows must have the same structure (number of graphs, nodes and 
+        edges), as is the case for the windows of a single dataset. 
+    """
+    return jax.tree_util.tree_map(lambda *xs: jnp.stack(xs), *windows)
+
+
 def print_graph_fts(graph: jraph.GraphsTuple):
     print(f'Number of nodes: {graph.n_node[0]}')
     print(f'Number of edges: {graph.n_edge[0]}')
@@ -21,30 +21,63 @@ def add_graphs_tuples_nodes(
   )
 
 
+class Dropout(nn.Dropout):
+    """ nn.Dropout whose rate may also be an array, e.g. a traced 
+        hyperparameter that is passed at runtime (so that models that only 
+        differ in their dropout rate share one compiled executable, or are 
+        vmapped over). Python float rates behave exactly like nn.Dropout. 
+    """
+
+    @nn.compact
+    def __call__(self, inputs, deterministic: Optional[bool] = None, 
+                 rng: Optional[jnp.ndarray] = None):
+        if isinstance(self.rate, (int, float)):
+            return super().__call__(inputs, deterministic, rng)
+
+        deterministic = nn.merge_param(
+            'deterministic', self.deterministic, deterministic)
+        if deterministic:
+            return inputs
+        keep_prob = 1. - jnp.asarray(self.rate, inputs.dtype)
+        if rng is None:
+            rng = self.make_rng(self.rng_collection)
+        mask = jax.random.bernoulli(rng, p=keep_prob, shape=inputs.shape)
+        # avoid dividing by 0 (and nan gradients) at a rate of 1 
+        return jnp.where(mask, inputs / jnp.maximum(keep_prob, 1e-6), 0)
+
+
 class MLP(nn.Module):
     """ A multi-layer perceptron.
     
         Copied from Flax example models. Note that dropout is deactivated if deterministic is True. 
+
+        The Dense layers compute in dtype and store their params in 
+        param_dtype, e.g. dtype=jnp.bfloat16 with param_dtype=jnp.float32 
+        gives bf16 matmuls with fp32 master weights.
     """
 
     feature_sizes: Sequence[int]
     dropout_rate: float = 0
     deterministic: bool = True
     activation: Callable[[jnp.ndarray], jnp.ndarray] = nn.relu
+    dtype: Any = jnp.float32 # dtype of the computation
+    param_dtype: Any = jnp.float32 # dtype of the stored params
 
     @nn.compact
     def __call__(self, inputs):
         x = inputs
         for size in self.feature_sizes[:-1]:
-            x = nn.Dense(features=size)(x)
+            x = nn.Dense(features=size, dtype=self.dtype, 
+                         param_dtype=self.param_dtype)(x)
             x = self.activation(x)
-            x = nn.Dropout(rate=self.dropout_rate, 
-                           deterministic=self.deterministic)(x)
+            x = Dropout(rate=self.dropout_rate, 
+                        deterministic=self.deterministic)(x)
         
         # we don't want an activation function like relu on the last layer 
-        x = nn.Dense(features=self.feature_sizes[-1])(x)
-        x = nn.Dropout(rate=self.dropout_rate, 
-                        deterministic=self.deterministic)(x)
+        x = nn.Dense(features=self.feature_sizes[-1], dtype=self.dtype, 
+                     param_dtype=self.param_dtype)(x)
+        x = Dropout(rate=self.dropout_rate, 
+                    deterministic=self.deterministic)(x)
 
         return x
 
@@ -63,6 +96,8 @@ class MLPBlock(nn.Module):
     edge_features: Sequence[int] = (4, 8) 
     node_features: Sequence[int] = (32, 2) # the last feature size will be the number of features that the graph predicts
     global_features: Sequence[int] = None
+    dtype: Any = jnp.float32 # compute dtype of the MLPs
+    param_dtype: Any = jnp.float32
     
 
     @nn.compact
@@ -80,6 +115,8 @@ class MLPBlock(nn.Module):
                     dropout_rate=self.dropout_rate,
                     deterministic=self.deterministic,
                     activation=self.activation,
+                    dtype=self.dtype,
+                    param_dtype=self.param_dtype,
                 )
             )
         else:
@@ -92,6 +129,8 @@ class MLPBlock(nn.Module):
                     dropout_rate=self.dropout_rate,
                     deterministic=self.deterministic,
                     activation=self.activation,
+                    dtype=self.dtype,
+                    param_dtype=self.param_dtype,
                 )
             )
         else:
@@ -104,6 +143,8 @@ class MLPBlock(nn.Module):
                     dropout_rate=self.dropout_rate,
                     deterministic=self.deterministic,
                     activation=self.activation,
+                    dtype=self.dtype,
+                    param_dtype=self.param_dtype,
                 )
             )
         else:
@@ -122,15 +163,22 @@ class MLPBlock(nn.Module):
         # we want the edges to be encoded/processed by the update_edge_fn internally as part of the processing for the node features, but we only use the encoded edges internally and don't want it to affect the actual graph structure of the data because we know that it is fixed 
         processed_graphs = processed_graphs._replace(edges=input_graph.edges)
 
+        # cast the outputs back to the dtype of the data, so that a reduced 
+        # precision compute dtype does not leak into the rollout or the loss
+        processed_graphs = processed_graphs._replace(
+            nodes=processed_graphs.nodes.astype(input_graph.nodes.dtype),
+            globals=processed_graphs.globals.astype(input_graph.globals.dtype),
+        )
+
         if self.skip_connections:
             processed_graphs = add_graphs_tuples_nodes(processed_graphs, input_graph)
 
         if self.layer_norm:
             # TODO: why does layernorm cause the edge features to all be 0? 
             processed_graphs = processed_graphs._replace(
-                nodes=nn.LayerNorm()(processed_graphs.nodes),
-                edges=nn.LayerNorm()(processed_graphs.edges),
-                globals=nn.LayerNorm()(processed_graphs.globals),
+                nodes=nn.LayerNorm(param_dtype=self.param_dtype)(processed_graphs.nodes),
+                edges=nn.LayerNorm(param_dtype=self.param_dtype)(processed_graphs.edges),
+                globals=nn.LayerNorm(param_dtype=self.param_dtype)(processed_graphs.globals),
             )
 
         
@@ -152,6 +200,8 @@ class MLPGraphNetwork(nn.Module):
     edge_features: Sequence[int] = (4, 8) # the last feature size will be the number of features that the graph predicts
     node_features: Sequence[int] = (32, 2)
     global_features: Sequence[int] = None
+    dtype: Any = jnp.float32 # compute dtype of the MLPs
+    param_dtype: Any = jnp.float32
 
     @nn.compact
     def __call__(
@@ -175,6 +225,8 @@ class MLPGraphNetwork(nn.Module):
                 node_features=self.node_features,      
                 global_features=self.global_features,   
                 activation=self.activation,   
+                dtype=self.dtype,
+                param_dtype=self.param_dtype,
             )
             for _ in range(self.n_blocks):
                 blocks.append(shared_block)
@@ -189,6 +241,8 @@ class MLPGraphNetwork(nn.Module):
                     node_features=self.node_features,      
                     global_features=self.global_features,      
                     activation=self.activation,   
+                    dtype=self.dtype,
+                    param_dtype=self.param_dtype,
                 ))
                 # TODO: check that this create distinct blocks with unshared params
 
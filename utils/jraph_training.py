@@ -14,6 +14,7 @@
 
 """Library file for executing training and evaluation on ogbg-molpcba."""
 
+import functools
 import os
 from typing import Any, Dict, Iterable, Tuple, Optional, Callable
 
@@ -31,14 +32,23 @@ import jax
 import jax.numpy as jnp
 import jraph
 import ml_collections
-# import numpy as np
+import numpy as np
 import optax
 import optuna 
 import pdb 
 
 # from . import input_pipeline
 from utils.jraph_models import MLPBlock, MLPGraphNetwork
-from utils.jraph_data import get_lorenz_graph_tuples, print_graph_fts
+from utils.jraph_data import get_lorenz_graph_tuples, print_graph_fts, stack_windows
+from utils.eval_metrics import LeadTimeErrors, SufficientStats, compute_suite
+from utils.compilation import (setup_compilation_cache, log_compilation_cache_stats, 
+                               monitor_compiles, recompilation_limit)
+from utils.checkpointing import AsyncCheckpointer
+from utils.timing import TrainingTimer
+from utils.data_loader import (PrefetchLoader, get_epoch_order, 
+                               get_subset_fraction, get_subset_indices)
+from utils.distributed import (initialize_distributed, is_main_process, 
+                               shard_windows, to_global, to_local)
 
 def create_model(
     config: ml_collections.ConfigDict, deterministic: bool
@@ -51,6 +61,22 @@ def create_model(
     }
     activation = activation_funcs[config.activation]
 
+    # compute and param dtypes, e.g. bfloat16 compute with float32 params for 
+    # mixed precision. bfloat16 has the same exponent range as float32, so no 
+    # loss scaling is needed.
+    dtypes = {
+        "float32": jnp.float32,
+        "bfloat16": jnp.bfloat16,
+    }
+    if "compute_dtype" in config._fields.keys():
+        compute_dtype = dtypes[config.compute_dtype]
+    else:
+        compute_dtype = jnp.float32
+    if "param_dtype" in config._fields.keys():
+        param_dtype = dtypes[config.param_dtype]
+    else:
+        param_dtype = jnp.float32
+
     if config.model == 'MLPBlock':
         return MLPBlock(
             dropout_rate=config.dropout_rate,
@@ -61,6 +87,8 @@ def create_model(
             edge_features=config.edge_features,
             node_features=config.node_features,
             global_features=config.global_features,
+            dtype=compute_dtype,
+            param_dtype=param_dtype,
         )
     elif config.model == 'MLPGraphNetwork':
         return MLPGraphNetwork(
@@ -74,6 +102,8 @@ def create_model(
             edge_features=config.edge_features,
             node_features=config.node_features,
             global_features=config.global_features,
+            dtype=compute_dtype,
+            param_dtype=param_dtype,
         )
 
     raise ValueError(f'Unsupported model: {config.model}.')
@@ -81,18 +111,111 @@ def create_model(
 
 def create_optimizer(
     config: ml_collections.ConfigDict,
+    inject_hyperparams: bool = False,
 ) -> optax.GradientTransformation:
-    """Creates an optimizer, as specified by the config."""
+    """Creates an optimizer, as specified by the config.
+    
+    If inject_hyperparams, the learning rate (and momentum) are kept in the 
+    optimizer state (see optax.inject_hyperparams) rather than baked into the 
+    update function, so that they can be changed at runtime, e.g. differ 
+    between the members of a vmapped population.
+    """
     if config.optimizer == 'adam':
-        return optax.adam(learning_rate=config.learning_rate)
+        adam = optax.inject_hyperparams(optax.adam) if inject_hyperparams else optax.adam
+        return adam(learning_rate=config.learning_rate)
     if config.optimizer == 'sgd':
-        return optax.sgd(
+        sgd = optax.inject_hyperparams(optax.sgd) if inject_hyperparams else optax.sgd
+        return sgd(
             learning_rate=config.learning_rate, momentum=config.momentum
         )
     raise ValueError(f'Unsupported optimizer: {config.optimizer}.')
 
+
+class ModelApply:
+    """ apply_fn of a model whose dropout rate is given at runtime, e.g. 
+        apply_fn(variables, inputs, dropout_rate=0.1, rngs=rngs). 
+
+        jax.jit caches compiled programs by their static arguments, which 
+        include the apply_fn (and tx) of a train state. A model's usual 
+        net.apply is a new object every time, so every new train state 
+        recompiles train_step. ModelApply objects are equal whenever their 
+        models have the same architecture (the dropout rate is left out), so 
+        train states of models that only differ in their dropout rate or 
+        learning rate reuse the same compiled programs, for the same input 
+        shapes (see get_model_apply and get_cached_optimizer). 
+    """
+
+    def __init__(self, net: nn.Module):
+        # the placeholder rate is never used, since every call passes one 
+        self.net = net.clone(dropout_rate=0.)
+
+    def __call__(self, variables, *args, dropout_rate=None, **kwargs):
+        if dropout_rate is None:
+            assert self.net.deterministic, \
+                'the dropout rate must be given to a non-deterministic model'
+            return self.net.apply(variables, *args, **kwargs)
+        return self.net.clone(dropout_rate=dropout_rate).apply(
+            variables, *args, **kwargs)
+
+    def __eq__(self, other):
+        return isinstance(other, ModelApply) and self.net == other.net
+
+    def __hash__(self):
+        return hash(self.net)
+
+
+_model_apply_cache = {}
+_optimizer_cache = {}
+
+
+@functools.partial(jax.jit, static_argnums=0)
+def init_cached_model(net: nn.Module, rng: jnp.ndarray, 
+                      sample_input_window: Iterable[jraph.GraphsTuple]):
+    """ net.init, compiled once per architecture (call it with the net of a 
+        ModelApply). """
+    return net.init(rng, sample_input_window)
+
+
+def get_model_apply(config: ml_collections.ConfigDict, deterministic: bool
+                    ) -> ModelApply:
+    """ Returns the ModelApply of the model of the config. The same object is 
+        returned for every config with the same architecture. """
+    model_apply = ModelApply(create_model(config, deterministic))
+    return _model_apply_cache.setdefault(model_apply, model_apply)
+
+
+def get_cached_optimizer(config: ml_collections.ConfigDict
+                         ) -> optax.GradientTransformation:
+    """ Returns an optimizer whose learning rate (and momentum) are kept in 
+        its state (see create_optimizer), shared by every config with the 
+        same optimizer. Its state must be created with 
+        init_cached_optimizer_state, which sets the config's values. """
+    # a momentum of None is compiled in rather than kept in the state 
+    key = (config.optimizer, 
+           config.optimizer == 'sgd' and config.momentum is None)
+    if key not in _optimizer_cache:
+        _optimizer_cache[key] = create_optimizer(config, 
+                                                 inject_hyperparams=True)
+    return _optimizer_cache[key]
+
+
+def init_cached_optimizer_state(config: ml_collections.ConfigDict, 
+                                tx: optax.GradientTransformation, 
+                                params: Any) -> optax.OptState:
+    """ Initializes the state of a cached optimizer with the hyperparameters 
+        of the config. """
+    opt_state = tx.init(params)
+    hyperparams = dict(opt_state.hyperparams)
+    for name in ('learning_rate', 'momentum'):
+        if name in hyperparams:
+            hyperparams[name] = jnp.asarray(config[name], 
+                                            hyperparams[name].dtype)
+    return opt_state._replace(hyperparams=hyperparams)
+
+
 def create_dataset(    
     config: ml_collections.ConfigDict,
+    return_norm_stats: bool = False,
 ) -> Dict[str, Dict[str, Iterable[jraph.GraphsTuple]]]:
     dataset = get_lorenz_graph_tuples(
         n_samples=config.n_samples,
@@ -113,11 +236,85 @@ def create_dataset(
         h=config.h,
         seed=config.seed,
         normalize=config.normalize,
-        fully_connected_edges=config.fully_connected_edges)
+        fully_connected_edges=config.fully_connected_edges,
+        return_norm_stats=return_norm_stats)
 
     return dataset
 
 
+class ResumableTrainState(train_state.TrainState):
+    """ TrainState that also records where training stopped, so that a run 
+        resumes from its latest checkpoint exactly where that checkpoint was 
+        saved, even in the middle of an epoch. The order of the windows of 
+        each epoch is derived from (seed, epoch) (see get_epoch_order). 
+
+        Attributes:
+            rng: key data of the rng that the dropout rng of each step is 
+                derived from (with jax.random.fold_in) 
+            epoch: epoch that training continues in (0-indexed) 
+            epoch_step: number of steps of that epoch that are already done 
+    """
+    rng: jnp.ndarray
+    epoch: jnp.ndarray
+    epoch_step: jnp.ndarray
+
+    @classmethod
+    def create(cls, *, apply_fn, params, tx, **kwargs):
+        """ Creates a state whose step is an int32 array from the start. 
+            TrainState.create starts from a (weakly typed) python int, so 
+            train_step would compile again after the first step. """
+        state = super().create(apply_fn=apply_fn, params=params, tx=tx, 
+                               **kwargs)
+        return state.replace(step=jnp.asarray(0, jnp.int32))
+
+
+def restore_eval_state(
+    config: ml_collections.ConfigDict,
+    workdir: str,
+    sample_input_window: Iterable[jraph.GraphsTuple],
+) -> train_state.TrainState:
+    """ Restores the latest checkpoint in workdir into a train state with a 
+        deterministic model, for evaluation and inference.
+
+        Args:
+            config: config that the checkpointed model was trained with
+            workdir: training workdir containing the checkpoints directory
+            sample_input_window: window of graphs used to initialize the params
+    """
+    checkpoint_dir = os.path.join(workdir, 'checkpoints')
+    assert os.path.exists(checkpoint_dir), checkpoint_dir
+
+    logging.info('Initializing network.')
+    rng = jax.random.key(0)
+    rng, init_rng = jax.random.split(rng)
+    eval_net = create_model(config, deterministic=True)
+    params = jax.jit(eval_net.init)(init_rng, sample_input_window)
+    parameter_overview.log_parameter_overview(params) # logs to logging.info
+
+    # Create the optimizer and state.
+    # (we don't actually need the optimizer for evaluation, we just need it to create the state)
+    # models trained with cache_executables keep their hyperparams in the 
+    # optimizer state 
+    if "cache_executables" in config._fields.keys() and config.cache_executables:
+        tx = create_optimizer(config, inject_hyperparams=True)
+    else:
+        tx = create_optimizer(config)
+    state = train_state.TrainState.create(
+        apply_fn=eval_net.apply, params=params, tx=tx
+    )
+
+    # load the checkpoint state (restore latest checkpoint). checkpoints of 
+    # training runs have additional fields (see ResumableTrainState), which 
+    # are not needed for evaluation 
+    ckpt = checkpoint.Checkpoint(checkpoint_dir)
+    state_dict = ckpt.restore_dict()
+    state_fields = flax.serialization.to_state_dict(state).keys()
+    state = flax.serialization.from_state_dict(
+        state, {k: v for k, v in state_dict.items() if k in state_fields})
+
+    return state
+
+
 # def unbatch_i(batched_graph, i):
 #    """ Retrieve the ith graph in a batched graphtuple. This helper function is jittable and replaced the jraph.unbatch function, which cannot be jitted. """
 #    n_graphs = batched_graph.n_edge.shape[0]
@@ -288,6 +485,40 @@ def rollout(state: train_state.TrainState,
 
     return pred_nodes # list of jnp arrays of size (36, 2)
 
+def rollout_scan(state: train_state.TrainState, 
+                 input_window_graphs: Iterable[jraph.GraphsTuple],
+                 n_rollout_steps: int,
+                 rngs: Optional[Dict[str, jnp.ndarray]] = None,
+                 ) -> Tuple[Iterable[jraph.GraphsTuple], jnp.ndarray]:
+    """ Computes rollout predictions like rollout, but as a lax.scan, so that 
+        the compile time does not grow with n_rollout_steps. 
+
+        If rngs are given, they are folded with the step index, so that each 
+        step draws different randomness (e.g. dropout masks). 
+
+        Returns the window of graphs after the last step (to continue the 
+        rollout from) and the predicted nodes, with shape 
+        (n_rollout_steps, K, 2). 
+    """
+    assert n_rollout_steps > 0
+
+    def step_fn(curr_input_window_graphs, i):
+        if rngs is None:
+            step_rngs = None
+        else:
+            step_rngs = {name: jax.random.fold_in(rng, i) 
+                         for name, rng in rngs.items()}
+        pred_graphs_list = state.apply_fn(state.params, curr_input_window_graphs, rngs=step_rngs) 
+        pred_graph = pred_graphs_list[0]
+
+        # retrieve the new input window 
+        curr_input_window_graphs = list(curr_input_window_graphs[1:]) + [pred_graph]
+        return curr_input_window_graphs, pred_graph.nodes
+
+    final_window_graphs, pred_nodes = jax.lax.scan(
+        step_fn, list(input_window_graphs), jnp.arange(n_rollout_steps))
+    return final_window_graphs, pred_nodes
+
 # TODO this is currently malfunctioning 
 # rollout_loss_batched = jax.vmap(rollout_loss, in_axes=[None, 1, 1, None])
 # batch over the params input_window_graph and target_window_graph but not 
@@ -303,20 +534,14 @@ class EvalMetrics(metrics.Collection):
 
 @flax.struct.dataclass
 class EvalMetricsSuite(metrics.Collection):
-    mse: metrics.Average.from_output('mse')
-    mb: metrics.Average.from_output('mb')
-    me: metrics.Average.from_output('me')
-    rmse: metrics.Average.from_output('rmse')
-    crmse: metrics.Average.from_output('crmse')
-    ##
-    fb: metrics.Average.from_output('fb')
-    fe: metrics.Average.from_output('fe')
-    r: metrics.Average.from_output('r')
-    r2: metrics.Average.from_output('r2')
-    d: metrics.Average.from_output('d')
-    # the loss value is passed in as a named param. it can be either single step 
-    # or rollout loss, and is chosen in the training step, so we do not need to 
-    # specify it here. 
+    # the metrics are all derived from the same sufficient statistics, which 
+    # are summed when merging, so the metrics are computed over all values of 
+    # the merged windows (see utils.eval_metrics). the statistics are kept 
+    # once, and the whole suite is derived from them in a single compute 
+    stats: SufficientStats
+
+    def compute(self) -> Dict[str, jnp.ndarray]:
+        return compute_suite(self.stats)
 
 @flax.struct.dataclass
 class TrainMetrics(metrics.Collection):
@@ -334,6 +559,7 @@ def train_step_fn(
     # batch_input_graphs: Iterable[jraph.GraphsTuple], 
     # batch_target_graphs: Iterable[Iterable[jraph.GraphsTuple]], 
     rngs: Dict[str, jnp.ndarray],
+    dropout_rate: Optional[jnp.ndarray] = None,
 ) -> Tuple[train_state.TrainState, metrics.Collection, jnp.ndarray]:
     """ Performs one update step over the current batch of graphs.
     
@@ -351,12 +577,17 @@ def train_step_fn(
         #     NOTE: the number of output graphs in this GraphsTuple object 
         #     indicates the number of rollout steps that should be performed
         rngs (dict): rngs where the key of the dict denotes the rng use 
+        dropout_rate: dropout rate for a state whose apply_fn is a ModelApply, 
+            passed at runtime 
     """
     assert n_rollout_steps > 0
     assert len(target_window_graphs) == n_rollout_steps, (len(target_window_graphs), n_rollout_steps)
 
     def loss_fn(params, input_window_graphs, target_window_graphs):
         curr_state = state.replace(params=params) # create a new state object so that we can pass the whole thing into the one_step_loss function. we do this so that we can keep track of the original state's apply_fn() and a custom param together (theoretically the param argument in this function doesn't need to be the same as the default state's param)
+        if dropout_rate is not None:
+            curr_state = curr_state.replace(apply_fn=functools.partial(
+                state.apply_fn, dropout_rate=dropout_rate))
 
         # Compute loss.
         x1_loss, x2_loss, pred_nodes = rollout_loss(
@@ -378,7 +609,179 @@ def train_step_fn(
 
     return state, metrics_update, pred_nodes
 
-train_step = jax.jit(train_step_fn, static_argnames=["n_rollout_steps"])
+train_step = monitor_compiles(
+    jax.jit(train_step_fn, static_argnames=["n_rollout_steps"]), "train_step")
+
+
+def train_step_batch_fn(
+    state: train_state.TrainState,
+    n_rollout_steps: int,
+    input_window_graphs: Iterable[jraph.GraphsTuple],
+    target_window_graphs: Iterable[jraph.GraphsTuple],
+    rngs: Dict[str, jnp.ndarray],
+    dropout_rate: Optional[jnp.ndarray] = None,
+) -> Tuple[train_state.TrainState, metrics.Collection, jnp.ndarray]:
+    """ Performs one update step over a batch of windows, using the average 
+        loss of the windows. 
+
+        If the batch is sharded over several devices (and the state is 
+        replicated), each device computes the loss of its own windows and the 
+        gradients are all-reduced by XLA. 
+    
+        Args: 
+        state (flax train_state.TrainState): TrainState containing the model's 
+            call function, the model's params, and the optimizer 
+        input_window_graphs: batch of input windows, stacked along a leading 
+            axis (see stack_windows) 
+        target_window_graphs: batch of target windows, stacked likewise 
+        rngs (dict): rngs where the key of the dict denotes the rng use. they 
+            are split into one rng per window. 
+        dropout_rate: dropout rate for a state whose apply_fn is a ModelApply, 
+            passed at runtime 
+    """
+    assert n_rollout_steps > 0
+    assert len(target_window_graphs) == n_rollout_steps, (len(target_window_graphs), n_rollout_steps)
+    batch_size = input_window_graphs[0].n_node.shape[0]
+    window_rngs = {name: jax.random.split(rng, batch_size) 
+                   for name, rng in rngs.items()}
+
+    def loss_fn(params, batch_input_graphs, batch_target_graphs):
+        curr_state = state.replace(params=params)
+        if dropout_rate is not None:
+            curr_state = curr_state.replace(apply_fn=functools.partial(
+                state.apply_fn, dropout_rate=dropout_rate))
+
+        def window_loss(input_window_graphs, target_window_graphs, rngs):
+            return rollout_loss(
+                state=curr_state, input_window_graphs=input_window_graphs, 
+                target_window_graphs=target_window_graphs, 
+                n_rollout_steps=n_rollout_steps, rngs=rngs)
+
+        # Compute loss for each window.
+        x1_losses, x2_losses, pred_nodes = jax.vmap(window_loss)(
+            batch_input_graphs, batch_target_graphs, window_rngs)
+        losses = x1_losses + x2_losses
+        loss_metrics = {'loss': losses, 'x1_loss': x1_losses, 'x2_loss': x2_losses}
+        return jnp.mean(losses), (loss_metrics, pred_nodes)
+    
+    grad_fn = jax.value_and_grad(loss_fn, has_aux=True)
+    (_, (loss_metrics, pred_nodes)), grads = grad_fn(
+        state.params, input_window_graphs, target_window_graphs)
+    state = state.apply_gradients(grads=grads) # update params in the state 
+
+    # the per-window losses are averaged over the windows 
+    metrics_update = TrainMetrics.single_from_model_output(**loss_metrics)
+
+    return state, metrics_update, pred_nodes
+
+train_step_batch = monitor_compiles(
+    jax.jit(train_step_batch_fn, static_argnames=["n_rollout_steps"]), 
+    "train_step_batch")
+
+
+def create_data_parallel_mesh(num_devices: Optional[int] = None
+                              ) -> jax.sharding.Mesh:
+    """ Creates a 1D mesh over the first num_devices devices (by default all 
+        of them, including those of other processes in a multi-process run), 
+        whose 'batch' axis the windows of a batch are sharded over. 
+
+        On CPU, several host devices can be exposed by starting python with 
+        XLA_FLAGS=--xla_force_host_platform_device_count=<n>. 
+    """
+    if num_devices is None:
+        num_devices = jax.device_count()
+    assert num_devices <= jax.device_count(), (num_devices, jax.device_count())
+    devices = np.array(jax.devices()[:num_devices])
+    return jax.sharding.Mesh(devices, ('batch',))
+
+
+def train_epoch_fn(
+    state: train_state.TrainState,
+    n_rollout_steps: int,
+    input_windows: Iterable[jraph.GraphsTuple],
+    target_windows: Iterable[jraph.GraphsTuple],
+    rng: jnp.ndarray,
+    dropout_rate: Optional[jnp.ndarray] = None,
+) -> Tuple[train_state.TrainState, metrics.Collection, jnp.ndarray]:
+    """ Performs one update step per window as a single scan, so that a whole 
+        epoch runs on device without returning to the host. 
+
+        Steps with a non-finite loss are skipped (the params and optimizer 
+        state are left unchanged) and are excluded from the metrics. 
+
+        Args: 
+        state (flax train_state.TrainState): TrainState containing the model's 
+            call function, the model's params, and the optimizer 
+        input_windows: stacked input windows, from stack_windows 
+        target_windows: stacked target windows, from stack_windows 
+        rng: key from which the dropout rngs for each step are split 
+        dropout_rate: dropout rate for a state whose apply_fn is a ModelApply 
+
+        Returns: 
+            the updated state, the metrics of the epoch, and the index (within 
+            the epoch) of the first step with a non-finite loss, or -1
+    """
+    def body_fn(carry, windows):
+        state, rng = carry
+        input_window_graphs, target_window_graphs = windows
+        rng, dropout_rng = jax.random.split(rng)
+        new_state, metrics_update, _ = train_step_fn(
+            state=state, 
+            n_rollout_steps=n_rollout_steps, 
+            input_window_graphs=input_window_graphs, 
+            target_window_graphs=target_window_graphs, 
+            rngs={'dropout': dropout_rng},
+            dropout_rate=dropout_rate,
+        )
+        is_finite = jnp.isfinite(metrics_update.loss.total)
+        # skip the update, but still count the step 
+        state = jax.lax.cond(is_finite, 
+                             lambda: new_state, 
+                             lambda: state.replace(step=state.step + 1))
+        step_outputs = (metrics_update.loss.total, 
+                        metrics_update.x1_loss.total, 
+                        metrics_update.x2_loss.total, 
+                        is_finite)
+        return (state, rng), step_outputs
+
+    (state, _), (losses, x1_losses, x2_losses, is_finite) = jax.lax.scan(
+        body_fn, (state, rng), (input_windows, target_windows))
+
+    epoch_metrics = TrainMetrics.single_from_model_output(
+        loss=losses, x1_loss=x1_losses, x2_loss=x2_losses, mask=is_finite)
+    nan_step = jnp.where(jnp.all(is_finite), -1, jnp.argmin(is_finite))
+
+    return state, epoch_metrics, nan_step
+
+train_epoch = monitor_compiles(
+    jax.jit(train_epoch_fn, static_argnames=["n_rollout_steps"]), "train_epoch")
+
+
+@jax.jit
+def flag_nan_step(nan_step: jnp.ndarray, loss: jnp.ndarray, step: int
+                  ) -> jnp.ndarray:
+    """ Records step if the loss is nan and no earlier nan was flagged. 
+    
+        This stays on device, so that nans can be checked for without 
+        blocking on every step (see check_nan_step). 
+    """
+    return jnp.where((nan_step < 0) & jnp.isnan(loss), step, nan_step)
+
+
+def check_nan_step(nan_step: jnp.ndarray, epoch: int,
+                   trial: Optional[optuna.trial.Trial] = None) -> jnp.ndarray:
+    """ Warns (and prunes the trial, if any) if a nan loss was flagged since 
+        the last check. 
+
+        This waits for the flagged steps to finish, so it should only be called 
+        every so often. Returns a cleared flag. 
+    """
+    nan_step = int(nan_step)
+    if nan_step >= 0:
+        logging.warning(f'loss is nan for step {nan_step} (in epoch {epoch})')
+        if trial:
+            raise optuna.TrialPruned()
+    return jnp.array(-1)
 
 
 def evaluate_step_metric_suite_fn(
@@ -386,37 +789,32 @@ def evaluate_step_metric_suite_fn(
     n_rollout_steps: int,
     input_window_graphs: Iterable[jraph.GraphsTuple],
     target_window_graphs: Iterable[jraph.GraphsTuple],
+    target_mean: Optional[jnp.ndarray] = None,
 ) -> Tuple[metrics.Collection, jnp.ndarray]:
-    """Computes metrics over a set of graphs."""
+    """Computes the metric suite over a window of graphs.
 
-    # Get node predictions and loss 
-    metric_avg, pred_nodes = rollout_metric_suite(
-        metric_funcs=[MSE, MB, ME, RMSE, CRMSE, FB, FE, R, R2, D], 
-        state=state, 
-        input_window_graphs=input_window_graphs, 
-        target_window_graphs=target_window_graphs, 
-        n_rollout_steps=n_rollout_steps, rngs=None,
-        )
+    Args: 
+        target_mean: mean of the targets of the whole split, which the index 
+            of agreement (d) is measured against. defaults to the mean of this 
+            window's targets, in which case d is only exact for this window. 
+    """
+    pred_nodes = rollout(state=state, 
+                         input_window_graphs=input_window_graphs, 
+                         n_rollout_steps=n_rollout_steps, rngs=None)
+    assert len(target_window_graphs) == n_rollout_steps, (len(target_window_graphs), n_rollout_steps)
 
+    # one pass over all rollout steps, nodes and features 
     eval_metrics_dict = EvalMetricsSuite.single_from_model_output(
-        mse = metric_avg["mse"],
-        mb = metric_avg["mb"],
-        me = metric_avg["me"],
-        rmse = metric_avg["rmse"],
-        crmse = metric_avg["crmse"],
-        #nmb = metric_avg["nmb"],
-        #nme = metric_avg["nme"],
-        fb = metric_avg["fb"],
-        fe = metric_avg["fe"],
-        r = metric_avg["r"],
-        r2 = metric_avg["r2"],
-        d = metric_avg["d"],
-        #pearson = metric_avg["pearson"],
-    ) 
+        preds=jnp.stack(pred_nodes), 
+        targets=jnp.stack([graph.nodes for graph in target_window_graphs]), 
+        target_mean=target_mean,
+    )
 
     return eval_metrics_dict, pred_nodes
 
-evaluate_step_metric_suite = jax.jit(evaluate_step_metric_suite_fn, static_argnames=["n_rollout_steps"])
+evaluate_step_metric_suite = monitor_compiles(
+    jax.jit(evaluate_step_metric_suite_fn, static_argnames=["n_rollout_steps"]), 
+    "evaluate_step_metric_suite")
 
 def evaluate_step_fn(
     state: train_state.TrainState,
@@ -438,7 +836,117 @@ def evaluate_step_fn(
 
     return eval_metrics, pred_nodes
 
-evaluate_step = jax.jit(evaluate_step_fn, static_argnames=["n_rollout_steps"])
+evaluate_step = monitor_compiles(
+    jax.jit(evaluate_step_fn, static_argnames=["n_rollout_steps"]), "evaluate_step")
+
+DEFAULT_EVAL_BATCH_SIZE = 128
+
+
+def stack_eval_split(
+    input_data: Iterable[Iterable[jraph.GraphsTuple]],
+    target_data: Iterable[Iterable[jraph.GraphsTuple]],
+    batch_size: int = DEFAULT_EVAL_BATCH_SIZE,
+) -> Tuple[Iterable[jraph.GraphsTuple], Iterable[jraph.GraphsTuple], jnp.ndarray]:
+    """ Stacks the windows of a split into batches for evaluate_split. 
+
+        The arrays of the returned windows have two leading axes, 
+        (n_batches, batch_size). The last batch is padded with copies of the 
+        first window, which are masked out by the returned mask. 
+    """
+    n_windows = len(input_data)
+    assert n_windows == len(target_data) and n_windows > 0
+    batch_size = min(batch_size, n_windows)
+    n_batches = -(-n_windows // batch_size) # ceil 
+    n_padding = n_batches * batch_size - n_windows
+
+    def to_batches(windows):
+        padded_windows = list(windows) + [windows[0]] * n_padding
+        return jax.tree_util.tree_map(
+            lambda x: x.reshape((n_batches, batch_size) + x.shape[1:]), 
+            stack_windows(padded_windows))
+
+    mask = jnp.arange(n_batches * batch_size) < n_windows
+    return (to_batches(input_data), to_batches(target_data), 
+            mask.reshape((n_batches, batch_size)))
+
+
+def evaluate_split_fn(
+    state: train_state.TrainState,
+    n_rollout_steps: int,
+    input_windows: Iterable[jraph.GraphsTuple],
+    target_windows: Iterable[jraph.GraphsTuple],
+    mask: jnp.ndarray,
+    all_metrics: bool = False,
+    return_error_tensors: bool = False,
+) -> metrics.Collection:
+    """ Computes the metrics of a whole split, stacked with stack_eval_split. 
+
+        The windows of each batch are evaluated at once (vmapped), and the 
+        batches are scanned over, with the metrics reduced on device. 
+
+        If return_error_tensors, also returns the LeadTimeErrors of the split, 
+        i.e. the errors accumulated per (rollout step, node, feature). 
+    """
+    if all_metrics:
+        # the mean of all (unpadded) targets of the split, for d 
+        target_nodes = jnp.stack([graph.nodes for graph in target_windows], 
+                                 axis=2) # (n_batches, batch_size, steps, K, 2)
+        n_values = jnp.sum(mask) * np.prod(target_nodes.shape[2:])
+        target_mean = jnp.sum(jnp.where(
+            mask[..., None, None, None], target_nodes, 0)) / n_values
+        eval_step_fn = functools.partial(evaluate_step_metric_suite_fn, 
+                                         target_mean=target_mean)
+    else:
+        eval_step_fn = evaluate_step_fn
+
+    def window_metrics(input_window_graphs, target_window_graphs):
+        window_metrics, pred_nodes = eval_step_fn(
+            state=state, 
+            n_rollout_steps=n_rollout_steps, 
+            input_window_graphs=input_window_graphs, 
+            target_window_graphs=target_window_graphs)
+        if not return_error_tensors:
+            return window_metrics
+        window_errors = LeadTimeErrors.from_model_output(
+            preds=jnp.stack(pred_nodes), 
+            targets=jnp.stack([graph.nodes for graph in target_window_graphs]))
+        return window_metrics, window_errors
+
+    def masked_sum(x, batch_mask):
+        batch_mask = batch_mask.reshape(batch_mask.shape + (1,) * (x.ndim - 1))
+        return jnp.sum(jnp.where(batch_mask, x, 0), axis=0)
+
+    def batch_fn(split_metrics, batch):
+        input_window_graphs, target_window_graphs, batch_mask = batch
+        batch_metrics = jax.vmap(window_metrics)(
+            input_window_graphs, target_window_graphs)
+        # sum the (total, count) of the unpadded windows 
+        batch_metrics = jax.tree_util.tree_map(
+            lambda x: masked_sum(x, batch_mask), batch_metrics)
+        if return_error_tensors:
+            split_metrics = tuple(split_metric.merge(batch_metric) for 
+                split_metric, batch_metric in zip(split_metrics, batch_metrics))
+        else:
+            split_metrics = split_metrics.merge(batch_metrics)
+        return split_metrics, None
+
+    # start from zero totals and counts 
+    first_window = jax.tree_util.tree_map(
+        lambda x: x[0, 0], (input_windows, target_windows))
+    init_metrics = jax.tree_util.tree_map(
+        lambda x: jnp.zeros(x.shape, x.dtype), 
+        jax.eval_shape(window_metrics, *first_window))
+
+    split_metrics, _ = jax.lax.scan(
+        batch_fn, init_metrics, (input_windows, target_windows, mask))
+    return split_metrics
+
+evaluate_split = monitor_compiles(
+    jax.jit(evaluate_split_fn, 
+            static_argnames=["n_rollout_steps", "all_metrics", 
+                             "return_error_tensors"]), 
+    "evaluate_split")
+
 
 def evaluate_model(
     state: train_state.TrainState,
@@ -447,44 +955,62 @@ def evaluate_model(
     # first key = train/test/val, second key = input/target 
     splits: Iterable[str], # e.g. ["val", "test"],
     all_metrics: bool = False,
+    batch_size: int = DEFAULT_EVAL_BATCH_SIZE,
+    stacked_splits: Optional[Dict[str, Tuple]] = None,
+    return_error_tensors: bool = False,
 ) -> Dict[str, metrics.Collection]:
-    """Evaluates the model on metrics over the specified splits (i.e. modes)."""
+    """Evaluates the model on metrics over the specified splits (i.e. modes).
+
+    Each split is evaluated with a single call of evaluate_split, in batches of 
+    batch_size windows. 
 
-    # Loop over each split independently.
+    Args: 
+        stacked_splits: optional outputs of stack_eval_split, by split, so that 
+            the windows are not stacked again at every evaluation 
+        return_error_tensors: if True, also returns a dict with the 
+            LeadTimeErrors of each split, whose compute() gives the mse and 
+            bias per (rollout step, node, feature) 
+    """
     eval_metrics_dict = {}
+    error_tensors_dict = {}
     for split in splits:
         # splits = e.g. 'val', 'test
-        split_metrics = None
-
-        input_data = datasets[split]['inputs']
-        target_data = datasets[split]['targets']
-
-        if all_metrics:
-            eval_fn = evaluate_step_metric_suite
-        else: # just MSE 
-            eval_fn = evaluate_step
-
-        # loop over individual windows in the dataset 
-        for (input_window_graphs, target_window_graphs) in zip(
-            input_data, target_data):
-            split_metrics_update, _ = eval_fn(
-                state=state, 
-                n_rollout_steps=n_rollout_steps, 
-                input_window_graphs=input_window_graphs, 
-                target_window_graphs=target_window_graphs,
-                )
-
-            # Update metrics.
-            if split_metrics is None:
-                split_metrics = split_metrics_update
-            else:
-                split_metrics = split_metrics.merge(split_metrics_update)
-        
-        eval_metrics_dict[split] = split_metrics
+        if stacked_splits is not None and split in stacked_splits:
+            input_windows, target_windows, mask = stacked_splits[split]
+        else:
+            input_windows, target_windows, mask = stack_eval_split(
+                datasets[split]['inputs'], datasets[split]['targets'], 
+                batch_size)
+
+        split_outputs = evaluate_split(
+            state=state, 
+            n_rollout_steps=n_rollout_steps, 
+            input_windows=input_windows, 
+            target_windows=target_windows, 
+            mask=mask,
+            all_metrics=all_metrics,
+            return_error_tensors=return_error_tensors,
+        )
+        if return_error_tensors:
+            eval_metrics_dict[split], error_tensors_dict[split] = split_outputs
+        else:
+            eval_metrics_dict[split] = split_outputs
 
+    if return_error_tensors:
+        return eval_metrics_dict, error_tensors_dict
     return eval_metrics_dict  # pytype: disable=bad-return-type
 
 
+def save_error_tensors(error_tensors_dict: Dict[str, LeadTimeErrors], 
+                       error_dir: str, epoch: int):
+    """ Saves the mse and bias tensors of each split to 
+        error_dir/{split}_epoch_{epoch}.npz. """
+    os.makedirs(error_dir, exist_ok=True)
+    for split, errors in error_tensors_dict.items():
+        np.savez(os.path.join(error_dir, f'{split}_epoch_{epoch}.npz'), 
+                 **jax.device_get(errors.compute()))
+
+
 def add_prefix_to_keys(result: Dict[str, Any], prefix: str) -> Dict[str, Any]:
     """ Adds a prefix to the keys of a dict, returning a new dict.
     
@@ -501,6 +1027,9 @@ def train_and_evaluate(
             trial: Optuna trial object, if we are running hyperparmeter tuning 
                 and want early pruning
     """
+    # Join the other processes before jax runs anything, if configured.
+    initialize_distributed(config)
+
     # Get datsets. 
     logging.info('Obtaining datasets.')
     datasets = create_dataset(config)
@@ -509,6 +1038,48 @@ def train_and_evaluate(
         config=config, workdir=workdir, datasets=datasets, trial=trial)
  
 
+def with_position(state: ResumableTrainState, epoch: int, epoch_step: int
+                  ) -> ResumableTrainState:
+    """ Returns state, recording that training continues from step 
+        epoch_step of epoch, e.g. to save it in a checkpoint. """
+    return state.replace(epoch=jnp.asarray(epoch, jnp.int32), 
+                         epoch_step=jnp.asarray(epoch_step, jnp.int32))
+
+
+def restore_or_initialize_train_state(
+    ckpt: checkpoint.Checkpoint, 
+    state: ResumableTrainState, 
+    epoch_start_steps: np.ndarray,
+) -> ResumableTrainState:
+    """ Restores the latest checkpoint into state, or saves state as the first 
+        checkpoint (as ckpt.restore_or_initialize). 
+
+        Checkpoints of plain TrainStates, written before ResumableTrainState, 
+        do not have the rng and position fields. They are restored into state, 
+        which keeps its initial rng, and the position is derived from their 
+        step with epoch_start_steps (the first step of each epoch). 
+    """
+    latest_checkpoint = ckpt.get_latest_checkpoint_to_restore_from()
+    if not latest_checkpoint:
+        return ckpt.restore_or_initialize(state)
+    state_dict = ckpt.restore_dict(latest_checkpoint)
+    state_fields = flax.serialization.to_state_dict(state)
+    missing_fields = set(state_fields) - set(state_dict)
+    if not missing_fields:
+        return flax.serialization.from_state_dict(state, state_dict)
+
+    assert missing_fields == {"rng", "epoch", "epoch_step"}, missing_fields
+    logging.warning(f'{latest_checkpoint} is a TrainState checkpoint without '
+                    'the rng and position in the training data; deriving the '
+                    'position from its step and keeping the initial rng.')
+    state = flax.serialization.from_state_dict(
+        state, {**state_fields, **state_dict})
+    step = int(state.step)
+    epoch = min(int(np.searchsorted(epoch_start_steps, step, side='right')) - 1, 
+                len(epoch_start_steps) - 1)
+    return with_position(state, epoch, step - int(epoch_start_steps[epoch]))
+
+
 def train_and_evaluate_with_data(
     config: ml_collections.ConfigDict, workdir: str, 
     datasets: Dict[str, Dict[str, Iterable[jraph.GraphsTuple]]], 
@@ -526,35 +1097,120 @@ def train_and_evaluate_with_data(
     Returns:
         The train state (which includes the `.params`).
     """
-    # We only support single-host training.
-    assert jax.process_count() == 1
+    # Warn (or, if strict, fail) when a jitted function compiles more often 
+    # than expected during this run, e.g. because the shapes of its inputs 
+    # keep changing. the compiles of earlier runs in this process don't count.
+    if "max_compiles_per_function" in config._fields.keys():
+        max_compiles_per_function = config.max_compiles_per_function
+    else:
+        max_compiles_per_function = None
+    if "strict_recompilation" in config._fields.keys():
+        strict_recompilation = config.strict_recompilation
+    else:
+        strict_recompilation = False
+    with recompilation_limit(max_compiles_per_function, 
+                             strict=strict_recompilation):
+        return _train_and_evaluate_with_data(config, workdir, datasets, trial)
+
 
-    # Create writer for logs.
-    writer = metric_writers.create_default_writer(workdir)
+def _train_and_evaluate_with_data(
+    config: ml_collections.ConfigDict, workdir: str, 
+    datasets: Dict[str, Dict[str, Iterable[jraph.GraphsTuple]]], 
+    trial: Optional[optuna.trial.Trial] = None,
+) -> Tuple[train_state.TrainState, TrainMetrics, EvalMetrics]:
+    """ Training and evaluation loop of train_and_evaluate_with_data. """
+    # Reuse compiled executables from previous runs, if configured.
+    if "compilation_cache_dir" in config._fields.keys():
+        setup_compilation_cache(config.compilation_cache_dir)
+
+    # Join the other processes of a multi-process run, if configured. Each 
+    # process trains on its own shard of the training windows.
+    initialize_distributed(config)
+    process_count = jax.process_count()
+    process_index = jax.process_index()
+
+    # Create writer for logs. Only process 0 writes summaries.
+    writer = metric_writers.create_default_writer(
+        workdir, just_logging=not is_main_process())
     writer.write_hparams(config.to_dict())
 
     # Get datasets, organized by split.
     train_set = datasets['train']
-    input_data = train_set['inputs']
-    target_data = train_set['targets']
+    input_data = shard_windows(train_set['inputs'], process_index, process_count)
+    target_data = shard_windows(train_set['targets'], process_index, 
+                                process_count)
     n_rollout_steps = config.output_steps
 
+    # whether to train on batches of config.batch_size windows, split over the 
+    # devices of a data-parallel mesh (with the train state replicated)
+    if "data_parallel" in config._fields.keys():
+        data_parallel = config.data_parallel
+    else:
+        data_parallel = False
+    assert data_parallel or process_count == 1, \
+        'multi-process training requires data_parallel'
+    batch_size = config.batch_size if data_parallel else 1
+    # number of windows of each batch that come from this process 
+    assert batch_size % process_count == 0, (batch_size, process_count)
+    local_batch_size = batch_size // process_count
+    steps_per_epoch = len(input_data) // local_batch_size
+    # fraction of the training windows used in each epoch (see 
+    # get_subset_fraction), e.g. a growing subset for multi-fidelity tuning. 
+    # by default, every epoch uses all windows. 
+    if "train_subset_fractions" in config._fields.keys():
+        train_subset_fractions = config.train_subset_fractions
+    else:
+        train_subset_fractions = None
+    epoch_subset_fractions = [
+        get_subset_fraction(train_subset_fractions, epoch) 
+        for epoch in range(config.epochs)]
+    # first step of each epoch (and the total number of steps, at the end) 
+    epoch_start_steps = np.cumsum([0] + [
+        len(get_subset_indices(len(input_data), fraction, config.seed)) 
+        // local_batch_size for fraction in epoch_subset_fractions])
+
+    # whether to reuse the compiled programs of earlier runs in this process 
+    # that had the same architecture (and input shapes), e.g. tuning trials. 
+    # the learning rate, momentum and dropout rate are then passed at runtime 
+    # instead of being compiled in (see ModelApply). 
+    if "cache_executables" in config._fields.keys():
+        cache_executables = config.cache_executables
+    else:
+        cache_executables = False
+
     # Create and initialize the network.
     logging.info('Initializing network.')
     rng = jax.random.key(0)
     rng, init_rng = jax.random.split(rng)
     sample_input_window = input_data[0]
-    init_net = create_model(config, deterministic=True)
-    params = jax.jit(init_net.init)(init_rng, sample_input_window)
+    if cache_executables:
+        params = init_cached_model(get_model_apply(config, True).net, 
+                                   init_rng, sample_input_window)
+    else:
+        init_net = create_model(config, deterministic=True)
+        params = jax.jit(init_net.init)(init_rng, sample_input_window)
     parameter_overview.log_parameter_overview(params) # logs to logging.info
 
-    # Create the optimizer.
-    tx = create_optimizer(config)
-
-    # Create the training state.
-    net = create_model(config, deterministic=False)
-    state = train_state.TrainState.create(
-        apply_fn=net.apply, params=params, tx=tx)
+    # Create the optimizer and the training state. the state also keeps the 
+    # rng and the position in the training data, for resuming (see 
+    # ResumableTrainState). 
+    resume_fields = dict(rng=jax.random.key_data(rng), 
+                         epoch=jnp.asarray(0, jnp.int32), 
+                         epoch_step=jnp.asarray(0, jnp.int32))
+    if cache_executables:
+        tx = get_cached_optimizer(config)
+        state = ResumableTrainState(
+            step=jnp.asarray(0, jnp.int32), 
+            apply_fn=get_model_apply(config, False), params=params, 
+            tx=tx, opt_state=init_cached_optimizer_state(config, tx, params), 
+            **resume_fields)
+        dropout_rate = jnp.float32(config.dropout_rate)
+    else:
+        tx = create_optimizer(config)
+        net = create_model(config, deterministic=False)
+        state = ResumableTrainState.create(
+            apply_fn=net.apply, params=params, tx=tx, **resume_fields)
+        dropout_rate = None
 
     # Set up checkpointing of the model.
     # The input pipeline cannot be checkpointed in its current form,
@@ -562,25 +1218,135 @@ def train_and_evaluate_with_data(
     checkpoint_dir = os.path.join(workdir, 'checkpoints')
     ckpt = checkpoint.Checkpoint(checkpoint_dir, 
                                  max_to_keep=config.max_checkpts_to_keep)
-    state = ckpt.restore_or_initialize(state)
+    state = restore_or_initialize_train_state(ckpt, state, epoch_start_steps)
     initial_step = int(state.step) # state.step is 0-indexed 
-    init_epoch = initial_step // len(input_data) # 0-indexed 
+    # whether to write checkpoints on a background thread, so that training 
+    # continues while they are serialized and written 
+    if "async_checkpointing" in config._fields.keys():
+        async_checkpointing = config.async_checkpointing
+    else:
+        async_checkpointing = False
+    if async_checkpointing:
+        ckpt = AsyncCheckpointer(ckpt)
+    # number of steps between checkpoints within an epoch, in addition to the 
+    # checkpoints at the end of epochs (None to only save at the end of 
+    # epochs). not supported with scan_epochs. 
+    if "checkpoint_every_steps" in config._fields.keys():
+        checkpoint_every_steps = config.checkpoint_every_steps
+    else:
+        checkpoint_every_steps = None
+    # resume where the checkpoint was saved, with the same rng 
+    rng = jax.random.wrap_key_data(state.rng)
+    init_epoch = int(state.epoch) # 0-indexed 
+    init_epoch_step = int(state.epoch_step)
+    assert epoch_start_steps[init_epoch] + init_epoch_step == initial_step, \
+        'the checkpoint was saved with a different training schedule'
+    if initial_step > 0:
+        logging.info(f'Resuming training at step {initial_step} (epoch '
+                     f'{init_epoch}, step {init_epoch_step} of the epoch).')
+
+    if data_parallel:
+        # number of devices to split each batch over (by default all of them)
+        if "num_devices" in config._fields.keys():
+            mesh = create_data_parallel_mesh(config.num_devices)
+        else:
+            mesh = create_data_parallel_mesh()
+        assert batch_size % mesh.size == 0, (batch_size, mesh.size)
+        logging.info(f'Training data-parallel over {mesh.size} devices.')
+        state = to_global(
+            state, jax.sharding.NamedSharding(mesh, jax.sharding.PartitionSpec()))
 
     # Create the evaluation state, corresponding to a deterministic model.
-    eval_net = create_model(config, deterministic=True)
-    eval_state = state.replace(apply_fn=eval_net.apply)
+    if cache_executables:
+        eval_state = state.replace(apply_fn=get_model_apply(config, True))
+    else:
+        eval_net = create_model(config, deterministic=True)
+        eval_state = state.replace(apply_fn=eval_net.apply)
 
-    num_train_steps = config.epochs * len(train_set['inputs'])  
+    num_train_steps = int(epoch_start_steps[-1])
     # Hooks called periodically during training.
     report_progress = periodic_actions.ReportProgress(
         num_train_steps=num_train_steps, writer=writer
     )
-    profiler = periodic_actions.Profile(num_profile_steps=5, logdir=workdir)
-    hooks = [report_progress, profiler]
+    hooks = [report_progress]
+    if is_main_process():
+        profiler = periodic_actions.Profile(num_profile_steps=5, logdir=workdir)
+        hooks.append(profiler)
+    # whether to time the phases of every step (and jax compilations), and 
+    # write their rolling p50/p95/p99 whenever the train metrics are written 
+    # (see utils.timing). waiting for a step to complete blocks the host, so 
+    # it is only timed every timing_sync_every_steps steps. 
+    if "timing" in config._fields.keys():
+        timing = config.timing
+    else:
+        timing = False
+    if "timing_sync_every_steps" in config._fields.keys():
+        timing_sync_every_steps = config.timing_sync_every_steps
+    else:
+        timing_sync_every_steps = 100
+    timer = TrainingTimer(enabled=timing)
     if "eval_all_metrics" in config._fields.keys():
         eval_all_metrics = config.eval_all_metrics
     else:
         eval_all_metrics = False
+    # number of windows evaluated at once. the val and test windows are 
+    # stacked into batches once, up front 
+    if "eval_batch_size" in config._fields.keys():
+        eval_batch_size = config.eval_batch_size
+    else:
+        eval_batch_size = DEFAULT_EVAL_BATCH_SIZE
+    # whether to also save the mse and bias per (rollout step, node, feature) 
+    # at every evaluation, to workdir/eval_errors 
+    if "eval_error_tensors" in config._fields.keys():
+        eval_error_tensors = config.eval_error_tensors
+    else:
+        eval_error_tensors = False
+    eval_splits = ['val', 'test']
+    stacked_eval_splits = {
+        split: stack_eval_split(datasets[split]['inputs'], 
+                                datasets[split]['targets'], eval_batch_size) 
+        for split in eval_splits}
+    # how often the host checks for nan losses. this blocks until the pending 
+    # steps are done, so by default it only happens once per epoch.
+    if "nan_check_every_steps" in config._fields.keys():
+        nan_check_every_steps = config.nan_check_every_steps
+    else:
+        nan_check_every_steps = steps_per_epoch
+    # whether to run each epoch as a single jitted scan over the windows
+    if "scan_epochs" in config._fields.keys():
+        scan_epochs = config.scan_epochs
+    else:
+        scan_epochs = False
+    if scan_epochs:
+        assert not data_parallel, 'scan_epochs is not supported with data_parallel'
+        assert checkpoint_every_steps is None and init_epoch_step == 0, \
+            'scan_epochs only supports checkpoints at the end of epochs'
+        stacked_input_data = stack_windows(input_data)
+        stacked_target_data = stack_windows(target_data)
+    # whether to visit the training windows in a different (deterministic) 
+    # order every epoch
+    if "shuffle_train" in config._fields.keys():
+        shuffle_train = config.shuffle_train
+    else:
+        shuffle_train = False
+    # number of windows to prepare and transfer to the device ahead of time, 
+    # on a background thread (0 to disable)
+    if "prefetch_depth" in config._fields.keys():
+        prefetch_depth = config.prefetch_depth
+    else:
+        prefetch_depth = 0
+    if data_parallel:
+        # batches are assembled and sharded over the mesh by the loader 
+        train_loader = PrefetchLoader(
+            input_data, target_data, prefetch_depth=max(prefetch_depth, 1), 
+            shuffle=shuffle_train, seed=config.seed, 
+            batch_size=local_batch_size, 
+            sharding=jax.sharding.NamedSharding(
+                mesh, jax.sharding.PartitionSpec('batch')))
+    elif prefetch_depth > 0:
+        train_loader = PrefetchLoader(input_data, target_data, 
+                                      prefetch_depth=prefetch_depth, 
+                                      shuffle=shuffle_train, seed=config.seed)
     
     eval_metrics_dict = {}
     
@@ -593,41 +1359,123 @@ def train_and_evaluate_with_data(
     # note step is 0-indexed 
     epoch_losses = []
     step = initial_step
+    # first step with a nan loss since the last check (or -1), kept on device
+    nan_step = jnp.array(-1)
+    update_fn = train_step_batch if data_parallel else train_step
     for epoch in range(init_epoch, config.epochs):
-        # iterate over data
-        # right now we don't have batching so we just loop over individual windows in the dataset
-        for (input_window_graphs, target_window_graphs) in zip(
-            input_data, target_data):
-            # Split PRNG key, to ensure different 'randomness' for every step.
-            rng, dropout_rng = jax.random.split(rng)
-
-            # Perform one step of training.
-            with jax.profiler.StepTraceAnnotation('train', step_num=step):
-                # graphs = jax.tree_util.tree_map(np.asarray, next(train_iter))
-                state, metrics_update, _ = train_step(
-                    state=state, 
-                    n_rollout_steps=n_rollout_steps, 
-                    input_window_graphs=input_window_graphs, 
-                    target_window_graphs=target_window_graphs, 
-                    rngs={'dropout': dropout_rng},
-                )
-                if jnp.isnan(metrics_update.loss.total): 
-                    logging.warning(f'loss is nan for step {step} (in epoch {epoch})')
-                    if trial:
-                        raise optuna.TrialPruned()
-                    
-                # Update metrics.
-                if train_metrics is None:
-                    train_metrics = metrics_update
-                else:
-                    train_metrics = train_metrics.merge(metrics_update)
+        subset_fraction = epoch_subset_fractions[epoch]
+        epoch_steps = epoch_start_steps[epoch + 1] - epoch_start_steps[epoch]
+        if scan_epochs:
+            # the rngs of the steps of the epoch are split from epoch_rng 
+            epoch_rng = jax.random.fold_in(rng, epoch)
+
+            epoch_input_data = stacked_input_data
+            epoch_target_data = stacked_target_data
+            if shuffle_train or subset_fraction < 1:
+                order = get_epoch_order(len(input_data), epoch, config.seed, 
+                                        shuffle_train, subset_fraction)
+                epoch_input_data, epoch_target_data = jax.tree_util.tree_map(
+                    lambda x: x[order], (epoch_input_data, epoch_target_data))
+
+            # Perform all training steps of the epoch at once.
+            with jax.profiler.StepTraceAnnotation('train_epoch', step_num=step):
+                with timer.timed('train_epoch_dispatch'):
+                    state, metrics_update, epoch_nan_step = train_epoch(
+                        state=state, 
+                        n_rollout_steps=n_rollout_steps, 
+                        input_windows=epoch_input_data, 
+                        target_windows=epoch_target_data, 
+                        rng=epoch_rng,
+                        dropout_rate=dropout_rate,
+                    )
+                if timer.enabled:
+                    with timer.timed('train_epoch_completion'):
+                        jax.block_until_ready(state.step)
+                nan_step = jnp.where((nan_step < 0) & (epoch_nan_step >= 0), 
+                                     step + epoch_nan_step, nan_step)
 
-            # Quick indication that training is happening.
-            logging.log_first_n(logging.INFO, 'Finished training step %d.', 10, step)
+                # Update metrics.
+                with timer.timed('metric_merge'):
+                    if train_metrics is None:
+                        train_metrics = metrics_update
+                    else:
+                        train_metrics = train_metrics.merge(metrics_update)
+
+            step += epoch_steps
+            timer.count_steps(epoch_steps)
             for hook in hooks:
-                hook(step)
-
-            step += 1
+                hook(step - 1)
+            nan_step = check_nan_step(nan_step, epoch, trial)
+        else:
+            # iterate over data
+            # without data_parallel, we just loop over individual windows in the dataset
+            # when resuming, skip the steps of the epoch that are done 
+            epoch_start = init_epoch_step if epoch == init_epoch else 0
+            if data_parallel or prefetch_depth > 0:
+                epoch_windows = train_loader.iterate(epoch, subset_fraction, 
+                                                     start=epoch_start)
+            else:
+                order = get_epoch_order(len(input_data), epoch, config.seed, 
+                                        shuffle_train, subset_fraction)
+                epoch_windows = ((input_data[j], target_data[j]) 
+                                 for j in order[epoch_start:])
+            # (the loader transfers the windows while fetching them) 
+            epoch_windows = timer.timed_iter('data_fetch', epoch_windows)
+            for i, (input_window_graphs, target_window_graphs) in enumerate(
+                epoch_windows, start=epoch_start):
+                # Derive the PRNG key of the step, to ensure different 
+                # 'randomness' for every step (and the same after resuming).
+                dropout_rng = jax.random.fold_in(rng, step)
+
+                if timer.enabled and not (data_parallel or prefetch_depth > 0):
+                    # transfer the window explicitly, to time the transfer 
+                    with timer.timed('host_to_device'):
+                        input_window_graphs, target_window_graphs = \
+                            jax.block_until_ready(jax.device_put(
+                                (input_window_graphs, target_window_graphs)))
+
+                # Perform one step of training.
+                with jax.profiler.StepTraceAnnotation('train', step_num=step):
+                    # graphs = jax.tree_util.tree_map(np.asarray, next(train_iter))
+                    with timer.timed('train_step_dispatch'):
+                        state, metrics_update, _ = update_fn(
+                            state=state, 
+                            n_rollout_steps=n_rollout_steps, 
+                            input_window_graphs=input_window_graphs, 
+                            target_window_graphs=target_window_graphs, 
+                            rngs={'dropout': dropout_rng},
+                            dropout_rate=dropout_rate,
+                        )
+                    if timer.enabled and step % timing_sync_every_steps == 0:
+                        with timer.timed('train_step_completion'):
+                            jax.block_until_ready(state.step)
+                    nan_step = flag_nan_step(nan_step, metrics_update.loss.total, 
+                                             step)
+                    
+                    # Update metrics.
+                    with timer.timed('metric_merge'):
+                        if train_metrics is None:
+                            train_metrics = metrics_update
+                        else:
+                            train_metrics = train_metrics.merge(metrics_update)
+
+                # Quick indication that training is happening.
+                logging.log_first_n(logging.INFO, 'Finished training step %d.', 10, step)
+                for hook in hooks:
+                    hook(step)
+
+                step += 1
+                timer.count_steps()
+                if (step % nan_check_every_steps == 0 
+                    or i == epoch_steps - 1):
+                    nan_step = check_nan_step(nan_step, epoch, trial)
+
+                # Checkpoint model within the epoch, if required.
+                if (checkpoint_every_steps and step % checkpoint_every_steps == 0 
+                    and i < epoch_steps - 1 and is_main_process()):
+                    with report_progress.timed('checkpoint'), \
+                         timer.timed('checkpoint'):
+                        ckpt.save(with_position(state, epoch, i + 1))
 
         # epoch is 0-indexed 
         is_last_epoch = (epoch == config.epochs - 1) 
@@ -638,21 +1486,34 @@ def train_and_evaluate_with_data(
                 epoch, add_prefix_to_keys(train_metrics.compute(), 'train')
             )
             train_metrics = None
+            timer.write(writer, epoch)
 
         # Evaluate on validation and test splits, if required.
         if epoch % config.eval_every_epochs == 0 or is_last_epoch:
-            eval_state = eval_state.replace(params=state.params)
+            # every process evaluates on the full val and test splits 
+            eval_state = eval_state.replace(params=to_local(state.params))
 
-            splits = ['val', 'test']
-            with report_progress.timed('eval'):
-                eval_metrics_dict = evaluate_model(
+            with report_progress.timed('eval'), timer.timed('eval'):
+                eval_outputs = evaluate_model(
                     state=eval_state, 
                     n_rollout_steps=n_rollout_steps, 
                     datasets=datasets, 
-                    splits=splits,
+                    splits=eval_splits,
                     all_metrics=eval_all_metrics,
+                    stacked_splits=stacked_eval_splits,
+                    return_error_tensors=eval_error_tensors,
                 )
-            for split in splits:
+                if timer.enabled:
+                    jax.block_until_ready(eval_outputs)
+            if eval_error_tensors:
+                eval_metrics_dict, error_tensors_dict = eval_outputs
+                if is_main_process():
+                    save_error_tensors(error_tensors_dict, 
+                                       os.path.join(workdir, 'eval_errors'), 
+                                       epoch)
+            else:
+                eval_metrics_dict = eval_outputs
+            for split in eval_splits:
                 writer.write_scalars(
                     epoch, add_prefix_to_keys(eval_metrics_dict[split].compute(), split)
                 )
@@ -669,9 +1530,16 @@ def train_and_evaluate_with_data(
                     raise optuna.TrialPruned()
 
         # Checkpoint model, if required.
-        if epoch % config.checkpoint_every_epochs == 0 or is_last_epoch:
-            with report_progress.timed('checkpoint'):
-                ckpt.save(state)
+        if ((epoch % config.checkpoint_every_epochs == 0 or is_last_epoch) 
+            and is_main_process()):
+            with report_progress.timed('checkpoint'), timer.timed('checkpoint'):
+                ckpt.save(with_position(state, epoch + 1, 0))
+
+    if async_checkpointing:
+        # make sure the last checkpoint is written before returning 
+        ckpt.wait()
+    timer.close()
+    log_compilation_cache_stats()
     return state, train_metrics, eval_metrics_dict, epoch_losses
 
 
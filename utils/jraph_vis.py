@@ -2,8 +2,10 @@ import jraph
 import jax
 import jax.numpy as jnp
 import networkx as nx
-from utils.jraph_data import convert_jraph_to_networkx_graph
-from utils.jraph_training import rollout, rollout_loss, create_dataset, create_model, create_optimizer
+from utils.jraph_data import convert_jraph_to_networkx_graph, stack_windows
+from utils.jraph_training import rollout, rollout_loss, create_dataset, create_model, create_optimizer, restore_eval_state
+from utils.compilation import setup_compilation_cache
+from utils.forecast import forecast
 from clu import parameter_overview
 from clu import checkpoint
 from flax.training import train_state
@@ -150,6 +152,9 @@ def plot_predictions(
         config.input_steps + config.output_delay + config.output_steps + config.sample_buffer == 1
         )
 
+    if "compilation_cache_dir" in config._fields.keys():
+        setup_compilation_cache(config.compilation_cache_dir)
+
     # Get datasets, organized by split.
     if datasets is None:
         logging.info('Generating datasets from config because none provided.')
@@ -160,60 +165,30 @@ def plot_predictions(
     target_data = plot_set['targets']
     # n_rollout_steps = config.output_steps
 
-    # Create the evaluation state, corresponding to a deterministic model.
-    logging.info('Initializing network.')
-    rng = jax.random.key(0)
-    rng, init_rng = jax.random.split(rng)
-    sample_input_window = input_data[0]
-    eval_net = create_model(config, deterministic=True)
-    params = jax.jit(eval_net.init)(init_rng, sample_input_window)
-    parameter_overview.log_parameter_overview(params) # logs to logging.info
-
-    # Create the optimizer and state.
-    # (we don't actually need the optimizer for evaluation, we just need it to create the state)
-    tx = create_optimizer(config)
-    state = train_state.TrainState.create(
-        apply_fn=eval_net.apply, params=params, tx=tx
-    )
-
-    # load the checkpoint state
-    ckpt = checkpoint.Checkpoint(checkpoint_dir)
-    state = ckpt.restore(state) # restore latest checkpoint 
-
-    # get the predictions from the model for the ith step of the rollout and for the specified node
-    node_preds = []
-    node_targets = []
-
-    # loop over individual windows in the dataset 
-    # TODO try batching to see if its faster? 
+    # Create the evaluation state, corresponding to a deterministic model, 
+    # and load the latest checkpoint into it.
+    state = restore_eval_state(config, workdir, input_data[0])
 
     if plot_days is not None:
         plot_count = plot_days * config.time_resolution / 5 / config.timestep_duration
     else:
         plot_count = len(input_data)
-
-    for i, (input_window_graphs, target_window_graphs) in enumerate(zip(
-        input_data, target_data)):
-        if i >= plot_count:
-            break
-        pred_nodes_list = rollout(state=state,
-                                  input_window_graphs=input_window_graphs,
-                                  n_rollout_steps=config.output_steps,
-                                #   n_rollout_steps=plot_ith_rollout_step+1, # +1 since plot_ith_rollout_step is 0-indexed
-                                  rngs=None) # deterministic during eval
-        
-        # get the last array of predictions, which will correspond to the ith rollout step that we care about 
-        ith_rollout_pred = pred_nodes_list[plot_ith_rollout_step]
-        node_pred = ith_rollout_pred[node, :] # jnp array with shape (1, 2)
-        node_preds.append(node_pred)
-
-        # also grab the target nodes while we're in this loop 
-        ith_rollout_target = target_window_graphs[plot_ith_rollout_step].nodes
-        node_target = ith_rollout_target[node, :] # jnp array with shape (1, 2)
-        node_targets.append(node_target)
-
-    node_preds = np.vstack(node_preds)
-    node_targets = np.vstack(node_targets)
+    n_windows = min(len(input_data), int(np.ceil(plot_count)))
+
+    # get the predictions from the model for the ith step of the rollout and 
+    # for the specified node, for all windows at once 
+    window_nodes = jnp.stack(
+        [graph.nodes for graph in stack_windows(input_data[:n_windows])], 
+        axis=1)
+    preds = forecast(state=state,
+                     states=window_nodes, # (n_windows, input_steps, K, 2)
+                     n_steps=config.output_steps,
+                     template_graph=input_data[0][0])
+    node_preds = np.asarray(preds[:, plot_ith_rollout_step, node, :])
+
+    # the targets of the ith rollout step for the specified node 
+    node_targets = np.asarray(stack_windows(target_data[:n_windows])[
+        plot_ith_rollout_step].nodes[:, node, :])
 
     # reconstruct timesteps
     steps = np.arange(plot_count)
@@ -1,51 +1,158 @@
 import os
-import json
+import atexit
 import logging
+import sqlite3
+import time
+from contextlib import contextmanager
 import matplotlib.pyplot as plt
+import numpy as np
 import pdb
 import jax
 
+# the performance log is a sqlite table with one row per (epoch, mode), 
+# indexed by mode and epoch so that single epochs (or ranges of epochs) of 
+# long runs can be read without reading the whole log 
+PERFORMANCE_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS performance (
+    epoch INTEGER NOT NULL, 
+    mode TEXT NOT NULL, 
+    avg_loss REAL NOT NULL, 
+    time REAL NOT NULL
+)"""
+PERFORMANCE_INDEX_SQL = """
+CREATE INDEX IF NOT EXISTS performance_mode_epoch ON performance (mode, epoch)"""
+
+
+class PerformanceLogWriter:
+    """ Buffers performance records in memory and writes them to the sqlite 
+        log in one transaction every flush_every records, or once flush_secs 
+        have passed since the last write. """
+
+    def __init__(self, log_path, flush_every=100, flush_secs=10.):
+        self.log_path = log_path
+        self.flush_every = flush_every
+        self.flush_secs = flush_secs
+        self.buffer = []
+        self.last_flush_time = time.time()
+        with connect_performance_log(log_path):
+            pass # creates the table 
+
+    def write(self, epoch, mode, loss):
+        self.buffer.append((int(epoch), mode, float(loss), time.time()))
+        if (len(self.buffer) >= self.flush_every 
+            or time.time() - self.last_flush_time >= self.flush_secs):
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            with connect_performance_log(self.log_path) as connection:
+                connection.executemany(
+                    "INSERT INTO performance VALUES (?, ?, ?, ?)", self.buffer)
+            self.buffer = []
+        self.last_flush_time = time.time()
+
+    def reset(self):
+        # drop the buffered and written records, e.g. at the start of a new run
+        self.buffer = []
+        with connect_performance_log(self.log_path) as connection:
+            connection.execute("DELETE FROM performance")
+
+
+_performance_writers = {}
+
+
+@contextmanager
+def connect_performance_log(log_path):
+    """ Opens the sqlite performance log, creating its table if needed, and 
+        commits (or rolls back, on errors) and closes it at the end. """
+    connection = sqlite3.connect(log_path)
+    try:
+        with connection: # one transaction 
+            connection.execute(PERFORMANCE_TABLE_SQL)
+            connection.execute(PERFORMANCE_INDEX_SQL)
+            yield connection
+    finally:
+        connection.close()
+
+
+def get_performance_writer(cfg):
+    """ Returns the buffered writer of the performance log of cfg, which is 
+        shared by all callers in this process and flushed at exit. """
+    log_path = get_log_path(cfg)
+    if log_path not in _performance_writers:
+        writer = PerformanceLogWriter(log_path)
+        atexit.register(writer.flush)
+        _performance_writers[log_path] = writer
+    return _performance_writers[log_path]
+
+
+def flush_training_performance(cfg):
+    # write the buffered records of the performance log, if any 
+    log_path = get_log_path(cfg)
+    if log_path in _performance_writers:
+        _performance_writers[log_path].flush()
+
+
 def log_training_performance(cfg, epoch, mode, loss):
-    # log the training and validation performance to a json file
+    # log the training and validation performance to the (buffered) 
+    # performance log
     assert mode in ["train", "val"]
 
-    log_path = get_log_path(cfg)
+    writer = get_performance_writer(cfg)
 
     # make sure the loss value is a float and not a jax array
     if isinstance(loss, jax.numpy.ndarray):
         loss = float(loss)
 
-    performance_dict = {"epoch": epoch, "mode": mode, "avg_loss": loss}
+    # the first record of a run replaces the log of previous runs 
+    if epoch == 0 and mode == "train":
+        writer.reset()
+    writer.write(epoch, mode, loss)
 
-    file_access_mode = "w" if (epoch == 0 and mode == "train") else "a"
-    with open(log_path, file_access_mode) as f:
-        json_str = json.dumps(performance_dict, indent=None)
-        f.write(json_str + "\n")
-        
 
-def load_training_performance(cfg):
-    """ load the training and validation performance from a json file
+def read_training_performance(cfg, mode, start_epoch=0, end_epoch=None):
+    """ read the performance of the epochs in [start_epoch, end_epoch) for 
+        one mode, using the index of the log
     
         Returns:
-            a dictionary containing the training and validation losses
+            arrays of the epochs and their average losses
     """
     log_path = get_log_path(cfg)
     assert os.path.exists(log_path), "performance log file does not exist"
+    flush_training_performance(cfg)
+
+    query = "SELECT epoch, avg_loss FROM performance WHERE mode = ? AND epoch >= ?"
+    args = [mode, start_epoch]
+    if end_epoch is not None:
+        query += " AND epoch < ?"
+        args.append(end_epoch)
+    with connect_performance_log(log_path) as connection:
+        rows = connection.execute(query + " ORDER BY epoch, rowid", 
+                                  args).fetchall()
+    epochs = np.array([row[0] for row in rows], dtype=np.int64)
+    losses = np.array([row[1] for row in rows], dtype=np.float64)
+    return epochs, losses
 
-    losses_dict = {"train": [], "val": []}
-    with open(log_path, "r") as f:
-        for line in f:
-            performance_dict = json.loads(line)
-            losses_dict[performance_dict["mode"]].append(performance_dict["avg_loss"])
+
+def load_training_performance(cfg):
+    """ load the training and validation performance from the performance log
+    
+        Returns:
+            a dictionary containing the training and validation losses
+    """
+    losses_dict = {}
+    for mode in ["train", "val"]:
+        _, losses = read_training_performance(cfg, mode)
+        losses_dict[mode] = losses.tolist()
     
     return losses_dict
 
 def get_performance_for_epoch(cfg, mode, epoch):
     # get the performance for a given mode and epoch
-    losses_dict = load_training_performance(cfg)
-    assert len(losses_dict[mode]) > epoch, f"epoch {epoch} does not exist in performance log"
+    _, losses = read_training_performance(cfg, mode, epoch, epoch + 1)
+    assert len(losses) > 0, f"epoch {epoch} does not exist in performance log"
 
-    return losses_dict[mode][epoch]
+    return float(losses[-1])
 
 def plot_training_performance(cfg):
     # plot the training and validation performance
@@ -77,7 +184,7 @@ def plot_training_performance(cfg):
 
 def get_log_path(cfg):
     # get the path to the log file and create the directory if it doesn't exist
-    log_path = os.path.join(cfg["OUTPUT_DIR"], "training_performance.log")
+    log_path = os.path.join(cfg["OUTPUT_DIR"], "training_performance.sqlite")
     if not os.path.exists(cfg["OUTPUT_DIR"]):
         os.makedirs(cfg["OUTPUT_DIR"])
     return log_path
\ No newline at end of file
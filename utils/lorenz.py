@@ -314,11 +314,13 @@ def load_lorenz96_2coupled(fname):
 
 
 # TODO: test this function
-def normalize_lorenz96_2coupled(graph_tuple_dict):
+def normalize_lorenz96_2coupled(graph_tuple_dict, return_stats=False):
     """ normalize dataset of GraphTuples using training data distribution.
 
         (replaced existing train, val, test with normalized versions)
 
+        if return_stats is True, also returns a dict with the X1/X2 means and 
+        stds that were used, so that the normalization can be undone later.
     """
         # graph_tuple_dict has the following format:
         # {
@@ -368,5 +370,14 @@ def normalize_lorenz96_2coupled(graph_tuple_dict):
                         n_edge=graphtuple.n_edge)
                     
                     window[i] = graphtuple
+
+    if return_stats:
+        norm_stats = {
+            "X1_mean": float(X1_mean), 
+            "X1_std": float(X1_std), 
+            "X2_mean": float(X2_mean), 
+            "X2_std": float(X2_std),
+        }
+        return graph_tuple_dict, norm_stats
                     
     return graph_tuple_dict
\ No newline at end of file
@@ -0,0 +1,213 @@
+""" Memory footprint of the dataset and the training state, to tell whether
+    the dataset, the params and optimizer state, or the activations of
+    train_step are responsible for running out of memory.
+
+    Dataset memory is split into the Python objects that hold it (lists of
+    windows, GraphsTuples, array headers), the arrays in host memory and the
+    arrays in device buffers. The memory of train_step comes from XLA's
+    analysis of the compiled program (some backends, e.g. cpu, leave parts of
+    it at 0) and from the device's own statistics, where available.
+"""
+import os
+import sys
+from typing import Any, Dict, Iterable, Optional, Sequence
+
+from absl import logging
+import jax
+import jax.numpy as jnp
+import jraph
+import ml_collections
+import numpy as np
+
+from utils.jraph_training import (ResumableTrainState, create_model,
+                                  create_optimizer, train_step)
+
+MEMORY_ANALYSIS_FIELDS = ("argument_size_in_bytes", "output_size_in_bytes",
+                          "alias_size_in_bytes", "temp_size_in_bytes",
+                          "generated_code_size_in_bytes")
+
+
+def get_object_memory(obj: Any) -> Dict[str, int]:
+    """ Counts the memory of a nested structure of lists, tuples, dicts and
+        arrays (e.g. a dataset split), without counting shared objects twice.
+
+        Returns:
+            the number of Python objects and their bytes (containers and
+            array headers), and the number and bytes of host (numpy) and
+            device (jax) arrays
+    """
+    memory = {"python_objects": 0, "python_object_bytes": 0,
+              "host_arrays": 0, "host_array_bytes": 0,
+              "device_arrays": 0, "device_array_bytes": 0}
+    seen = set()
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if obj is None or id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        if isinstance(obj, jax.Array):
+            memory["device_arrays"] += 1
+            memory["device_array_bytes"] += sum(
+                shard.data.nbytes for shard in obj.addressable_shards)
+            continue
+        memory["python_objects"] += 1
+        if isinstance(obj, np.ndarray):
+            memory["host_arrays"] += 1
+            memory["host_array_bytes"] += obj.nbytes
+            # getsizeof includes the data of arrays that own it
+            memory["python_object_bytes"] += (
+                sys.getsizeof(obj) - (obj.nbytes if obj.base is None else 0))
+            continue
+        memory["python_object_bytes"] += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple)):
+            stack.extend(obj)
+    return memory
+
+
+def get_dataset_memory(
+    datasets: Dict[str, Dict[str, Iterable[Iterable[jraph.GraphsTuple]]]]
+) -> Dict[str, Dict[str, int]]:
+    """ Returns the memory of each split of a dataset (as returned by
+        create_dataset), and of the whole dataset under "total". """
+    report = {split: get_object_memory(split_data)
+              for split, split_data in datasets.items()}
+    report["total"] = get_object_memory(datasets)
+    return report
+
+
+def get_train_state_memory(state: Any) -> Dict[str, int]:
+    """ Returns the number of params and the bytes of the params and of the
+        optimizer state of a train state. """
+    params = jax.tree_util.tree_leaves(state.params)
+    return {
+        "n_params": int(sum(np.size(x) for x in params)),
+        "params_bytes": int(sum(x.nbytes for x in params)),
+        "opt_state_bytes": int(sum(
+            x.nbytes for x in jax.tree_util.tree_leaves(state.opt_state)
+            if hasattr(x, "nbytes"))),
+    }
+
+
+def get_train_step_memory(
+    state: Any,
+    n_rollout_steps: int,
+    input_window_graphs: Iterable[jraph.GraphsTuple],
+    target_window_graphs: Iterable[jraph.GraphsTuple],
+) -> Dict[str, Optional[int]]:
+    """ Returns XLA's memory analysis of the compiled train_step (argument,
+        output, aliased and temporary buffers, and generated code), and its
+        estimate of the peak device memory during the step. """
+    compiled = train_step.lower(
+        state=state, n_rollout_steps=n_rollout_steps,
+        input_window_graphs=input_window_graphs,
+        target_window_graphs=target_window_graphs,
+        rngs={'dropout': jax.random.key(0)}).compile()
+    analysis = compiled.memory_analysis()
+    if analysis is None:
+        return {field: None for field in MEMORY_ANALYSIS_FIELDS + ("peak_bytes",)}
+    report = {field: int(getattr(analysis, field))
+              for field in MEMORY_ANALYSIS_FIELDS}
+    report["peak_bytes"] = (report["argument_size_in_bytes"]
+                            + report["output_size_in_bytes"]
+                            - report["alias_size_in_bytes"]
+                            + report["temp_size_in_bytes"])
+    return report
+
+
+def get_device_memory_stats() -> Optional[Dict[str, int]]:
+    """ Returns the memory statistics of the first local device (e.g.
+        bytes_in_use and peak_bytes_in_use), or None if the backend does not
+        provide them. """
+    return jax.local_devices()[0].memory_stats()
+
+
+def get_memory_report(
+    config: ml_collections.ConfigDict,
+    datasets: Dict[str, Dict[str, Iterable[Iterable[jraph.GraphsTuple]]]],
+    profile_steps: Sequence[int] = (),
+    profile_dir: Optional[str] = None,
+) -> Dict[str, Any]:
+    """ Reports the memory of a dataset and of training on it with config.
+
+        The train state is created as in train_and_evaluate_with_data, and
+        max(profile_steps) + 1 train steps are run on the training windows.
+        After each step in profile_steps, a jax.profiler device memory profile
+        is saved to profile_dir/memory_step_{step}.prof (which can be read
+        with pprof).
+    """
+    report = {"dataset": get_dataset_memory(datasets)}
+
+    input_data = datasets['train']['inputs']
+    target_data = datasets['train']['targets']
+    rng = jax.random.key(0)
+    rng, init_rng = jax.random.split(rng)
+    init_net = create_model(config, deterministic=True)
+    params = jax.jit(init_net.init)(init_rng, input_data[0])
+    net = create_model(config, deterministic=False)
+    state = ResumableTrainState.create(
+        apply_fn=net.apply, params=params, tx=create_optimizer(config),
+        rng=jax.random.key_data(rng), epoch=jnp.asarray(0, jnp.int32),
+        epoch_step=jnp.asarray(0, jnp.int32))
+    report["train_state"] = get_train_state_memory(state)
+    report["train_step"] = get_train_step_memory(
+        state, config.output_steps, input_data[0], target_data[0])
+
+    if profile_steps:
+        assert profile_dir is not None, 'profile_steps require a profile_dir'
+        os.makedirs(profile_dir, exist_ok=True)
+        report["profiles"] = []
+        for step in range(max(profile_steps) + 1):
+            j = step % len(input_data)
+            state, _, _ = train_step(
+                state=state, n_rollout_steps=config.output_steps,
+                input_window_graphs=input_data[j],
+                target_window_graphs=target_data[j],
+                rngs={'dropout': jax.random.fold_in(rng, step)})
+            if step in profile_steps:
+                jax.block_until_ready(state)
+                path = os.path.join(profile_dir, f"memory_step_{step}.prof")
+                jax.profiler.save_device_memory_profile(path)
+                report["profiles"].append(path)
+                logging.info(f'saved device memory profile {path}')
+
+    report["device"] = get_device_memory_stats()
+    return report
+
+
+def format_bytes(n_bytes: Optional[int]) -> str:
+    if n_bytes is None:
+        return "n/a"
+    if abs(n_bytes) < 1024:
+        return f"{n_bytes} B"
+    for unit in ["KiB", "MiB", "GiB"]:
+        n_bytes /= 1024
+        if abs(n_bytes) < 1024 or unit == "GiB":
+            return f"{n_bytes:.1f} {unit}"
+
+
+def log_memory_report(report: Dict[str, Any]) -> None:
+    """ Logs a memory report in a readable form. """
+    for split, memory in report["dataset"].items():
+        logging.info(
+            f'dataset {split}: {memory["python_objects"]} python objects '
+            f'({format_bytes(memory["python_object_bytes"])}), '
+            f'{memory["host_arrays"]} host arrays '
+            f'({format_bytes(memory["host_array_bytes"])}), '
+            f'{memory["device_arrays"]} device arrays '
+            f'({format_bytes(memory["device_array_bytes"])})')
+    state_memory = report["train_state"]
+    logging.info(
+        f'train state: {state_memory["n_params"]} params '
+        f'({format_bytes(state_memory["params_bytes"])}), optimizer state '
+        f'{format_bytes(state_memory["opt_state_bytes"])}')
+    logging.info('train_step: ' + ', '.join(
+        f'{field} {format_bytes(value)}'
+        for field, value in report["train_step"].items()))
+    if report["device"] is not None:
+        logging.info('device: ' + ', '.join(
+            f'{field} {format_bytes(value)}'
+            for field, value in report["device"].items()
+            if field.endswith("bytes_in_use") or field == "bytes_limit"))
@@ -0,0 +1,219 @@
+""" Trains a population of models that share an architecture but differ in
+    their continuous hyperparameters (learning rate, momentum, dropout rate),
+    all at once.
+
+    The params and optimizer states of the members are stacked along a leading
+    axis and train_step is vmapped over them. The learning rate and momentum
+    of each member live in its optimizer state (see optax.inject_hyperparams)
+    and its dropout rate is passed to the model at runtime, so one compiled
+    program trains the whole population, for roughly the cost of training one
+    model on a larger batch.
+"""
+from typing import Callable, Dict, Iterable, Optional, Sequence, Tuple
+
+from absl import logging
+from flax import linen as nn
+from flax.training import train_state
+import jax
+import jax.numpy as jnp
+import jraph
+import ml_collections
+import numpy as np
+
+from utils.data_loader import get_epoch_order
+from utils.jraph_training import (create_model, create_optimizer,
+                                  evaluate_split_fn, stack_eval_split,
+                                  train_step_fn, DEFAULT_EVAL_BATCH_SIZE)
+
+# hyperparameters that can differ between the members of a population
+OPTIMIZER_HYPERPARAMS = ("learning_rate", "momentum")
+MODEL_HYPERPARAMS = ("dropout_rate",)
+
+
+def create_population_state(
+    config: ml_collections.ConfigDict,
+    sample_input_window: Iterable[jraph.GraphsTuple],
+    member_hparams: Dict[str, Sequence[float]],
+) -> train_state.TrainState:
+    """ Creates the stacked train state of a population.
+
+        All members start from the same params (initialized as in
+        train_and_evaluate_with_data), so that each member trains like a
+        separate run with its own hyperparameters.
+
+        Args:
+            config: config of the architecture and optimizer
+            sample_input_window: window of graphs used to initialize the params
+            member_hparams: values of the optimizer hyperparameters (e.g.
+                learning_rate) for each member. hyperparameters that are not
+                given are taken from the config.
+
+        Returns:
+            a train state whose arrays have a leading axis over the members
+    """
+    n_members = len(next(iter(member_hparams.values())))
+    assert all(len(values) == n_members for values in member_hparams.values())
+
+    rng = jax.random.key(0)
+    rng, init_rng = jax.random.split(rng)
+    init_net = create_model(config, deterministic=True)
+    params = jax.jit(init_net.init)(init_rng, sample_input_window)
+
+    tx = create_optimizer(config, inject_hyperparams=True)
+    net = create_model(config, deterministic=False)
+    state = train_state.TrainState.create(
+        apply_fn=net.apply, params=params, tx=tx)
+    state = jax.tree_util.tree_map(
+        lambda x: jnp.repeat(jnp.asarray(x)[None], n_members, axis=0), state)
+
+    hyperparams = dict(state.opt_state.hyperparams)
+    for name, values in member_hparams.items():
+        if name in OPTIMIZER_HYPERPARAMS:
+            assert name in hyperparams, (name, config.optimizer)
+            hyperparams[name] = jnp.asarray(values, hyperparams[name].dtype)
+    return state.replace(opt_state=state.opt_state._replace(
+        hyperparams=hyperparams))
+
+
+def train_population_step_fn(
+    state: train_state.TrainState,
+    n_rollout_steps: int,
+    input_window_graphs: Iterable[jraph.GraphsTuple],
+    target_window_graphs: Iterable[jraph.GraphsTuple],
+    rngs: Dict[str, jnp.ndarray],
+    dropout_rates: jnp.ndarray,
+    net: nn.Module,
+):
+    """ Performs one update step of every member of a population, on the same
+        window.
+
+        Args:
+            state: stacked train state (see create_population_state)
+            rngs: rngs with a leading axis over the members
+            dropout_rates: dropout rate of each member
+            net: the (non-deterministic) model, whose dropout rate is replaced
+                by each member's
+
+        Returns:
+            the updated state, the stacked TrainMetrics of the members and
+            their predictions
+    """
+
+    def member_step(member_state, member_rngs, dropout_rate):
+        member_net = net.clone(dropout_rate=dropout_rate)
+        member_state, metrics_update, pred_nodes = train_step_fn(
+            state=member_state.replace(apply_fn=member_net.apply),
+            n_rollout_steps=n_rollout_steps,
+            input_window_graphs=input_window_graphs,
+            target_window_graphs=target_window_graphs,
+            rngs=member_rngs)
+        # keep the population's apply_fn, so the next step reuses the program
+        return (member_state.replace(apply_fn=state.apply_fn), metrics_update,
+                pred_nodes)
+
+    return jax.vmap(member_step)(state, rngs, dropout_rates)
+
+train_population_step = jax.jit(train_population_step_fn,
+                                static_argnames=["n_rollout_steps", "net"])
+
+
+def evaluate_population_split_fn(
+    state: train_state.TrainState,
+    n_rollout_steps: int,
+    input_windows: Iterable[jraph.GraphsTuple],
+    target_windows: Iterable[jraph.GraphsTuple],
+    mask: jnp.ndarray,
+):
+    """ Evaluates every member of a population on a split, stacked with
+        stack_eval_split. Returns the stacked EvalMetrics of the members. """
+    return jax.vmap(lambda member_state: evaluate_split_fn(
+        state=member_state, n_rollout_steps=n_rollout_steps,
+        input_windows=input_windows, target_windows=target_windows,
+        mask=mask))(state)
+
+evaluate_population_split = jax.jit(evaluate_population_split_fn,
+                                    static_argnames=["n_rollout_steps"])
+
+
+def train_population(
+    config: ml_collections.ConfigDict,
+    datasets: Dict[str, Dict[str, Iterable[jraph.GraphsTuple]]],
+    member_hparams: Dict[str, Sequence[float]],
+    report_fn: Optional[Callable[[int, np.ndarray], None]] = None,
+) -> Tuple[train_state.TrainState, np.ndarray]:
+    """ Trains a population of models on the train split and evaluates them on
+        the val split.
+
+        Args:
+            config: config of the architecture, optimizer and training loop
+                (as for train_and_evaluate_with_data)
+            datasets: dataset, as returned by create_dataset
+            member_hparams: value of each member for some of learning_rate,
+                momentum and dropout_rate. the others are taken from the
+                config.
+            report_fn: optional function called with (epoch, val losses of
+                the members) after every evaluation, e.g. to report them to
+                Optuna
+
+        Returns:
+            the stacked train state and the final val loss of each member
+    """
+    unknown = set(member_hparams) - set(OPTIMIZER_HYPERPARAMS + MODEL_HYPERPARAMS)
+    assert not unknown, f'unsupported population hyperparameters: {unknown}'
+
+    train_set = datasets['train']
+    input_data = train_set['inputs']
+    target_data = train_set['targets']
+    n_rollout_steps = config.output_steps
+    n_members = len(next(iter(member_hparams.values())))
+    if "dropout_rate" in member_hparams:
+        dropout_rates = jnp.asarray(member_hparams["dropout_rate"], jnp.float32)
+    else:
+        dropout_rates = jnp.full((n_members,), config.dropout_rate, jnp.float32)
+
+    logging.info(f'Initializing population of {n_members} networks.')
+    state = create_population_state(config, input_data[0], member_hparams)
+    net = create_model(config, deterministic=False)
+    eval_net = create_model(config, deterministic=True)
+    eval_apply_fn = eval_net.apply
+
+    if "shuffle_train" in config._fields.keys():
+        shuffle_train = config.shuffle_train
+    else:
+        shuffle_train = False
+    if "eval_batch_size" in config._fields.keys():
+        eval_batch_size = config.eval_batch_size
+    else:
+        eval_batch_size = DEFAULT_EVAL_BATCH_SIZE
+    stacked_val = stack_eval_split(datasets['val']['inputs'],
+                                   datasets['val']['targets'], eval_batch_size)
+
+    rng = jax.random.key(0)
+    val_losses = None
+    for epoch in range(config.epochs):
+        order = get_epoch_order(len(input_data), epoch, config.seed,
+                                shuffle_train)
+        for j in order:
+            rng, dropout_rng = jax.random.split(rng)
+            state, _, _ = train_population_step(
+                state=state,
+                n_rollout_steps=n_rollout_steps,
+                input_window_graphs=input_data[j],
+                target_window_graphs=target_data[j],
+                rngs={'dropout': jax.random.split(dropout_rng, n_members)},
+                dropout_rates=dropout_rates,
+                net=net,
+            )
+
+        is_last_epoch = (epoch == config.epochs - 1)
+        if epoch % config.eval_every_epochs == 0 or is_last_epoch:
+            val_metrics = evaluate_population_split(
+                state.replace(apply_fn=eval_apply_fn), n_rollout_steps,
+                *stacked_val)
+            val_losses = np.asarray(val_metrics.loss.total
+                                    / val_metrics.loss.count)
+            logging.info(f'epoch {epoch}: population val losses {val_losses}')
+            if report_fn is not None:
+                report_fn(epoch, val_losses)
+
+    return state, val_losses
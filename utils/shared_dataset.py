@@ -0,0 +1,136 @@
+""" Datasets of windows of graphs whose arrays live in shared memory, so that
+    several worker processes (e.g. parallel tuning trials) can use one copy of
+    the dataset instead of each unpickling their own.
+
+    The arrays of each split are stacked (one array per graph of the window
+    and GraphsTuple field) into a single multiprocessing.shared_memory block.
+    Workers attach to the block by name and get the same nested
+    {split: {'inputs'/'targets': [window, ...]}} structure back, where every
+    array is a read-only numpy view into the shared block.
+"""
+from multiprocessing import shared_memory
+from typing import Any, Dict, Iterable, List, Optional
+
+import jraph
+import numpy as np
+
+# offsets of the arrays in the block are aligned to this many bytes
+ALIGNMENT = 64
+
+
+def _aligned(offset: int) -> int:
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+class SharedDataset:
+    """ A dataset in a shared memory block, given its spec.
+
+        The spec is a small picklable dict (the block name and the shape,
+        dtype and offset of each array) to pass to the worker processes, which
+        call SharedDataset.attach(spec). The process that created the dataset
+        should call unlink() once the workers are done.
+    """
+
+    def __init__(self, shm: shared_memory.SharedMemory, spec: Dict[str, Any]):
+        self.shm = shm
+        self.spec = spec
+
+    @classmethod
+    def create(cls, datasets: Dict[str, Dict[str, List[List[jraph.GraphsTuple]]]]
+               ) -> "SharedDataset":
+        """ Copies datasets (as returned by create_dataset) into a new shared
+            memory block. All windows of a split must have the same structure.
+        """
+        layout = {}
+        offset = 0
+        for split, split_data in datasets.items():
+            layout[split] = {}
+            for key, windows in split_data.items():
+                window_layout = []
+                for graph in windows[0]:
+                    graph_layout = {}
+                    for field, value in graph._asdict().items():
+                        if value is None:
+                            graph_layout[field] = None
+                            continue
+                        value = np.asarray(value)
+                        offset = _aligned(offset)
+                        shape = (len(windows),) + value.shape
+                        graph_layout[field] = (offset, shape, value.dtype.str)
+                        offset += int(np.prod(shape)) * value.dtype.itemsize
+                    window_layout.append(graph_layout)
+                layout[split][key] = window_layout
+
+        shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+        spec = {"name": shm.name, "layout": layout}
+        shared = cls(shm, spec)
+        for split, split_data in datasets.items():
+            for key, windows in split_data.items():
+                stacked = shared._stacked_arrays(split, key, writeable=True)
+                for i, window in enumerate(windows):
+                    for graph, graph_arrays in zip(window, stacked):
+                        for field, array in graph_arrays.items():
+                            if array is not None:
+                                array[i] = np.asarray(getattr(graph, field))
+        return shared
+
+    @classmethod
+    def attach(cls, spec: Dict[str, Any]) -> "SharedDataset":
+        """ Attaches to a shared dataset created by another process. """
+        return cls(shared_memory.SharedMemory(name=spec["name"]), spec)
+
+    def _stacked_arrays(self, split: str, key: str, writeable: bool = False
+                        ) -> List[Dict[str, Optional[np.ndarray]]]:
+        """ Returns, for each graph of the window, its fields stacked over the
+            windows, as views into the shared block. """
+        stacked = []
+        for graph_layout in self.spec["layout"][split][key]:
+            graph_arrays = {}
+            for field, array_layout in graph_layout.items():
+                if array_layout is None:
+                    graph_arrays[field] = None
+                    continue
+                offset, shape, dtype = array_layout
+                array = np.ndarray(shape, dtype=np.dtype(dtype),
+                                   buffer=self.shm.buf, offset=offset)
+                array.flags.writeable = writeable
+                graph_arrays[field] = array
+            stacked.append(graph_arrays)
+        return stacked
+
+    def get_datasets(self) -> Dict[str, Dict[str, List[List[jraph.GraphsTuple]]]]:
+        """ Returns the datasets, with the same structure as the ones it was
+            created from, without copying the arrays. The SharedDataset must
+            stay referenced while they are in use, since the block is unmapped
+            when it is garbage collected. """
+        datasets = {}
+        for split, split_layout in self.spec["layout"].items():
+            datasets[split] = {}
+            for key in split_layout:
+                stacked = self._stacked_arrays(split, key)
+                n_windows = self._n_windows(stacked)
+                datasets[split][key] = [
+                    [jraph.GraphsTuple(**{
+                        field: None if array is None else array[i]
+                        for field, array in graph_arrays.items()})
+                     for graph_arrays in stacked]
+                    for i in range(n_windows)]
+        return datasets
+
+    @staticmethod
+    def _n_windows(stacked: Iterable[Dict[str, Optional[np.ndarray]]]) -> int:
+        for graph_arrays in stacked:
+            for array in graph_arrays.values():
+                if array is not None:
+                    return array.shape[0]
+        return 0
+
+    def close(self):
+        """ Detaches this process from the block. The arrays returned by
+            get_datasets must not be used afterwards. """
+        self.shm.close()
+
+    def unlink(self):
+        """ Frees the block, once no process uses it anymore. """
+        self.shm.close()
+        self.shm.unlink()
@@ -0,0 +1,130 @@
+""" Lightweight timing of the phases of the training loop (data fetch,
+    host-to-device transfer, train step dispatch and completion, metric
+    merge, eval, checkpoint) and of jax compilations.
+
+    TrainingTimer keeps the durations of the most recent calls of each phase
+    and writes their p50/p95/p99 (in ms), together with the steps per second,
+    through a clu metric writer. A disabled timer does nothing, so the
+    training loop can time its phases unconditionally.
+"""
+import collections
+import contextlib
+import time
+import weakref
+from typing import Dict, Iterable, Iterator, Optional
+
+import jax
+import numpy as np
+
+# jax compilation events recorded by TrainingTimer, and the names they are
+# recorded under
+COMPILE_EVENTS = {
+    "/jax/core/compile/jaxpr_trace_duration": "compile_trace",
+    "/jax/core/compile/jaxpr_to_mlir_module_duration": "compile_lowering",
+    "/jax/core/compile/backend_compile_duration": "compile_backend",
+}
+PERCENTILES = (50, 95, 99)
+
+# enabled timers, which receive the compilation events
+_timers = weakref.WeakSet()
+_compile_listener_registered = False
+
+
+def _compile_event_listener(event: str, duration: float, **kwargs) -> None:
+    if event in COMPILE_EVENTS:
+        for timer in list(_timers):
+            timer.record(COMPILE_EVENTS[event], duration)
+
+
+class TrainingTimer:
+    """ Rolling durations of named phases.
+
+        Args:
+            enabled: if False, timed() and timed_iter() do not time anything
+            window_size: number of recent durations of each phase that the
+                percentiles are computed over
+    """
+
+    def __init__(self, enabled: bool = True, window_size: int = 1000):
+        global _compile_listener_registered
+        self.enabled = enabled
+        self.durations = collections.defaultdict(
+            lambda: collections.deque(maxlen=window_size))
+        self.n_steps = 0
+        self.last_write_time = time.perf_counter()
+        if enabled:
+            if not _compile_listener_registered:
+                jax.monitoring.register_event_duration_secs_listener(
+                    _compile_event_listener)
+                _compile_listener_registered = True
+            _timers.add(self)
+
+    def record(self, name: str, duration: float):
+        """ Records a duration (in seconds) of the phase name. """
+        self.durations[name].append(duration)
+
+    @contextlib.contextmanager
+    def timed(self, name: str):
+        """ Times the enclosed block as one call of the phase name. """
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def timed_iter(self, name: str, iterable: Iterable) -> Iterator:
+        """ Yields the items of iterable, timing how long each one takes to
+            get, e.g. to time data fetching. """
+        if not self.enabled:
+            return iter(iterable)
+        return self._timed_iter(name, iterable)
+
+    def _timed_iter(self, name: str, iterable: Iterable) -> Iterator:
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.record(name, time.perf_counter() - start)
+            yield item
+
+    def count_steps(self, n_steps: int = 1):
+        """ Counts finished train steps, for the steps per second. """
+        self.n_steps += n_steps
+
+    def summary(self) -> Dict[str, float]:
+        """ Returns the percentiles of the recent durations of each phase (in
+            ms), and the steps per second since the previous summary. """
+        scalars = {}
+        for name, durations in sorted(self.durations.items()):
+            if not durations:
+                continue
+            values = np.percentile(np.asarray(durations) * 1e3, PERCENTILES)
+            for percentile, value in zip(PERCENTILES, values):
+                scalars[f'{name}_ms_p{percentile}'] = float(value)
+        now = time.perf_counter()
+        if now > self.last_write_time:
+            scalars['steps_per_sec'] = (self.n_steps
+                                        / (now - self.last_write_time))
+        self.n_steps = 0
+        self.last_write_time = now
+        return scalars
+
+    def write(self, writer, step: int, prefix: Optional[str] = 'timing'):
+        """ Writes the summary through a clu metric writer. """
+        if not self.enabled:
+            return
+        scalars = self.summary()
+        if prefix:
+            scalars = {f'{prefix}/{name}': value
+                       for name, value in scalars.items()}
+        writer.write_scalars(step, scalars)
+
+    def close(self):
+        """ Stops recording compilation events. """
+        _timers.discard(self)
@@ -0,0 +1,183 @@
+""" Manages the workdirs (checkpoints and logs) of hyperparameter tuning
+    trials, so that a study does not accumulate thousands of them.
+
+    Every trial trains in a temporary workdir. Pruned and failed trials have
+    theirs deleted, and completed trials only keep theirs (moved to
+    study_dir/trial_{number}) while they are among the keep_top_k best trials
+    of the study. Deletions happen on a background thread. A manifest
+    (study_dir/trial_manifest.json) records what happened to the workdir of
+    every trial, and is shared safely by parallel workers through a file lock.
+"""
+import atexit
+import fcntl
+import json
+import os
+import queue
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Optional
+
+from absl import logging
+
+DEFAULT_KEEP_TOP_K = 5
+MANIFEST_NAME = "trial_manifest.json"
+
+
+def get_trial_workdir(study_dir: str, trial_number: int) -> str:
+    """ Returns the workdir that a kept trial's artifacts are moved to. """
+    return os.path.join(study_dir, f"trial_{trial_number}")
+
+
+class TrialArtifacts:
+    """ Artifact policy of the trials of one study.
+
+        Args:
+            study_dir: directory of the study
+            keep_top_k: number of best completed trials whose workdirs are kept
+            direction: "minimize" or "maximize", as for the study
+    """
+
+    def __init__(self, study_dir: str, keep_top_k: int = DEFAULT_KEEP_TOP_K,
+                 direction: str = "minimize"):
+        assert keep_top_k >= 1
+        assert direction in ("minimize", "maximize"), direction
+        self.study_dir = study_dir
+        self.keep_top_k = keep_top_k
+        self.direction = direction
+        self.tmp_dir = os.path.join(study_dir, "tmp")
+        self.manifest_path = os.path.join(study_dir, MANIFEST_NAME)
+        self.lock_path = os.path.join(study_dir, ".trial_manifest.lock")
+        os.makedirs(self.tmp_dir, exist_ok=True)
+
+        self.deletions = queue.Queue()
+        self.deletion_thread = threading.Thread(target=self._delete_loop,
+                                                daemon=True)
+        self.deletion_thread.start()
+
+    def create_workdir(self, trial_number: int) -> str:
+        """ Creates the temporary workdir of a trial. """
+        workdir = tempfile.mkdtemp(prefix=f"trial_{trial_number}_",
+                                   dir=self.tmp_dir)
+        with self._locked_manifest() as manifest:
+            manifest["trials"][str(trial_number)] = {
+                "state": "running", "workdir": workdir, "value": None}
+        return workdir
+
+    def finish(self, trial_number: int, value: float) -> Optional[str]:
+        """ Records the value of a completed trial, and keeps its workdir if
+            it is among the keep_top_k best trials (deleting the workdir of
+            the trial that drops out of them, if any).
+
+            Returns the trial's kept workdir, or None if it was deleted.
+        """
+        with self._locked_manifest() as manifest:
+            entry = manifest["trials"][str(trial_number)]
+            entry["value"] = value
+
+            kept = [(number, kept_entry) for number, kept_entry
+                    in manifest["trials"].items()
+                    if kept_entry["state"] == "kept"]
+            kept.append((str(trial_number), entry))
+            # ties are broken by trial number, so the ranking is deterministic
+            kept.sort(key=lambda item: (
+                item[1]["value"] if self.direction == "minimize"
+                else -item[1]["value"], int(item[0])))
+
+            for rank, (number, kept_entry) in enumerate(kept):
+                if rank < self.keep_top_k:
+                    if number == str(trial_number):
+                        kept_workdir = get_trial_workdir(self.study_dir,
+                                                         trial_number)
+                        self._move_out_of_the_way(kept_workdir)
+                        os.rename(kept_entry["workdir"], kept_workdir)
+                        kept_entry["workdir"] = kept_workdir
+                        kept_entry["state"] = "kept"
+                else:
+                    self._delete(kept_entry["workdir"])
+                    kept_entry["workdir"] = None
+                    kept_entry["state"] = "deleted"
+            return entry["workdir"]
+
+    def discard(self, trial_number: int, state: str = "pruned"):
+        """ Deletes the workdir of a pruned or failed trial. """
+        with self._locked_manifest() as manifest:
+            entry = manifest["trials"][str(trial_number)]
+            self._delete(entry["workdir"])
+            entry["workdir"] = None
+            entry["state"] = state
+
+    def get_workdir(self, trial_number: int) -> Optional[str]:
+        """ Returns the kept workdir of a trial, or None. """
+        entry = self.read_manifest()["trials"].get(str(trial_number))
+        if entry is None or entry["state"] != "kept":
+            return None
+        return entry["workdir"]
+
+    def read_manifest(self) -> Dict[str, Any]:
+        with self._locked_manifest(write=False) as manifest:
+            return manifest
+
+    def wait(self):
+        """ Blocks until the pending deletions are done. """
+        self.deletions.join()
+
+    @contextmanager
+    def _locked_manifest(self, write: bool = True):
+        with open(self.lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                if os.path.exists(self.manifest_path):
+                    with open(self.manifest_path) as f:
+                        manifest = json.load(f)
+                else:
+                    manifest = {"trials": {}}
+                yield manifest
+                if write:
+                    # write to a temporary file first, so readers never see a
+                    # partially written manifest
+                    tmp_path = self.manifest_path + ".tmp"
+                    with open(tmp_path, "w") as f:
+                        json.dump(manifest, f, indent=2)
+                    os.replace(tmp_path, self.manifest_path)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _move_out_of_the_way(self, path: str):
+        """ Deletes a stale directory at path, e.g. from an earlier run. """
+        if os.path.exists(path):
+            self._delete(path)
+
+    def _delete(self, path: Optional[str]):
+        """ Renames path right away (freeing its name) and deletes it in the
+            background. """
+        if path is None or not os.path.exists(path):
+            return
+        trash_path = tempfile.mkdtemp(prefix="deleted_", dir=self.tmp_dir)
+        os.rename(path, os.path.join(trash_path, "workdir"))
+        self.deletions.put(trash_path)
+
+    def _delete_loop(self):
+        while True:
+            path = self.deletions.get()
+            try:
+                shutil.rmtree(path)
+            except OSError as e:
+                logging.warning(f'could not delete trial artifacts {path}: {e}')
+            finally:
+                self.deletions.task_done()
+
+
+_trial_artifacts = {}
+
+
+def get_trial_artifacts(study_dir: str, keep_top_k: int = DEFAULT_KEEP_TOP_K,
+                        direction: str = "minimize") -> TrialArtifacts:
+    """ Returns the TrialArtifacts of a study, shared by the trials of this
+        process. Pending deletions are finished when the process exits. """
+    if study_dir not in _trial_artifacts:
+        artifacts = TrialArtifacts(study_dir, keep_top_k, direction)
+        atexit.register(artifacts.wait)
+        _trial_artifacts[study_dir] = artifacts
+    return _trial_artifacts[study_dir]